@@ -0,0 +1,606 @@
+import os
+import select
+import struct
+import threading
+import tty
+from time import monotonic, sleep
+from Arduino_Hardware import (encode_frame, FRAME_REPLY, FRAME_BATCH, FRAME_STATUS, STATUS_FORMAT)
+
+
+# Pure python stand-in for the brainStepperControl sketch so that LaserBrainArduino,
+# RPiHardware and the deposition code can be run without the real board. The
+# emulator speaks the same serial protocol (text and binary replies, batched
+# queries, the status stream) and models the motors with AccelStepper style
+# trapezoidal kinematics. It can be reached through EmulatedSerial (passed to
+# LaserBrainArduino as serial_port) or through a pty with PtyBridge, and runs in
+# real time, accelerated time, or only when advance() is called.
+
+# Arduino pin numbers for the run lines, and the RPi GPIO each one is wired to
+SUB_RUN = 18
+TARGET_RUN = 19
+LASER_RUN = 20
+PI_GPIO_FOR_PIN = {SUB_RUN: 21, TARGET_RUN: 20, LASER_RUN: 19}
+
+CAROUSEL_STEPS_PER_REV = 6000
+NUM_CHARS = 32  # Serial command buffer length in the sketch
+
+
+class EmulatedStepper:
+    # Minimal model of an AccelStepper driven with run(): accelerates at a constant
+    # rate up to max_speed, then decelerates so that it stops on the target.
+
+    def __init__(self, max_speed=1., acceleration=1.):
+        self.max_speed = float(max_speed)
+        self.acceleration = float(acceleration)
+        self.speed = 0.          # steps/s, signed
+        self.set_speed_value = 0.
+        self._position = 0.      # Kept as a float internally, reported as whole steps
+        self.target_position = 0
+
+    @property
+    def current_position(self):
+        return int(round(self._position))
+
+    def set_current_position(self, position: int):
+        # Like AccelStepper::setCurrentPosition this also stops the motor
+        self._position = float(position)
+        self.target_position = int(position)
+        self.speed = 0.
+
+    def move_to(self, position):
+        self.target_position = int(position)
+
+    def move(self, relative):
+        self.move_to(self.current_position + int(relative))
+
+    def distance_to_go(self):
+        return self.target_position - self.current_position
+
+    def is_running(self):
+        return not (self.speed == 0. and self.target_position == self.current_position)
+
+    def stop(self):
+        # Sets a new target as close as possible while still decelerating
+        if self.speed != 0.:
+            steps_to_stop = int((self.speed * self.speed) / (2. * self.acceleration)) + 1
+            self.move(steps_to_stop if self.speed > 0 else -steps_to_stop)
+
+    def advance(self, dt: float):
+        distance = self.target_position - self._position
+        if self.speed == 0. and abs(distance) < 0.5:
+            self._position = float(self.target_position)
+            return
+
+        direction = 1. if distance > 0 else -1.
+        stopping_distance = (self.speed * self.speed) / (2. * self.acceleration)
+        if self.speed * direction < 0 or stopping_distance >= abs(distance):
+            # Heading the wrong way or need to start braking
+            braking = self.acceleration * dt
+            if abs(self.speed) <= braking:
+                self.speed = 0.
+            else:
+                self.speed -= braking if self.speed > 0 else -braking
+        else:
+            self.speed += direction * self.acceleration * dt
+            self.speed = max(-self.max_speed, min(self.max_speed, self.speed))
+
+        self._position += self.speed * dt
+        remaining = self.target_position - self._position
+        # Snap to the target when we reach or pass it at low speed
+        if remaining * direction <= 0.5 and abs(self.speed) <= max(self.acceleration * dt * 2, 1.):
+            self._position = float(self.target_position)
+            self.speed = 0.
+
+
+class BrainStepperEmulator:
+    # Emulates brainStepperControl.ino. Bytes from the host go in through feed(),
+    # replies come out through read_output(). Time only moves when advance() is
+    # called; the serial wrappers below take care of that.
+
+    def __init__(self, loop_period=0.001):
+        self.loop_period = loop_period  # Simulated seconds per pass of loop()
+        self.time = 0.                   # Simulated seconds since power on
+
+        # Same setup() values as the sketch
+        self.substrate = EmulatedStepper(max_speed=1000, acceleration=20000)
+        self.target = EmulatedStepper(max_speed=600, acceleration=1000)
+        self.laser = EmulatedStepper(max_speed=20, acceleration=500000)
+        self.target_accel = 1000.
+        self.sub_accel = 20000.
+
+        self.laser_run_indef = False
+        self.sub_run_indef = False
+        self.target_run_indef = False
+        self.sub_dir_indef = 0
+        self.target_dir_indef = 0
+        self.current_target = 0
+        self.raster_steps = 0
+        self.raster_on = False
+        self.centering = False
+        self.raster_side = 1
+
+        self.status_period_ms = 0
+        self.last_status_frame = None
+        self.binary_mode = False
+
+        self.pins = {}            # Arduino pin number -> 0/1
+        self.pin_callbacks = []   # Called as callback(pin, value) when an output pin changes
+
+        self._in_buffer = bytearray()
+        self._receiving = False
+        self._commands = []
+        self._output = bytearray()
+        self._repeat_command = None  # '<l,u,d>' keeps commandReady set in the sketch
+
+        self.commands_processed = 0
+
+    # ---- Serial side ----
+
+    def feed(self, data: bytes):
+        # Mirrors recCommand(): keep what is between '<' and '>', truncated to the
+        # sketch's buffer length.
+        for byte in data:
+            char = chr(byte)
+            if self._receiving:
+                if char == '>':
+                    self._commands.append(self._in_buffer.decode('ascii', errors='replace')[:NUM_CHARS - 1])
+                    self._in_buffer = bytearray()
+                    self._receiving = False
+                else:
+                    self._in_buffer.append(byte)
+            elif char == '<':
+                self._receiving = True
+
+    def read_output(self):
+        data = bytes(self._output)
+        self._output.clear()
+        return data
+
+    def output_waiting(self):
+        return len(self._output)
+
+    # ---- Main loop ----
+
+    def advance(self, dt: float):
+        # Runs the sketch's loop() for dt simulated seconds. Commands that are
+        # waiting are handled on the first pass, one per pass like the sketch.
+        steps = max(1, int(round(dt / self.loop_period)))
+        step_dt = dt / steps if dt > 0 else 0.
+        for _ in range(steps):
+            self._loop(step_dt)
+
+    def _loop(self, dt):
+        if self._commands:
+            # A new command replaces the one being repeated (the sketch only
+            # repeats while no new command has come in), <l,u,d> sets it again
+            self._repeat_command = None
+            self._handle_command(self._commands.pop(0))
+        elif self._repeat_command is not None:
+            self._handle_command(self._repeat_command)
+
+        # Rastering, same order of checks as the sketch
+        center = self.current_target * (CAROUSEL_STEPS_PER_REV // 6)
+        if self.raster_steps == 0 and not self.centering and self.raster_on:
+            self.target.move_to(center)
+            self.centering = True
+        elif self.raster_side == 0 and self.centering and self.raster_on:
+            if self.target.distance_to_go() == 0:
+                self.centering = False
+                self.raster_on = False
+        elif self.raster_on and self.target.distance_to_go() == 0:
+            self.raster_side *= -1
+            self.target.move_to(center + self.raster_steps * self.raster_side)
+
+        if self.sub_run_indef:
+            self.substrate.move(100 * self.sub_dir_indef)
+        if self.target_run_indef:
+            self.target.move(100 * self.target_dir_indef)
+        if self.laser_run_indef:
+            self.laser.move(100)
+
+        # Run lines. Note that the sketch as written never pulls TARGET_RUN low,
+        # the emulator does the same so the host sees what the hardware does.
+        if self.target.is_running():
+            self._write_pin(TARGET_RUN, 1)
+        elif self.target.current_position >= CAROUSEL_STEPS_PER_REV or self.target.current_position < 0:
+            self.target.set_current_position(self.target.current_position % CAROUSEL_STEPS_PER_REV)
+        else:
+            self._write_pin(TARGET_RUN, 1)
+        self._write_pin(SUB_RUN, int(self.substrate.is_running()))
+        self._write_pin(LASER_RUN, int(self.laser.is_running()))
+
+        if dt > 0:
+            self.target.advance(dt)
+            self.substrate.advance(dt)
+            self.laser.advance(dt)
+            self.time += dt
+
+        self.current_target = int(round(((self.target.current_position % CAROUSEL_STEPS_PER_REV)
+                                         / CAROUSEL_STEPS_PER_REV) * 6))
+
+        if self.status_period_ms > 0:
+            now_ms = self.time * 1000
+            if self.last_status_frame is None or now_ms - self.last_status_frame >= self.status_period_ms:
+                self.last_status_frame = now_ms
+                self._send_status_frame()
+
+    def _write_pin(self, pin, value):
+        if self.pins.get(pin) != value:
+            self.pins[pin] = value
+            for callback in self.pin_callbacks:
+                callback(pin, value)
+
+    # ---- Command handling ----
+
+    @staticmethod
+    def _atol(text):
+        # atol() semantics: leading integer, 0 if there isn't one
+        try:
+            return int(float(text))
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _atof(text):
+        try:
+            return float(text)
+        except (TypeError, ValueError):
+            return 0.
+
+    def _handle_command(self, command: str):
+        self.commands_processed += 1
+        tokens = command.split(',')
+        axis = tokens[0][:1]
+        if axis == 'b':
+            self._batch_query(tokens[1:])
+        elif axis == 'o' and len(tokens) >= 3:
+            self._write_pin(self._atol(tokens[1]), 1 if tokens[2][:1] == 'w' else 0)
+        elif axis == 'i' and len(tokens) >= 2:
+            self._reply(FRAME_REPLY, [('l', self.pins.get(self._atol(tokens[1]), 0))])
+        elif axis in 'stlmn' and len(tokens) >= 2:
+            command_type = tokens[1][:1]
+            param = tokens[2][:1] if len(tokens) >= 3 else ''
+            value = tokens[3] if len(tokens) >= 4 else None
+            if axis == 's':
+                self._update_motor(self.substrate, 's', command_type, param, value)
+            elif axis == 't':
+                self._update_motor(self.target, 't', command_type, param, value)
+            elif axis == 'l':
+                self._update_laser(command, command_type, param, value)
+            elif axis == 'm':
+                if command_type == 'u' and param == 'r':
+                    self.status_period_ms = max(0, self._atol(value))
+                    self.last_status_frame = None
+                elif command_type == 'h':
+                    self.status_period_ms = 0
+            elif axis == 'n':
+                if command_type == 'b':
+                    self._output.extend(b'BIN1\r\n')
+                    self.binary_mode = True
+                elif command_type == 't':
+                    self.binary_mode = False
+                    self._output.extend(b'TXT1\r\n')
+        # 'f' and 'r' (serial forwarding) have nothing connected, ignore them
+
+    def _update_motor(self, motor, axis, command_type, param, value):
+        if command_type == 'u':
+            if param == 'a':
+                motor.acceleration = self._atof(value)
+                if axis == 't':
+                    self.target_accel = motor.acceleration
+                else:
+                    self.sub_accel = motor.acceleration
+            elif param == 'm':
+                motor.max_speed = self._atof(value)
+            elif param == 'v':
+                motor.set_speed_value = self._atof(value)
+            elif param == 'g':
+                if axis == 's':
+                    self.sub_run_indef = False
+                    self.sub_dir_indef = 0
+                    motor.move_to(self._atol(value))
+                else:
+                    self.raster_on = False
+                    self.raster_side = 0
+                    self.raster_steps = 0
+                    self.target_run_indef = False
+                    self.target_dir_indef = 0
+                    motor.move(self._shortest_move_to_target(self._atol(value) % CAROUSEL_STEPS_PER_REV))
+            elif param == 't':
+                motor.move(self._atol(value))
+            elif param == 'p':
+                motor.set_current_position(self._atol(value))
+            elif param == 'd':
+                direction = self._atol(value)
+                if direction in (1, -1):
+                    if axis == 's':
+                        self.sub_run_indef = True
+                        self.sub_dir_indef = direction
+                    else:
+                        self.target_run_indef = True
+                        self.target_dir_indef = direction
+            elif param == 'r' and axis == 't':
+                self.raster_steps = self._atol(value)
+                if self.raster_steps == 0:
+                    self.raster_side = 0
+                else:
+                    self.raster_side = 1
+                    self.raster_on = True
+        elif command_type == 'q':
+            self._reply(FRAME_REPLY, [self._motor_value(motor, axis, param)])
+        elif command_type == 'h':
+            motor.stop()
+            if axis == 's':
+                self.sub_run_indef = False
+                self.sub_dir_indef = 0
+            else:
+                self.target_run_indef = False
+                self.target_dir_indef = 0
+
+    def _update_laser(self, command, command_type, param, value):
+        if command_type == 'u':
+            if param == 'r':
+                reprate = self._atol(value)
+                self.laser.max_speed = min(20, abs(reprate))
+            elif param == 'g':
+                self.laser_run_indef = False
+                self.laser.set_current_position(0)
+                self.laser.move(self._atol(value))
+            elif param == 't':
+                self.laser_run_indef = False
+                self.laser.move_to(max(self._atol(value), self.laser.current_position))
+            elif param == 'd':
+                # The sketch leaves commandReady set for this one so it repeats
+                self.laser_run_indef = True
+                self._repeat_command = command
+        elif command_type == 'q':
+            self._reply(FRAME_REPLY, [self._laser_value(param)])
+        elif command_type == 'h':
+            self.laser.stop()
+            self.laser_run_indef = False
+            self._repeat_command = None
+
+    def _motor_value(self, motor, axis, param):
+        if param == 'p':
+            return 'l', motor.current_position
+        if param == 'a':
+            return 'f', self.target_accel if axis == 't' else self.sub_accel
+        if param == 'm':
+            return 'f', motor.max_speed
+        if param == 'v':
+            return 'f', motor.speed
+        if param == 'g':
+            return 'l', motor.target_position
+        if param == 'd':
+            return 'l', motor.distance_to_go()
+        if param == 'r':
+            return 'l', int(motor.is_running())
+        return None
+
+    def _laser_value(self, param):
+        if param == 'p':
+            return 'l', self.laser.current_position
+        if param == 'm':
+            return 'f', self.laser.max_speed
+        if param == 'v':
+            return 'f', self.laser.speed
+        if param == 'g':
+            return 'l', self.laser.target_position
+        if param == 'd':
+            return 'l', self.laser.distance_to_go()
+        if param == 'r':
+            return 'l', int(self.laser.is_running())
+        return None
+
+    def _batch_query(self, pairs):
+        values = []
+        for pair in pairs:
+            if pair[:1] == 's':
+                values.append(self._motor_value(self.substrate, 's', pair[1:2]))
+            elif pair[:1] == 't':
+                values.append(self._motor_value(self.target, 't', pair[1:2]))
+            elif pair[:1] == 'l':
+                values.append(self._laser_value(pair[1:2]))
+            else:
+                values.append(None)
+        self._reply(FRAME_BATCH, values)
+
+    def _shortest_move_to_target(self, final_pos):
+        origin = self.target.current_position
+        delta_mod = abs(origin - final_pos) % CAROUSEL_STEPS_PER_REV
+        if delta_mod > CAROUSEL_STEPS_PER_REV / 2:
+            path = CAROUSEL_STEPS_PER_REV - delta_mod
+            if final_pos > origin:
+                path *= -1
+        else:
+            path = delta_mod
+            if origin > final_pos:
+                path *= -1
+        return path
+
+    # ---- Output ----
+
+    def _reply(self, frame_type, values):
+        # values is a list of (struct format, value) pairs, None for unknown
+        # parameters (printed as nothing, like the sketch).
+        if self.binary_mode:
+            payload = b''.join(struct.pack('<' + fmt, value) for fmt, value in filter(None, values))
+            self._output.extend(encode_frame(frame_type, payload))
+            return
+        text = ','.join('' if item is None else self._format(*item) for item in values)
+        if frame_type == FRAME_BATCH:
+            text = '{' + text + '}'
+        self._output.extend((text + '\r\n').encode('ascii'))
+
+    @staticmethod
+    def _format(fmt, value):
+        if fmt == 'f':
+            return '{:.2f}'.format(value)
+        return str(int(value))
+
+    def _send_status_frame(self):
+        flags = (int(self.substrate.is_running()) | int(self.target.is_running()) << 1
+                 | int(self.laser.is_running()) << 2 | int(self.raster_on) << 3)
+        values = (self.substrate.current_position, self.substrate.distance_to_go(),
+                  self.target.current_position, self.target.distance_to_go(),
+                  self.laser.current_position, self.laser.distance_to_go(), flags)
+        if self.binary_mode:
+            self._output.extend(encode_frame(FRAME_STATUS, struct.pack(STATUS_FORMAT, *values)))
+        else:
+            self._output.extend(('#' + ','.join(str(value) for value in values) + '\r\n').encode('ascii'))
+
+    # ---- RPi side ----
+
+    def attach_pi_pins(self, pin_factory):
+        # Drives the RPi ends of the run lines on a gpiozero MockFactory so that
+        # RPiHardware's buttons follow the emulated motors.
+        def drive(pin, value):
+            if pin in PI_GPIO_FOR_PIN:
+                mock_pin = pin_factory.pin(PI_GPIO_FOR_PIN[pin])
+                if value:
+                    mock_pin.drive_high()
+                else:
+                    mock_pin.drive_low()
+        self.pin_callbacks.append(drive)
+
+
+class EmulatorClock:
+    # Advances an emulator in real time (time_scale=1), accelerated time
+    # (time_scale > 1) or not at all (time_scale=None, call advance() yourself).
+
+    def __init__(self, emulator: BrainStepperEmulator, time_scale=1., tick=0.002):
+        self.emulator = emulator
+        self.time_scale = time_scale
+        self.tick = tick
+        self.lock = threading.RLock()
+        self.output_ready = threading.Condition(self.lock)
+        self._stop_event = threading.Event()
+        self._thread = None
+        if time_scale is not None:
+            self._thread = threading.Thread(target=self._run, name='EmulatorClock', daemon=True)
+            self._thread.start()
+
+    def advance(self, dt: float):
+        with self.lock:
+            self.emulator.advance(dt)
+            if self.emulator.output_waiting():
+                self.output_ready.notify_all()
+
+    def feed(self, data: bytes):
+        with self.lock:
+            self.emulator.feed(data)
+            if self.time_scale is None:
+                # Nothing else will run the loop, handle the commands right away
+                self.emulator.advance(0)
+                if self.emulator.output_waiting():
+                    self.output_ready.notify_all()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(1.)
+
+    def _run(self):
+        last = monotonic()
+        while not self._stop_event.is_set():
+            sleep(self.tick)
+            now = monotonic()
+            self.advance((now - last) * self.time_scale)
+            last = now
+
+
+class EmulatedSerial:
+    # Loopback object with the parts of the pyserial API that LaserBrainArduino
+    # uses, connected straight to an emulator.
+
+    def __init__(self, emulator=None, time_scale=1., timeout=0.1):
+        self.emulator = emulator if emulator is not None else BrainStepperEmulator()
+        self.clock = EmulatorClock(self.emulator, time_scale)
+        self.timeout = timeout
+        self.is_open = True
+        self._buffer = bytearray()
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @property
+    def in_waiting(self):
+        with self.clock.lock:
+            self._collect()
+            return len(self._buffer)
+
+    def write(self, data: bytes):
+        self.bytes_written += len(data)
+        self.clock.feed(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        with self.clock.lock:
+            self._wait_for(lambda: len(self._buffer) >= size)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self):
+        with self.clock.lock:
+            self._wait_for(lambda: b'\n' in self._buffer)
+            end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+            data = bytes(self._buffer[:end])
+            del self._buffer[:end]
+        self.bytes_read += len(data)
+        return data
+
+    def reset_input_buffer(self):
+        with self.clock.lock:
+            self._collect()
+            self._buffer.clear()
+
+    def close(self):
+        self.is_open = False
+        self.clock.stop()
+
+    def _collect(self):
+        self._buffer.extend(self.emulator.read_output())
+
+    def _wait_for(self, ready):
+        # Called with the clock lock held
+        deadline = monotonic() + (self.timeout if self.timeout is not None else 1e9)
+        self._collect()
+        while not ready():
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not self.is_open:
+                break
+            self.clock.output_ready.wait(remaining)
+            self._collect()
+
+
+class PtyBridge:
+    # Exposes an emulator on a pseudo terminal so it can be opened by name like
+    # the real board, e.g. LaserBrainArduino(PtyBridge().port).
+
+    def __init__(self, emulator=None, time_scale=1.):
+        self.emulator = emulator if emulator is not None else BrainStepperEmulator()
+        self.clock = EmulatorClock(self.emulator, time_scale)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='PtyBridge', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join(1.)
+        self.clock.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._master], [], [], self.clock.tick)
+            if readable:
+                self.clock.feed(os.read(self._master, 256))
+            with self.clock.lock:
+                data = self.emulator.read_output()
+            if data:
+                os.write(self._master, data)
@@ -1,17 +1,193 @@
 import serial
-from PyQt5.QtCore import QObject
-from time import sleep
+import asyncio
+import struct
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from PyQt5.QtCore import QObject, pyqtSignal
+from time import sleep, monotonic
+import Global_Values as Global
+
+
+# Binary reply framing, see binaryFraming.ino in the arduino sketch. A frame is
+# FRAME_SYNC, type, payload length, payload, CRC-16/CCITT-FALSE (low byte first)
+# with the CRC taken over the type, length and payload.
+FRAME_SYNC = 0xA5
+FRAME_REPLY = 0x01
+FRAME_BATCH = 0x02
+FRAME_STATUS = 0x03
+STATUS_FORMAT = '<6lB'  # Six longs and the flags byte
+
+# Text lines the firmware sends after switching reply framing (<n,b> and <n,t>)
+ACK_BINARY = 'BIN1'
+ACK_TEXT = 'TXT1'
+
+
+class ReplyLostError(RuntimeError):
+    # Set on requests that were pending when a reply went missing, see LaserBrainArduino.resync
+    pass
+
+
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def encode_frame(frame_type: int, payload: bytes):
+    body = bytes((frame_type, len(payload))) + payload
+    return bytes((FRAME_SYNC,)) + body + struct.pack('<H', crc16(body))
+
+
+class FrameDecoder:
+    # Incremental decoder for binary frames. Bytes are fed in as they arrive and
+    # complete frames come back as (type, payload) tuples. Anything that fails the
+    # CRC is skipped a byte at a time until the decoder finds the next good frame.
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, data: bytes):
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_SYNC)
+            if start < 0:
+                self.buffer.clear()
+                break
+            del self.buffer[:start]
+            if len(self.buffer) < 3:
+                break
+            end = 3 + self.buffer[2] + 2
+            if len(self.buffer) < end:
+                break
+            body = bytes(self.buffer[1:end - 2])
+            if struct.unpack_from('<H', self.buffer, end - 2)[0] == crc16(body):
+                frames.append((body[0], body[2:]))
+                del self.buffer[:end]
+            else:
+                self.crc_errors += 1
+                del self.buffer[:1]
+        return frames
+
+
+class ArduinoStatus:
+    # One decoded status frame pushed by the arduino. A new object is created
+    # for every frame, so holding on to one gives a consistent view of all axes.
+    __slots__ = ('timestamp', 'sub_position', 'sub_distance_to_go', 'target_position', 'target_distance_to_go',
+                 'laser_pulses', 'laser_pulses_remaining', 'flags')
+
+    # Bits in the flags field of a status frame
+    SUB_RUNNING = 1
+    TARGET_RUNNING = 2
+    LASER_RUNNING = 4
+    RASTER_ON = 8
+
+    def __init__(self, timestamp, sub_position, sub_distance_to_go, target_position, target_distance_to_go,
+                 laser_pulses, laser_pulses_remaining, flags):
+        self.timestamp = timestamp  # time.monotonic() when the frame was received
+        self.sub_position = sub_position
+        self.sub_distance_to_go = sub_distance_to_go
+        self.target_position = target_position
+        self.target_distance_to_go = target_distance_to_go
+        self.laser_pulses = laser_pulses
+        self.laser_pulses_remaining = laser_pulses_remaining
+        self.flags = flags
+
+    @classmethod
+    def from_line(cls, line: str, timestamp: float):
+        # Parses '#sp,sd,tp,td,lp,ld,flags'
+        values = [int(value) for value in line.lstrip('#').split(',')]
+        if len(values) != 7:
+            raise ValueError('Malformed status frame: {}'.format(line))
+        return cls(timestamp, *values)
+
+    @classmethod
+    def from_payload(cls, payload: bytes, timestamp: float):
+        # Parses the payload of a binary FRAME_STATUS frame
+        return cls(timestamp, *struct.unpack(STATUS_FORMAT, payload))
+
+    @property
+    def sub_running(self):
+        return bool(self.flags & self.SUB_RUNNING)
+
+    @property
+    def target_running(self):
+        return bool(self.flags & self.TARGET_RUNNING)
+
+    @property
+    def laser_running(self):
+        return bool(self.flags & self.LASER_RUNNING)
+
+    @property
+    def raster_on(self):
+        return bool(self.flags & self.RASTER_ON)
+
+    def age(self):
+        return monotonic() - self.timestamp
 
 
 class LaserBrainArduino(QObject):
+    # Emitted from the reader thread with an ArduinoStatus for every pushed frame
+    status_updated = pyqtSignal(object)
 
-    def __init__(self, port: str):
+    def __init__(self, port: str, binary=True, serial_port=None):
         super().__init__()
 
-        self.arduino = serial.Serial(port, baudrate=115200, timeout=1.5)  # Standard port with 8N1 configuration
+        # Standard port with 8N1 configuration. The short timeout only sets how
+        # often the reader thread wakes up to check for shutdown. An already open
+        # pyserial-like object can be passed as serial_port instead (e.g. the
+        # EmulatedSerial from Arduino_Emulator), in which case port is ignored.
+        if serial_port is None:
+            serial_port = serial.Serial(port, baudrate=115200, timeout=0.1)
+        self.arduino = serial_port
         self.serial_read_delay = 0.01
         # FIXME: This is a guess at timing that probably needs adjusting but
         #  isn't relevant till we need more serial ports
+        self.reply_timeout = 1.5  # Seconds the blocking query methods will wait for a reply
+        self.command_buffer_size = 32  # Matches numChars in brainStepperControl.ino
+
+        # Replies from the arduino are not tagged, but it answers queries in
+        # the order they are received, so outstanding requests are matched to
+        # reply lines first in, first out. The write lock keeps the order of
+        # the pending queue and the order on the wire the same. If a reply goes
+        # missing (timeout, or a frame dropped for a bad CRC) every later reply
+        # would go to the wrong request, so resync() fails everything pending
+        # and drops replies until they stop coming before matching again.
+        self._pending = deque()
+        self._quiet = threading.Event()  # Cleared while draining stray replies after a lost one
+        self._quiet.set()
+        self._last_stray = 0.         # monotonic() time of the last reply dropped while draining
+        self.binary_mode = False      # Set once the arduino has agreed to binary replies
+        self._text_resync = False     # Set while waiting for the text ack to <n,t> among binary frames
+        self._resync_buffer = bytearray()
+        self._text_carry = b''        # Text that arrived in the same read as the ack to <n,t>
+        self._decoder = FrameDecoder()
+        self.status = None            # Most recent ArduinoStatus, None until the stream is started
+        self.status_period_ms = 0     # Requested milliseconds between pushed status frames
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._reader_thread = threading.Thread(target=self._read_loop, name='LaserBrainArduinoReader',
+                                               daemon=True)
+        self._reader_thread.start()
+
+        # struct format codes for the value returned by each query parameter
+        self.query_formats = {'p': 'l', 'g': 'l', 'd': 'l', 'r': 'l',
+                              'a': 'f', 'm': 'f', 'v': 'f'}
 
         self.valid_axes = {'laser': 'l', 'l': 'l',                      # l is for laser
                            'sub': 's', 'substrate': 's', 's': 's',      # s is for substrate
@@ -19,10 +195,13 @@ class LaserBrainArduino(QObject):
                            'pin write': 'o', 'write': 'o', 'o': 'o',    # o is for (gpi)o
                            'pin read': 'i', 'read': 'i', 'i': 'i',      # i is for (gp)i(o)
                            'serial forward': 'f', 'f': 'f',             # f is for (serial) f(orward)
-                           'serial read': 'r', 'r': 'r'}                # r is for serial r(ead)
+                           'serial read': 'r', 'r': 'r',                # r is for serial r(ead)
+                           'batch': 'b', 'b': 'b',                      # b is for b(atched query)
+                           'status stream': 'm', 'm': 'm'}              # m is for (status) m(onitor)
 
         self.valid_laser_params = {'reprate': 'r', 'r': 'r',
                                    'goal': 'g', 'g': 'g',
+                                   'total goal': 't', 't': 't',  # Goal counted from the last 'goal', no reset
                                    'start': 'd', 'd': 'd'}
 
         self.valid_laser_queries = {'pulses': 'p', 'p': 'p',
@@ -66,11 +245,253 @@ class LaserBrainArduino(QObject):
                                   'A5': 19, 'PiGPIO20': 19, 'A6': 20, 'PiGPIO19': 20,
                                   'LED': 13}
 
+        if binary:
+            self.negotiate_binary()
+
     def send_serial(self, command: str):
-        self.arduino.write(command.encode('utf-8'))
+        with self._write_lock:
+            self.arduino.write(command.encode('utf-8'))
+
+    def request(self, command: str, parser=None, value_format='l'):
+        # Sends a command that the arduino will answer with one reply and returns
+        # a Future for that reply. In text mode parser is applied to the stripped
+        # reply line. In binary mode the payload is unpacked with value_format and
+        # parser gets the tuple of values instead; without a parser a single value
+        # is formatted the way the arduino would have printed it, so callers see
+        # the same result in either mode.
+        future = Future()
+        with self._write_lock:
+            # Held back until a resync has finished draining, or its reply would be dropped with the stray ones
+            self._quiet.wait(self.reply_timeout)
+            self._pending.append((future, parser, value_format))
+            self.arduino.write(command.encode('utf-8'))
+        return future
+
+    async def arequest(self, command: str, parser=None, value_format='l'):
+        # asyncio flavour of request(), for use from a running event loop
+        return await asyncio.wrap_future(self.request(command, parser, value_format))
+
+    def negotiate_binary(self, timeout=0.5):
+        # Asks the arduino to switch to binary replies. Older firmware ignores the
+        # command, in which case we stay in text mode. The ack itself switches
+        # the reader (see _handle_protocol_ack), so one that turns up after the
+        # timeout still leaves both ends in binary.
+        future = self.request('<n,b>', self._accept_protocol_ack)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._abandon(future)
+            print('Arduino did not accept binary framing, using text replies.')
+            return self.binary_mode
+
+    def negotiate_text(self):
+        # The ack comes back as a text line after the last binary frame, so the
+        # reader watches for it in the byte stream from here on.
+        self._text_resync = self.binary_mode
+        return self.wait_reply(self.request('<n,t>', self._accept_protocol_ack))
+
+    @staticmethod
+    def _accept_protocol_ack(line):
+        # Parser for the <n,b> and <n,t> requests, the mode switch is done by _handle_protocol_ack
+        return True
 
-    def return_serial(self):
-        return self.arduino.readline().decode('utf-8')
+    def _handle_protocol_ack(self, line: str):
+        # Switches the reader to the mode the firmware has just changed to. Not
+        # treated as an ordinary reply, an ack whose request already timed out
+        # mustn't be taken as the reply to whatever was sent next.
+        self.binary_mode = line == ACK_BINARY
+        self._text_resync = False
+        self._decoder.buffer.clear()
+        if self._pending and self._pending[0][1] is self._accept_protocol_ack:
+            future = self._pending.popleft()[0]
+            if not future.cancelled():
+                future.set_result(True)
+        else:
+            print('Late {} from arduino, switched to {} replies.'.format(line, 'binary' if self.binary_mode else 'text'))
+
+    def _abandon(self, future: Future):
+        # Drops a request that will never be answered (e.g. a command the firmware
+        # doesn't know) so that it doesn't swallow the next reply.
+        with self._write_lock:
+            for entry in list(self._pending):
+                if entry[0] is future:
+                    self._pending.remove(entry)
+        future.cancel()
+
+    def wait_reply(self, future: Future):
+        # Blocks for a reply up to reply_timeout. On a timeout the replies can
+        # no longer be trusted to line up with the requests, so they are resynced.
+        try:
+            return future.result(timeout=self.reply_timeout)
+        except FutureTimeoutError:
+            print('Timed out waiting for a reply from the arduino.')
+            self.resync()
+        except ReplyLostError as err:
+            print(err)
+
+    def resync(self, reason='a reply from the arduino went missing'):
+        # Fails every pending request with ReplyLostError and drops replies
+        # (status frames are still handled) until none has come for
+        # ARDUINO_RESYNC_QUIET seconds. New requests wait for that in request().
+        with self._write_lock:
+            pending, self._pending = self._pending, deque()
+            self._last_stray = monotonic()
+            self._quiet.clear()
+        for future, parser, value_format in pending:
+            if not future.done():
+                future.set_exception(ReplyLostError('Arduino request dropped, {}.'.format(reason)))
+
+    def _check_quiet(self):
+        # Called by the reader, ends a resync once the stray replies have stopped
+        if not self._quiet.is_set() and monotonic() - self._last_stray >= Global.ARDUINO_RESYNC_QUIET:
+            self._quiet.set()
+
+    def _take_pending(self):
+        # The request the next reply answers, None if the reply has to be dropped
+        if not self._quiet.is_set():
+            self._last_stray = monotonic()
+            return None
+        try:
+            return self._pending.popleft()
+        except IndexError:
+            return None
+
+    def close(self):
+        self._stop_event.set()
+        self._reader_thread.join(1.0)
+        self.arduino.close()
+        while self._pending:
+            self._pending.popleft()[0].cancel()
+
+    def _read_loop(self):
+        # Drains the serial port continuously so replies never sit in the OS
+        # buffer waiting for a caller to get around to reading them.
+        while not self._stop_event.is_set():
+            try:
+                if self.binary_mode:
+                    self._feed_binary(self.arduino.read(max(1, self.arduino.in_waiting)))
+                else:
+                    line = self.arduino.readline()
+                    if self._text_carry:
+                        line, self._text_carry = self._text_carry + line, b''
+                    for part in line.split(b'\n'):
+                        if part.strip():
+                            self._handle_line(part.decode('utf-8', errors='replace').strip())
+            except serial.SerialException as err:
+                print('Arduino serial read failed:', err)
+                break
+            self._check_quiet()
+
+    def _feed_binary(self, data: bytes):
+        ack_at = -1
+        if self._text_resync:
+            # Frames sent before the switch go to the decoder, the ack line and
+            # anything after it are text. A few bytes are held back in case the
+            # ack is split across reads.
+            self._resync_buffer.extend(data)
+            ack_at = self._resync_buffer.find(ACK_TEXT.encode())
+            split = ack_at if ack_at >= 0 else max(len(self._resync_buffer) - len(ACK_TEXT) + 1, 0)
+            data, rest = bytes(self._resync_buffer[:split]), bytes(self._resync_buffer[split:])
+            self._resync_buffer.clear()
+            if ack_at < 0:
+                self._resync_buffer.extend(rest)
+        crc_errors = self._decoder.crc_errors
+        for frame_type, payload in self._decoder.feed(data):
+            self._handle_frame(frame_type, payload)
+        if self._decoder.crc_errors != crc_errors:
+            if not self._quiet.is_set():
+                self._last_stray = monotonic()
+            elif self._pending:
+                # The bad frame may have been a reply
+                self.resync('a reply frame failed its CRC')
+        if ack_at >= 0:
+            line, _, self._text_carry = rest.partition(b'\n')
+            self._handle_protocol_ack(line.decode('utf-8', errors='replace').strip())
+
+    def _handle_line(self, line: str):
+        if line in (ACK_BINARY, ACK_TEXT):
+            self._handle_protocol_ack(line)
+            return
+        if line.startswith('#'):
+            # Unsolicited status frame, not a reply to anything
+            try:
+                self.status = ArduinoStatus.from_line(line, monotonic())
+            except ValueError as err:
+                print(err)
+                return
+            self.status_updated.emit(self.status)
+            return
+        entry = self._take_pending()
+        if entry is None:
+            if self._quiet.is_set():
+                print('Unexpected message from arduino:', line)
+            return
+        future, parser, value_format = entry
+        if future.cancelled():
+            return
+        try:
+            future.set_result(parser(line) if parser is not None else line)
+        except (ValueError, TypeError) as err:
+            future.set_exception(err)
+
+    def _handle_frame(self, frame_type: int, payload: bytes):
+        if frame_type == FRAME_STATUS:
+            try:
+                self.status = ArduinoStatus.from_payload(payload, monotonic())
+            except struct.error as err:
+                print('Malformed status frame from arduino:', err)
+                return
+            self.status_updated.emit(self.status)
+            return
+        entry = self._take_pending()
+        if entry is None:
+            if self._quiet.is_set():
+                print('Unexpected frame from arduino: type={}, payload={}'.format(frame_type, payload))
+            return
+        future, parser, value_format = entry
+        if future.cancelled():
+            return
+        try:
+            values = struct.unpack('<' + value_format, payload)
+            if parser is not None:
+                future.set_result(parser(values))
+            else:
+                future.set_result(self.format_value(values[0]))
+        except (ValueError, TypeError, struct.error) as err:
+            future.set_exception(err)
+
+    @staticmethod
+    def format_value(value):
+        # Matches the way the arduino prints a value in text mode
+        if isinstance(value, float):
+            return '{:.2f}'.format(value)
+        return str(value)
+
+    @staticmethod
+    def _resolved(value=None):
+        # Helper that returns an already completed Future, used when a request
+        # is rejected before it gets sent.
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def start_status_stream(self, period_ms=Global.ARDUINO_STATUS_PERIOD_MS):
+        # Asks the arduino to push a status frame every period_ms milliseconds
+        self.status_period_ms = int(period_ms)
+        self.send_serial('<m,u,r,{}>'.format(self.status_period_ms))
+
+    def stop_status_stream(self):
+        self.status_period_ms = 0
+        self.send_serial('<m,h>')
+
+    def status_is_fresh(self, max_age=None):
+        # True if the pushed status is recent enough to use instead of a query.
+        # By default a status is stale once two frames have been missed.
+        if self.status is None or self.status_period_ms <= 0:
+            return False
+        if max_age is None:
+            max_age = 3 * self.status_period_ms / 1000
+        return self.status.age() <= max_age
 
     def update_laser_param(self, command_param, value='null'):
         try:
@@ -79,13 +500,19 @@ class LaserBrainArduino(QObject):
         except KeyError:
             print('Invalid laser parameter supplied:', command_param)
 
-    def query_laser_parameters(self, query_param):
+    def query_laser_parameters_async(self, query_param):
         try:
             query_param = self.valid_laser_queries[query_param]
-            self.send_serial('<l,q,{}>'.format(query_param))
-            return self.return_serial()
+            return self.request('<l,q,{}>'.format(query_param), value_format=self.query_formats[query_param])
         except KeyError:
             print('Invalid laser parameter to query:', query_param)
+            return self._resolved()
+
+    def query_laser_parameters(self, query_param):
+        return self.wait_reply(self.query_laser_parameters_async(query_param))
+
+    async def aquery_laser_parameters(self, query_param):
+        return await asyncio.wrap_future(self.query_laser_parameters_async(query_param))
 
     def halt_laser(self):
         self.send_serial('<l,h>')
@@ -98,14 +525,74 @@ class LaserBrainArduino(QObject):
         except KeyError:
             print('Invalid motor or parameter to update: motor={}, query={}'.format(motor, command_param))
 
-    def query_motor_parameters(self, motor: str, query_param: str):
+    def query_motor_parameters_async(self, motor: str, query_param: str):
         try:
             motor = self.valid_motors[motor]
             query_param = self.valid_motor_queries[query_param]
-            self.send_serial('<{},q,{}>'.format(motor, query_param))
-            return self.return_serial()
+            return self.request('<{},q,{}>'.format(motor, query_param), value_format=self.query_formats[query_param])
         except KeyError:
             print('Invalid motor or parameter to query: motor={}, query={}'.format(motor, query_param))
+            return self._resolved()
+
+    def query_motor_parameters(self, motor: str, query_param: str):
+        return self.wait_reply(self.query_motor_parameters_async(motor, query_param))
+
+    async def aquery_motor_parameters(self, motor: str, query_param: str):
+        return await asyncio.wrap_future(self.query_motor_parameters_async(motor, query_param))
+
+    def query_many_async(self, fields):
+        # Reads several motor and laser parameters in a single serial round trip.
+        # fields is a list of (axis, parameter) pairs, e.g. [('substrate', 'position'),
+        # ('carousel', 'max speed'), ('laser', 'pulses')]. The Future resolves to a
+        # dict keyed by the pairs as they were passed in.
+        fields = list(fields)
+        codes = []
+        for axis, query_param in fields:
+            try:
+                if axis in self.valid_motors:
+                    codes.append(self.valid_motors[axis] + self.valid_motor_queries[query_param])
+                elif self.valid_axes[axis] == 'l':
+                    codes.append('l' + self.valid_laser_queries[query_param])
+                else:
+                    raise KeyError(axis)
+            except KeyError:
+                print('Invalid axis or parameter in batched query: axis={}, query={}'.format(axis, query_param))
+                return self._resolved()
+
+        command = '<b,{}>'.format(','.join(codes))
+        if len(command) - 2 >= self.command_buffer_size:
+            print('Too many parameters for one batched query ({}), command not sent'.format(len(fields)))
+            return self._resolved()
+
+        def parse_batch(reply):
+            if isinstance(reply, tuple):
+                # Binary reply, already unpacked
+                values = reply
+            else:
+                if not (reply.startswith('{') and reply.endswith('}')):
+                    raise ValueError('Malformed batched query reply: {}'.format(reply))
+                values = [self.parse_value(value) for value in reply[1:-1].split(',')]
+            if len(values) != len(fields):
+                raise ValueError('Batched query reply has {} values, expected {}'.format(len(values), len(fields)))
+            return dict(zip(fields, values))
+
+        value_format = ''.join(self.query_formats[code[1]] for code in codes)
+        return self.request(command, parse_batch, value_format)
+
+    def query_many(self, fields):
+        return self.wait_reply(self.query_many_async(fields))
+
+    async def aquery_many(self, fields):
+        return await asyncio.wrap_future(self.query_many_async(fields))
+
+    @staticmethod
+    def parse_value(value: str):
+        # Arduino prints longs as plain integers and floats with a decimal point
+        if value == '':
+            return None
+        if '.' in value:
+            return float(value)
+        return int(value)
 
     def halt_motor(self, motor: str):
         try:
@@ -124,14 +611,17 @@ class LaserBrainArduino(QObject):
         except KeyError:
             print('Invalid pin or pin status supplied: pin={}, pin status={}'.format(pin_number, status))
 
-    def read_pin_status(self, pin_number):
+    def read_pin_status_async(self, pin_number):
         try:
             if type(pin_number) != int:
                 pin_number = self.valid_pin_numbers[pin_number]
-            self.send_serial('<i,{}>'.format(pin_number))
-            return self.return_serial()
+            return self.request('<i,{}>'.format(pin_number))
         except KeyError:
             print('Invalid pin number supplied: {}'.format(pin_number))
+            return self._resolved()
+
+    def read_pin_status(self, pin_number):
+        return self.wait_reply(self.read_pin_status_async(pin_number))
 
     def serial_forward(self, message: str):
         print('Serial forward not currently implemented')
@@ -139,6 +629,4 @@ class LaserBrainArduino(QObject):
 
     def read_serial_forward(self):
         print('Serial forward not currently implemented')
-        # self.send_serial('<r>')
-        # sleep(self.serial_read_delay)
-        # return self.return_serial()
+        # return self.wait_reply(self.request('<r>'))
@@ -1,7 +1,7 @@
 import sys
 
 from PyQt5 import uic
-from PyQt5.QtCore import QTimer, QObject, QRegExp, QThread, pyqtSignal
+from PyQt5.QtCore import QTimer, QObject, QRegExp, pyqtSignal
 from PyQt5.QtGui import QFont, QIntValidator, QDoubleValidator, QStandardItem, QStandardItemModel
 from PyQt5.QtWidgets import (QCheckBox, QFileDialog, QLabel, QLineEdit, QVBoxLayout,
                              QWidget, QMessageBox, QFormLayout, QFrame, QPushButton, QListView, QListWidgetItem,
@@ -10,10 +10,18 @@ import os
 import xml.etree.ElementTree as ET
 from RPi_Hardware import RPiHardware
 from Laser_Hardware import CompexLaser
+from Deposition_Plan import DepositionPlan, DepositionPlanError, compile_deposition
+from Deposition_Scheduler import schedule_deposition
+from Deposition_Estimator import DepositionEstimator
+import Deposition_Journal as Journal
+from Deposition_Journal import DepositionJournal, JournalState
+from Thickness_Control import ThicknessPredictor
+import Global_Values as Global
+from time import monotonic
 from math import trunc
+from datetime import timedelta
 
 
-# ToDo: Write validators for steps
 class DepStepItem(QListWidgetItem):
 
     def __init__(self, *__args, copy_idx=None):
@@ -33,7 +41,8 @@ class DepStepItem(QListWidgetItem):
                 'reprate': 5,
                 'time_on_step': 20,
                 'delay': 0,
-                'man_action': ''
+                'man_action': '',
+                'thickness': 0
             }
 
     def get_params(self):
@@ -56,7 +65,9 @@ class DepStepItem(QListWidgetItem):
             'reprate': xml.find('./reprate').text,
             'time_on_step': xml.find('./time_on_step').text,
             'delay': xml.find('./delay').text,
-            'man_action': xml.find('./man_action')
+            'man_action': xml.find('./man_action'),
+            # Not in depositions saved before thickness terminated steps
+            'thickness': xml.findtext('./thickness', default='0')
         }
 
     def set_step_index(self, step_index):
@@ -126,10 +137,8 @@ class DepControlBox(QWidget):
         self.list_view.setSelectionMode(QListView.ExtendedSelection)
         # FIXME: Build in the ability to load from an xml
 
-        # Create a thread to use for running depositions and move the deposition worker to it.
-        self.deposition_thread = QThread()
+        # The deposition worker is event driven so it lives on the GUI thread alongside the hardware signals
         self.dep_worker_obj = DepositionWorker(laser, brain)
-        self.dep_worker_obj.moveToThread(self.deposition_thread)
 
         self.init_connections()
 
@@ -142,12 +151,17 @@ class DepControlBox(QWidget):
         self.list_view.currentItemChanged.connect(self.on_item_change)
         QApplication.instance().instrument_settings.settings_applied.connect(self.update_target_roster)
 
-        # Cross thread communications
+        # Deposition worker communications
         self.btns['run_dep'].clicked.connect(self.run_deposition)
-        self.dep_worker_obj.deposition_interrupted.connect(self.deposition_thread.quit)
-        self.dep_worker_obj.deposition_finished.connect(self.deposition_thread.quit)
+        self.dep_worker_obj.deposition_interrupted.connect(self.on_deposition_ended)
+        self.dep_worker_obj.deposition_finished.connect(self.on_deposition_ended)
+        self.dep_worker_obj.manual_action_required.connect(self.prompt_manual_action)
         self.stop_deposition.connect(self.dep_worker_obj.halt_dep)
-        self.deposition_thread.started.connect(self.dep_worker_obj.start_deposition)
+
+        # Keep the estimated run time next to the run button current as the deposition is edited
+        self.deposition_changed.connect(self.update_time_estimate)
+        for name in ('tts_distance', 'num_pulses', 'reprate', 'delay'):
+            self.lines[name].editingFinished.connect(self.on_step_edited)
 
     def on_item_change(self, current, previous):
         updated = False
@@ -165,6 +179,32 @@ class DepControlBox(QWidget):
         if updated:
             self.deposition_changed.emit()
 
+    def on_step_edited(self):
+        if self.list_view.currentItem() is not None:
+            self.commit_changes(self.list_view.currentItem())
+            self.deposition_changed.emit()
+
+    def update_time_estimate(self):
+        # Shows how long the deposition in the editor will take, starting from where the motors are now if the
+        # arduino's status is current. Manual actions aren't counted.
+        settings = QApplication.instance().instrument_settings.pld_settings
+        try:
+            plan = compile_deposition((self.list_view.item(index).get_params()
+                                       for index in range(self.list_view.count())), pld_settings=settings)
+        except DepositionPlanError:
+            self.labels['total_time'].setText('Estimated time: --')
+            return
+        brain = self.dep_worker_obj.brain
+        start_target, start_tts = None, None
+        if brain.arduino.status_is_fresh():
+            start_target = brain.target_from_position(brain.arduino.status.target_position)
+            start_tts = brain.arduino.status.sub_position / Global.SUB_STEPS_PER_MM + Global.SUB_D0
+        estimator = DepositionEstimator.from_settings(settings, laser_start_delay_msec=brain.laser_start_delay_msec,
+                                                      arm_during_move=self.dep_worker_obj.laser.trigger_src == 'EXT')
+        total = estimator.estimate_plan(plan, start_target=start_target, start_tts=start_tts).sum()
+        manual = ' + manual actions' if any(step.man_action for step in plan) else ''
+        self.labels['total_time'].setText('Estimated time: {}{}'.format(timedelta(seconds=round(total)), manual))
+
     def update_step_indices(self):
         for index in range(0, self.list_view.count()):
             self.list_view.item(index).set_step_index(index)
@@ -190,6 +230,7 @@ class DepControlBox(QWidget):
         self.lines['reprate'].setText(ret_params['reprate'])
         self.lines['delay'].setText(ret_params['delay'])
         self.lines['man_action'].setText(ret_params['man_action'])
+        self.lines['thickness'].setText(ret_params.get('thickness', '0'))
 
     def commit_changes(self, item):
         try:
@@ -203,7 +244,8 @@ class DepControlBox(QWidget):
                 'reprate': self.lines['reprate'].text(),
                 'time_on_step': str(int(self.lines['num_pulses'].text()) / int(self.lines['reprate'].text())),
                 'delay': self.lines['delay'].text(),
-                'man_action': self.lines['man_action'].text()
+                'man_action': self.lines['man_action'].text(),
+                'thickness': self.lines['thickness'].text()
             }
 
             item.set_params(step_params)
@@ -220,21 +262,25 @@ class DepControlBox(QWidget):
     def add_deposition_step(self):
         self.list_view.addItem(DepStepItem('New Step {}'.format(self.list_view.count() + 1), copy_idx=None))
         self.update_step_indices()
+        self.deposition_changed.emit()
 
     def copy_deposition_step(self):
         for item in self.list_view.selectedItems():
             self.list_view.addItem(DepStepItem(item.text(), copy_idx=item.get_params()['step_index']))
         self.update_step_indices()
+        self.deposition_changed.emit()
 
     def delete_selected_steps(self):
         for item in self.list_view.selectedItems():
             # Convoluted way to get the index from the selected item and then remove it, only way that seems to work
             self.list_view.takeItem(self.list_view.indexFromItem(item).row())
         self.update_step_indices()
+        self.deposition_changed.emit()
 
     def clear_deposition(self):
         self.list_view.clear()
         self.update_step_indices()
+        self.update_time_estimate()
 
     def update_time_on_step(self):
         self.commit_changes(self.list_view.currentItem())
@@ -248,6 +294,14 @@ class DepControlBox(QWidget):
 
         return dep_xml_root
 
+    def get_dep_plan(self):
+        # Compiles the steps straight from the list items, raises DepositionPlanError if any step is invalid
+        if self.list_view.currentItem() is not None:
+            self.commit_changes(self.list_view.currentItem())
+        self.update_step_indices()
+        return compile_deposition((self.list_view.item(index).get_params() for index in range(self.list_view.count())),
+                                  pld_settings=QApplication.instance().instrument_settings.pld_settings)
+
     def load_xml_dep(self, xml: ET.Element):
         steps = xml.findall('./step')
         # Make sure that the list of steps is sorted by index before import
@@ -256,29 +310,84 @@ class DepControlBox(QWidget):
             temp = DepStepItem('New Step {}'.format(self.list_view.count() + 1), copy_idx=None)
             temp.set_params_from_xml(step)
             self.list_view.addItem(temp)
+        self.update_time_estimate()
 
     def run_deposition(self):
-        # FIXME: THIS IS BROKEN, NEED TO FIX check state logic.
-        # If the button has not been activated, check it then start the deposition
-        if not self.btns['run_dep'].isChecked():
-            self.btns['run_dep'].setChecked(True)
-            self.btns['run_dep'].setText('Stop Deposition')
-            # Get a list of steps and then sort it by index
-
-            self.deposition_thread.start()
-        # If the button is checked, uncheck and send the stop signal
-        elif self.btns['run_dep'].isChecked():
-            self.btns['run_dep'].setChecked(False)
-            self.btns['run_dep'].setText('Run Current Deposition')
+        # The button toggles between starting the current deposition and stopping a running one
+        if self.dep_worker_obj.is_running():
             self.stop_deposition.emit()
+            return
 
-        ET.dump(self.get_dep_xml())
+        # Offer to pick up the last run if it didn't finish (aborted, or the program stopped part way through)
+        unfinished = Journal.latest_unfinished_journal()
+        if unfinished is not None:
+            resume = QMessageBox.warning(self, 'Previous Deposition Aborted...',
+                                         'The previous deposition was aborted on step {} after {} pulses, would you '
+                                         'like to resume? Press yes to resume, no to start the current deposition '
+                                         'from the beginning, and cancel to take no action.'.format(
+                                             unfinished.resume_index, unfinished.pulses_done),
+                                         QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel,
+                                         QMessageBox.No)
+            if resume == QMessageBox.Yes:
+                try:
+                    self.dep_worker_obj.check_plan(unfinished.plan.from_index(unfinished.resume_index))
+                except DepositionPlanError as err:
+                    QMessageBox.warning(self, 'Invalid Deposition', str(err), QMessageBox.Ok, QMessageBox.Ok)
+                    self.btns['run_dep'].setChecked(False)
+                    return
+                self.btns['run_dep'].setChecked(True)
+                self.btns['run_dep'].setText('Stop Deposition')
+                self.dep_worker_obj.resume_from_journal(unfinished)
+                return
+            elif resume == QMessageBox.Cancel:
+                self.btns['run_dep'].setChecked(False)
+                return
+
+        try:
+            plan = self.get_dep_plan()
+            self.dep_worker_obj.check_plan(plan)
+        except DepositionPlanError as err:
+            QMessageBox.warning(self, 'Invalid Deposition', str(err), QMessageBox.Ok, QMessageBox.Ok)
+            self.btns['run_dep'].setChecked(False)
+            return
+
+        self.btns['run_dep'].setChecked(True)
+        self.btns['run_dep'].setText('Stop Deposition')
+        self.dep_worker_obj.start_deposition(plan)
+
+    def prompt_manual_action(self, man_action: str):
+        manual_action = QMessageBox.warning(self, 'Manual action required...',
+                                            'The previous step was flagged as needing manual action. '
+                                            'Please {} before continuing.'.format(man_action),
+                                            QMessageBox.Ok | QMessageBox.Abort,
+                                            QMessageBox.Ok)
+        self.dep_worker_obj.manual_action_done(manual_action == QMessageBox.Ok)
+
+    def on_deposition_ended(self):
+        self.btns['run_dep'].setChecked(False)
+        self.btns['run_dep'].setText('Run Current Deposition')
 
 
-# ToDo: Write run deposition for real
 class DepositionWorker(QObject):
+    # Runs a deposition as a state machine on the GUI thread. Each stage is
+    # started from the slot that handles the end of the previous one (motion
+    # finished, laser finished, a timer or the user answering a manual action
+    # prompt), so nothing blocks or polls while waiting on the hardware. Where
+    # the schedule allows (see Deposition_Scheduler) the laser start delay and
+    # the next step's moves are overlapped with other waits. Every stage is
+    # written to a DepositionJournal so an interrupted run can be resumed from
+    # the exact pulse (see resume_from_journal).
     deposition_interrupted = pyqtSignal()
     deposition_finished = pyqtSignal()
+    step_started = pyqtSignal(int)
+    manual_action_required = pyqtSignal(str)
+
+    # States
+    IDLE = 'idle'
+    MOVING = 'moving'
+    PULSING = 'pulsing'
+    MANUAL = 'manual'
+    DELAY = 'delay'
 
     def __init__(self, laser: CompexLaser, brain: RPiHardware):
         super().__init__()
@@ -286,109 +395,350 @@ class DepositionWorker(QObject):
         self.laser = laser
         self.brain = brain
 
+        self.state = self.IDLE
         self.stop = False
         self.prev_tts = None
         self.prev_target = None
         self.curr_step_idx = None
         self.steps = None
+        self.schedule = None
+        self.step_pos = 0
+        self.motion_pending = False  # A move has been sent and motion_finished hasn't arrived yet
+        self.premove_during_manual = True  # Allow moving to the next step while a manual action prompt is up
+        self.journal = None
+        self.pulse_offset = 0  # Pulses of the current step delivered before the current pulse goal (resuming)
+        self.pulse_goal = 0  # Pulses asked for in the current goal
+        self.last_journal_pulses = 0.  # monotonic() time of the last pulse count written to the journal
+        self.predictor = None  # ThicknessPredictor while a thickness terminated step is pulsing
+        self.thickness_start = None  # SQM thickness reading the current thickness step started from
+        self.pending_reading = None  # SQM reading waiting on a status frame taken no earlier than it
+        self.goal_finished_at = None  # monotonic() time a thickness step's goal finished, until it is checked
+
+        self.timer_delay = QTimer()
+        self.timer_delay.setSingleShot(True)
+        self.timer_thickness_wait = QTimer()
+        self.timer_thickness_wait.setSingleShot(True)
 
         self.init_connections()
 
     def init_connections(self):
-        pass
+        self.brain.motion_finished.connect(self.on_motion_finished)
+        self.brain.laser_finished.connect(self.on_laser_finished)
+        self.timer_delay.timeout.connect(self.next_step)
+        self.timer_thickness_wait.timeout.connect(self.check_thickness_reached)
+        self.brain.arduino.status_updated.connect(self.on_arduino_status)
+        if self.brain.sqm is not None:
+            self.brain.sqm.reading_updated.connect(self.on_sqm_reading)
+
+    def is_running(self):
+        return self.state != self.IDLE
+
+    def check_plan(self, plan: DepositionPlan):
+        # Raises DepositionPlanError if the hardware can't run plan, checked before anything moves
+        thickness_steps = [step.index for step in plan if step.is_thickness_step()]
+        if thickness_steps and (self.brain.sqm is None or self.laser.trigger_src != 'EXT'):
+            raise DepositionPlanError('Steps {} are thickness terminated, which needs thickness readings from the '
+                                      'SQM-160 and external triggering.'.format(thickness_steps))
+
+    def start_deposition(self, plan: DepositionPlan, start_index=0, pulses_done=0, journal=None,
+                         thickness_start=None):
+        # Runs a compiled plan (see Deposition_Plan.compile_deposition), steps with an index below start_index are
+        # skipped and pulses_done of the first step's pulses are treated as already delivered (used to resume an
+        # interrupted deposition, along with the SQM reading a resumed thickness step started from). A new journal
+        # is started unless one is passed in.
+        self.steps = plan.from_index(start_index)
+        self.pulse_offset = pulses_done
+        self.thickness_start = thickness_start
+        if journal is None:
+            self.journal = DepositionJournal.create(self.steps)
+        else:
+            self.journal = journal
+            self.journal.record(Journal.RUN_RESUMED, index=start_index, pulses_done=pulses_done)
+        # Telemetry for the run is logged alongside the journal, under the same name
+        self.brain.pulse_logger.start(os.path.splitext(os.path.basename(self.journal.path))[0])
+        self.schedule = schedule_deposition(self.steps, external_trigger=self.laser.trigger_src == 'EXT',
+                                            premove_during_manual=self.premove_during_manual)
+        self.step_pos = 0
+        self.stop = False
+        self.motion_pending = False
+        # Always move to the first step's positions
+        self.prev_target = None
+        self.prev_tts = None
+        self.start_step()
+
+    def start_step(self):
+        if self.step_pos >= len(self.steps):
+            self.state = self.IDLE
+            self.curr_step_idx = None
+            self.close_journal(Journal.RUN_FINISHED)
+            self.deposition_finished.emit()
+            return
 
-    def start_deposition(self):
-        xml = self.parentWidget().get_dep_xml()
-        deposition = xml.getroot()
-        steps = deposition.findall('./step')
-        steps.sort(key=lambda x: x.get('step_index'), reverse=False)
+        step = self.steps[self.step_pos]
+        self.curr_step_idx = step.index
+        self.journal.record(Journal.STEP_STARTED, index=step.index)
+        self.brain.pulse_logger.set_step(step.index)
+        self.step_started.emit(self.curr_step_idx)
 
-        self.steps = steps
-        if self.curr_step_idx is not None:
-            resume = QMessageBox.warning(self, 'Previous Deposition Aborted...',
-                                         'The previous deposition was aborted, would you like to resume? Press yes '
-                                         'to resume, no to restart from the beginning, and cancel to '
-                                         'take no action.',
-                                         QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel,
-                                         QMessageBox.No)
-            if resume == QMessageBox.Yes:
-                steps = [x for x in steps if int(x.get('step_index')) >= self.curr_step_idx]
-                pass
-            elif resume == QMessageBox.No:
-                self.curr_step_idx = None
-                self.start_deposition(steps)
-            elif resume == QMessageBox.Cancel:
-                return
+        # Move the target carousel and substrate if necessary, they may already be on their way if the moves
+        # were sent during the previous step's manual action.
+        self.move_to_step(step)
+        if self.schedule[self.step_pos].arm_during_move:
+            self.brain.arm_laser()
 
-        for step in steps:
-            self.curr_step_idx = step.get('step_index')
-
-            # Move the target carousel
-            if self.prev_target != step.find('./target').text:
-                self.brain.move_to_target(int(step.find('./target').text))
-            self.prev_target = step.find('./target').text
-
-            # Move the Substrate if necessary
-            if self.prev_tts != step.find('./tts_distance'):
-                # ToDo: Find a way to convert stepper steps to z translation
-                sub_position = int(step.find('./tts_distance'))
-                self.brain.sub_position(sub_position)
-
-            # Check that the sub and target positions are achieved. block until it is done
-            count = 0
-            while (self.brain.targets_running() or self.brain.substrate_running()) and not self.stop:
-                count += 1
-                # Make sure that the stop signal gets read before the motors come to completion.
-                QApplication.processEvents()
-                if count % 2 == 0:
-                    print('Waiting for motors to finish movement')
-
-            # If stop has been sent, halt all and emit interrupted signal
-            if self.stop:
-                self.abort_all()
-                break
-
-            # Start rastering target, if necessary. Abort if brain and step have mismatched targets
-            if bool(step.find('./raster')) and self.brain.current_target == int(step.find('./target')):
-                self.brain.raster_current_target()
-            elif self.brain.current_target != int(step.find('./target')):
-                print('Target setting error')
-                self.stop = True
+        if self.motion_pending:
+            self.state = self.MOVING  # Continues in on_motion_finished
+        else:
+            self.start_pulsing()
+
+    def move_to_step(self, step):
+        if self.prev_target != step.target:
+            self.brain.move_carousel_to_position(step.carousel_goal)
+            self.motion_pending = True
+        if self.prev_tts != step.tts_distance:
+            self.brain.move_sub_to_position(step.sub_goal)
+            self.motion_pending = True
+        self.prev_target = step.target
+        self.prev_tts = step.tts_distance
+
+    def on_motion_finished(self):
+        self.motion_pending = False
+        if self.state != self.MOVING or self.stop:
+            return
+        self.journal.record(Journal.MOTION_DONE, index=self.curr_step_idx)
+        self.start_pulsing()
+
+    def start_pulsing(self):
+        step = self.steps[self.step_pos]
+
+        # Abort if brain and step have mismatched targets
+        if self.brain.current_target() != step.target:
+            print('Target setting error')
+            self.abort_all()
+            return
+        self.state = self.PULSING  # Continues in on_laser_finished
+        self.pulse_goal = step.num_pulses - self.pulse_offset
+        if self.pulse_goal <= 0:
+            # Resumed after the pulses were all delivered
+            self.on_laser_finished()
+            return
+        thickness_fields = {}
+        if step.is_thickness_step():
+            # Fires up to the step's pulses, the goal is brought in as the thickness readings come in
+            # (see on_sqm_reading)
+            if self.brain.sqm is None or self.brain.sqm.reading is None or self.laser.trigger_src != 'EXT':
+                print('Step {} is thickness terminated, which needs thickness readings from the SQM-160 and '
+                      'external triggering.'.format(step.index))
                 self.abort_all()
+                return
+            if self.thickness_start is None:
+                self.thickness_start = self.brain.sqm.reading.thickness
+            self.predictor = ThicknessPredictor()
+            thickness_fields = {'thickness_start': self.thickness_start, 'thickness': step.thickness}
+        if step.raster_steps:
+            self.brain.raster_target(step.raster_steps)
+
+        self.journal.record(Journal.PULSING_STARTED, index=step.index, goal=self.pulse_goal, offset=self.pulse_offset,
+                            **thickness_fields)
+        self.last_journal_pulses = monotonic()
+        self.brain.set_reprate(step.reprate)
+        self.brain.start_laser(num_pulses=self.pulse_goal)
+
+    def on_arduino_status(self, status):
+        # Pairs a waiting SQM reading with the first frame taken after it, and keeps the journal's pulse count
+        # current while pulsing
+        if self.pending_reading is not None and status.timestamp >= self.pending_reading.timestamp:
+            reading, self.pending_reading = self.pending_reading, None
+            self.trim_thickness_goal(reading, status)
+        if self.state != self.PULSING or monotonic() - self.last_journal_pulses < Global.DEPOSITION_JOURNAL_INTERVAL:
+            return
+        self.last_journal_pulses = monotonic()
+        if self.laser.trigger_src == 'EXT' and self.brain.laser_goal is not None:
+            self.journal.record(Journal.PULSES, index=self.curr_step_idx,
+                                delivered=self.pulse_offset + status.laser_pulses)
 
-            # Start pulsing
-            self.brain.start_pulsing(step.find('./reprate').text, step.find('./num_pulses'))
+    def on_sqm_reading(self, reading):
+        if self.state != self.PULSING or self.predictor is None:
+            return
+        if self.goal_finished_at is not None:
+            # The goal has finished, the first reading taken after that decides if the step is done
+            if reading.timestamp >= self.goal_finished_at:
+                self.check_thickness_reached(reading)
+            return
+        status = self.brain.arduino.status
+        if status is not None and status.timestamp >= reading.timestamp:
+            self.trim_thickness_goal(reading, status)
+        else:
+            # The pulse count has to include every pulse the reading saw, wait for the next frame
+            self.pending_reading = reading
+
+    def trim_thickness_goal(self, reading, status):
+        # Predicts the pulse a thickness terminated step will reach its thickness on and moves the arduino's goal
+        # there, well before it is reached, so the arduino stops on that pulse without waiting on the next reading.
+        # status must have been taken no earlier than the reading, so its count covers what the reading measured.
+        if self.state != self.PULSING or self.predictor is None or self.goal_finished_at is not None or \
+                self.brain.laser_goal is None or not self.brain.arduino.status_is_fresh() or \
+                reading.age() > Global.THICKNESS_MAX_READING_AGE:
+            return
+        step = self.steps[self.step_pos]
+        pulses = status.laser_pulses  # Counted from the start of the current goal
+        if pulses == 0 and not self.predictor.points and self.pulse_offset == 0:
+            # Still in the laser start delay, take the most settled reading as the starting thickness
+            self.thickness_start = reading.thickness
+            return
+        grown = reading.thickness - self.thickness_start
+        self.predictor.add(self.pulse_offset + pulses, grown)
+        if grown >= step.thickness:
+            goal = pulses  # Stop now
+        else:
+            predicted = self.predictor.pulses_for(step.thickness)
+            if predicted is None:
+                return
+            goal = predicted - self.pulse_offset
+        goal = max(0, min(goal, step.num_pulses - self.pulse_offset))
+        if goal != self.brain.laser_goal:
+            self.brain.update_laser_goal(goal)
+            self.journal.record(Journal.GOAL_CHANGED, index=step.index, goal=goal)
+
+    def delivered_pulses(self):
+        # Pulses of the current step delivered so far, from the arduino's pulse counter. With internal triggering
+        # the arduino doesn't count, so the goal is assumed to have been met.
+        if self.laser.trigger_src != 'EXT':
+            return self.pulse_offset + self.pulse_goal
+        if self.brain.arduino.status_is_fresh():
+            pulses = self.brain.arduino.status.laser_pulses
+        else:
+            pulses = self.brain.arduino.query_laser_parameters('pulses')
+        return None if pulses is None else self.pulse_offset + int(pulses)
 
-            # Block until laser is finished
-            while self.brain.laser_running() and not self.stop:
-                count += 1
-                # Make sure that the stop signal gets read before the motors come to completion.
-                QApplication.processEvents()
-                if count % 10 == 0:
-                    print('Laser pulses under way')
+    def on_laser_finished(self):
+        if self.state != self.PULSING or self.stop:
+            return
+        if self.predictor is not None:
+            # The goal is only a prediction, wait for a reading taken after the laser stopped to see if the
+            # thickness was reached (see check_thickness_reached)
+            self.pending_reading = None
+            self.goal_finished_at = monotonic()
+            self.timer_thickness_wait.start(int(Global.THICKNESS_FINISH_WAIT * 1000))
+            return
+        self.finish_pulsing()
 
-            # If stop has been sent, halt all and emit interrupted signal
-            if self.stop:
-                self.abort_all()
-                break
-
-            # If there is a manual action item, pop up a box for the user
-            if step.find('./man_action').text != '':
-                manual_action = QMessageBox.warning(self, 'Manual action required...',
-                                                    'The previous step was flagged as needing manual action. '
-                                                    'Please {} before continuing.',
-                                                    QMessageBox.Ok | QMessageBox.Abort,
-                                                    QMessageBox.Ok)
-                if manual_action == QMessageBox.Ok:
-                    pass
-                elif manual_action == QMessageBox.Abort:
-                    self.stop = True
+    def check_thickness_reached(self, reading=None):
+        # Ends a thickness terminated step whose goal has finished, unless it is still short of its thickness and
+        # below its pulse cap, then the goal is extended to the predicted pulse (at least one more) and the laser
+        # carries on. Without a new reading in time the latest one is used.
+        if self.state != self.PULSING or self.goal_finished_at is None:
+            return
+        self.goal_finished_at = None
+        self.timer_thickness_wait.stop()
+        step = self.steps[self.step_pos]
+        if reading is None:
+            reading = self.brain.sqm.reading
+        delivered = self.delivered_pulses()
+        if reading is not None and delivered is not None and delivered < step.num_pulses:
+            grown = reading.thickness - self.thickness_start
+            if grown < step.thickness:
+                self.predictor.add(delivered, grown)
+                predicted = self.predictor.pulses_for(step.thickness)
+                total = min(max(delivered + 1, predicted or 0), step.num_pulses)
+                print('Step {} is {:.4f} kA short of its thickness after {} pulses, continuing to {} pulses'.format(
+                    step.index, step.thickness - grown, delivered, total))
+                self.brain.extend_laser_goal(total - self.pulse_offset)
+                self.journal.record(Journal.GOAL_CHANGED, index=step.index, goal=total - self.pulse_offset)
+                return
+        self.finish_pulsing()
+
+    def finish_pulsing(self):
+        step = self.steps[self.step_pos]
+        if self.pulse_goal > 0:
+            # Actual against planned pulses, and for thickness steps the thickness grown against the target
+            result_fields = {}
+            if self.predictor is not None and self.brain.sqm.reading is not None:
+                result_fields = {'thickness_grown': self.brain.sqm.reading.thickness - self.thickness_start,
+                                 'thickness': step.thickness}
+            self.journal.record(Journal.PULSES, index=step.index, delivered=self.delivered_pulses(),
+                                planned=step.num_pulses, **result_fields)
+        self.predictor = None
+        if step.raster_steps:
+            self.brain.raster_target(0)
+        if not self.schedule[self.step_pos].keep_laser_on:
+            self.brain.stop_laser()
+
+        # If there is a manual action item, ask the user through the control box and wait for the answer
+        if step.man_action:
+            self.state = self.MANUAL
+            if self.schedule[self.step_pos].premove_during_manual:
+                self.move_to_step(self.steps[self.step_pos + 1])
+            self.manual_action_required.emit(step.man_action)
+        else:
+            self.end_step()
+
+    def manual_action_done(self, proceed: bool):
+        # Called with the user's answer to manual_action_required
+        if self.state != self.MANUAL:
+            return
+        if proceed:
+            self.end_step()
+        else:
+            self.halt_dep()
+
+    def end_step(self):
+        # Wait out the step's delay (seconds) before moving on
+        self.state = self.DELAY
+        self.timer_delay.start(int(self.steps[self.step_pos].delay * 1000))
+
+    def next_step(self):
+        if self.state != self.DELAY or self.stop:
+            return
+        self.journal.record(Journal.STEP_FINISHED, index=self.curr_step_idx)
+        self.pulse_offset = 0
+        self.thickness_start = None
+        self.step_pos += 1
+        self.start_step()
 
     def abort_all(self):
-        self.brain.halt_sub()
-        self.brain.halt_target()
-        self.brain.stop_pulsing()
+        pulsing = self.state == self.PULSING
+        self.predictor = None
+        self.pending_reading = None
+        self.goal_finished_at = None
+        self.timer_thickness_wait.stop()
+        self.stop = True
+        self.state = self.IDLE
+        self.motion_pending = False
+        self.timer_delay.stop()
+        self.brain.arduino.halt_motor('substrate')
+        self.brain.arduino.halt_motor('carousel')
+        self.brain.stop_laser()
+        # Record how far the step got once the laser has been stopped
+        delivered = self.delivered_pulses() if pulsing else None
+        self.close_journal(Journal.RUN_ABORTED, index=self.curr_step_idx, delivered=delivered)
         self.deposition_interrupted.emit()
 
+    def close_journal(self, event, **fields):
+        self.brain.pulse_logger.set_step(None)
+        self.brain.pulse_logger.stop()
+        if self.journal is not None:
+            self.journal.record(event, **fields)
+            self.journal.close()
+            self.journal = None
+
+    def resume_from_journal(self, state: JournalState):
+        # Continues the run recorded in state. If the arduino still holds the pulse goal the run was on (it
+        # wasn't reset since), its counter gives the exact number of pulses delivered.
+        pulses_done = state.pulses_done
+        if state.goal is not None and self.laser.trigger_src == 'EXT':
+            # Read before halting, stopping the laser moves the firmware's goal
+            goal = self.brain.arduino.query_laser_parameters('goal pulses')
+            pulses = self.brain.arduino.query_laser_parameters('pulses')
+            self.brain.stop_laser()
+            try:
+                if int(goal) == state.goal:
+                    pulses_done = max(pulses_done, state.goal_offset + int(pulses))
+            except (TypeError, ValueError):
+                print('Could not read the pulse count back from the arduino, resuming from the journal count.')
+        self.start_deposition(state.plan, start_index=state.resume_index, pulses_done=pulses_done,
+                              journal=DepositionJournal(state.path), thickness_start=state.thickness_start)
+
     def halt_dep(self):
-        self.stop = True
+        if self.is_running():
+            self.abort_all()
@@ -0,0 +1,109 @@
+import numpy as np
+import Global_Values as Global
+from RPi_Hardware import RPiHardware
+from Deposition_Plan import DepositionPlan
+from Deposition_Scheduler import schedule_deposition
+
+
+class DepositionEstimator:
+    # Predicts how long a deposition will take. Moves follow the AccelStepper
+    # trapezoidal profile (accelerate at a constant rate to max speed, cruise,
+    # then decelerate), the carousel takes the shortest way round like the
+    # firmware does and both motors move at the same time. The laser start
+    # delay runs during the moves when the laser is armed early, and is skipped
+    # for steps the scheduler keeps the laser on for (see Deposition_Scheduler).
+    # Manual actions aren't included since there is no telling how long they
+    # take.
+    #
+    # Everything is done on numpy arrays so recipes can be swept in bulk: any
+    # of the step arrays passed to estimate_steps can have leading dimensions
+    # (e.g. shape (n_candidates, n_steps)) and are broadcast together.
+
+    def __init__(self, sub_max_speed, sub_acceleration, carousel_max_speed, carousel_acceleration,
+                 laser_start_delay=4.5, arm_during_move=True, max_idle_on=10.):
+        self.sub_max_speed = float(sub_max_speed)  # steps/s
+        self.sub_acceleration = float(sub_acceleration)  # steps/s^2
+        self.carousel_max_speed = float(carousel_max_speed)
+        self.carousel_acceleration = float(carousel_acceleration)
+        self.laser_start_delay = float(laser_start_delay)  # s
+        self.arm_during_move = arm_during_move
+        self.max_idle_on = max_idle_on
+
+    @classmethod
+    def from_settings(cls, pld_settings, laser_start_delay_msec=4500, **kwargs):
+        # Motor limits from the instrument settings xml (settings.xml)
+        return cls(float(pld_settings.find('./substrate/max_speed').text),
+                   float(pld_settings.find('./substrate/max_acceleration').text),
+                   float(pld_settings.find('./target/max_speed').text),
+                   float(pld_settings.find('./target/max_acceleration').text),
+                   laser_start_delay=laser_start_delay_msec / 1000, **kwargs)
+
+    @staticmethod
+    def move_time(distance, max_speed, acceleration):
+        # Seconds to move distance steps from rest to rest. Short moves never reach max speed and are a triangle.
+        distance = np.abs(np.asarray(distance, dtype=float))
+        ramp_distance = max_speed * max_speed / acceleration  # Covered while speeding up and slowing down
+        trapezoid = distance / max_speed + max_speed / acceleration
+        triangle = 2 * np.sqrt(distance / acceleration)
+        return np.where(distance >= ramp_distance, trapezoid, triangle)
+
+    @staticmethod
+    def carousel_distance(start_position, goal_position):
+        # Steps travelled going the shortest way round the carousel
+        delta = np.mod(np.asarray(goal_position) - np.asarray(start_position), Global.CAROUSEL_STEPS_PER_REV)
+        return np.minimum(delta, Global.CAROUSEL_STEPS_PER_REV - delta)
+
+    def estimate_steps(self, target, tts_distance, num_pulses, reprate, delay=0., kept_on=False, start_target=None,
+                       start_tts=None):
+        # Returns an array of per step durations (s), shaped like the broadcast inputs with steps along the last
+        # axis. kept_on flags steps that start with the laser still on from the previous one, as planned by
+        # schedule_deposition (estimate_plan works them out).
+        # start_target/start_tts are where the motors are before the first step, None means the first step
+        # doesn't need to move that motor.
+        # Scalars are a single step
+        target, tts_distance, num_pulses, reprate, delay, kept_on = np.broadcast_arrays(
+            np.atleast_1d(target), np.atleast_1d(np.asarray(tts_distance, dtype=float)),
+            np.atleast_1d(np.asarray(num_pulses, dtype=float)), np.atleast_1d(np.asarray(reprate, dtype=float)),
+            np.atleast_1d(np.asarray(delay, dtype=float)), np.atleast_1d(np.asarray(kept_on, dtype=bool)))
+
+        carousel_goal = np.mod(target, 6) * (Global.CAROUSEL_STEPS_PER_REV // 6)
+        sub_goal = ((tts_distance - Global.SUB_D0) * Global.SUB_STEPS_PER_MM).astype(int)
+
+        # Where each step starts from is where the previous one ended
+        carousel_start = np.empty_like(carousel_goal)
+        carousel_start[..., 1:] = carousel_goal[..., :-1]
+        carousel_start[..., 0] = carousel_goal[..., 0] if start_target is None else \
+            RPiHardware.carousel_position_for_target(start_target)
+        sub_start = np.empty_like(sub_goal)
+        sub_start[..., 1:] = sub_goal[..., :-1]
+        sub_start[..., 0] = sub_goal[..., 0] if start_tts is None else RPiHardware.sub_position_for_tts(start_tts)
+
+        carousel_time = self.move_time(self.carousel_distance(carousel_start, carousel_goal),
+                                       self.carousel_max_speed, self.carousel_acceleration)
+        sub_time = self.move_time(sub_goal - sub_start, self.sub_max_speed, self.sub_acceleration)
+        move_time = np.maximum(carousel_time, sub_time)
+
+        # Laser start delay, skipped when the laser is left on from the previous step and overlapped with the
+        # move when the laser is armed early.
+        start_delay = np.full(move_time.shape, self.laser_start_delay)
+        if self.arm_during_move:
+            start_delay = np.maximum(start_delay - move_time, 0.)
+        start_delay = np.where(kept_on, 0., start_delay)
+
+        return move_time + start_delay + num_pulses / reprate + delay
+
+    def estimate_plan(self, plan: DepositionPlan, start_target=None, start_tts=None):
+        # Per step durations for a compiled plan, scheduled the way DepositionWorker will run it
+        if len(plan) == 0:
+            return np.zeros(0)
+        schedule = schedule_deposition(plan, external_trigger=self.arm_during_move, max_idle_on=self.max_idle_on)
+        kept_on = [False] + [step_schedule.keep_laser_on for step_schedule in schedule[:-1]]
+        columns = np.array([(step.target, step.tts_distance, step.num_pulses, step.reprate, step.delay)
+                            for step in plan], dtype=float).T
+        return self.estimate_steps(columns[0].astype(int), *columns[1:], kept_on=kept_on,
+                                   start_target=start_target, start_tts=start_tts)
+
+    @staticmethod
+    def throughput(num_pulses, step_times):
+        # Average pulses per second of wall clock time over the steps (last axis)
+        return np.sum(num_pulses, axis=-1) / np.sum(step_times, axis=-1)
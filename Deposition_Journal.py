@@ -0,0 +1,173 @@
+import json
+import os
+from time import time, strftime
+import Global_Values as Global
+from Deposition_Plan import DepositionPlan, DepositionStep
+
+
+# Append only record of a deposition run, one json object per line. Every
+# event is flushed to disk (fdatasync) before record() returns so that after a
+# crash or power loss the journal shows how far the run got, down to the last
+# pulse count read back from the arduino. read_journal() rebuilds the run's
+# state from a journal so the deposition can be resumed where it stopped.
+
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+# Events
+RUN_STARTED = 'run_started'
+RUN_RESUMED = 'run_resumed'
+STEP_STARTED = 'step_started'
+MOTION_DONE = 'motion_done'
+PULSING_STARTED = 'pulsing_started'
+GOAL_CHANGED = 'goal_changed'
+PULSES = 'pulses'
+STEP_FINISHED = 'step_finished'
+RUN_FINISHED = 'run_finished'
+RUN_ABORTED = 'run_aborted'
+
+
+class DepositionJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    @classmethod
+    def create(cls, plan: DepositionPlan, directory=Global.DEPOSITION_JOURNAL_DIR):
+        # Starts a new journal for plan, the whole plan is written out first so the run can be rebuilt without
+        # the deposition editor.
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'deposition_{}.jsonl'.format(strftime('%Y%m%d_%H%M%S')))
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, 'deposition_{}_{}.jsonl'.format(strftime('%Y%m%d_%H%M%S'), suffix))
+            suffix += 1
+        journal = cls(path)
+        journal.record(RUN_STARTED, steps=[step_to_dict(step) for step in plan])
+        return journal
+
+    def record(self, event: str, **fields):
+        entry = {'t': time(), 'event': event}
+        entry.update(fields)
+        # A single write of a whole line with O_APPEND so a crash can only ever lose (or tear) the last line
+        os.write(self._fd, (json.dumps(entry) + '\n').encode('utf-8'))
+        _sync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class JournalState:
+    # How far a journaled run got. resume_index is the step to carry on from (None if the run finished) and
+    # pulses_done the number of that step's pulses known to have been delivered. goal and goal_offset are the
+    # last pulse goal sent to the arduino for that step and the pulses delivered before it, so the arduino's own
+    # counter can be used to get the exact count if it is still powered. thickness_start is the SQM thickness
+    # reading a thickness terminated step started from, None for other steps.
+    __slots__ = ('path', 'plan', 'finished', 'resume_index', 'pulses_done', 'goal', 'goal_offset', 'last_event',
+                 'thickness_start')
+
+    def __init__(self, path, plan, finished, resume_index, pulses_done, goal, goal_offset, last_event,
+                 thickness_start=None):
+        self.path = path
+        self.plan = plan
+        self.finished = finished
+        self.resume_index = resume_index
+        self.pulses_done = pulses_done
+        self.goal = goal
+        self.goal_offset = goal_offset
+        self.last_event = last_event
+        self.thickness_start = thickness_start
+
+    def __repr__(self):
+        return 'JournalState(path={!r}, finished={}, resume_index={}, pulses_done={}, goal={})'.format(
+            self.path, self.finished, self.resume_index, self.pulses_done, self.goal)
+
+
+def step_to_dict(step: DepositionStep):
+    return {'index': step.index, 'name': step.name, 'target': step.target, 'raster_steps': step.raster_steps,
+            'tts_distance': step.tts_distance, 'num_pulses': step.num_pulses, 'reprate': step.reprate,
+            'delay': step.delay, 'man_action': step.man_action, 'thickness': step.thickness}
+
+
+def read_journal(path: str):
+    entries = []
+    with open(path, 'rt', encoding='utf-8') as journal_file:
+        for line in journal_file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Torn final line from a crash mid write, everything before it is intact
+                break
+    if not entries or entries[0].get('event') != RUN_STARTED:
+        raise ValueError('{} is not a deposition journal'.format(path))
+
+    plan = DepositionPlan(DepositionStep(**step) for step in entries[0]['steps'])
+    finished_steps = set()
+    current = None
+    pulses_done = 0
+    goal = None
+    goal_offset = 0
+    thickness_start = None
+    for entry in entries[1:]:
+        event = entry['event']
+        if event == STEP_STARTED:
+            if entry['index'] != current:
+                # The resumed step of a resumed run keeps its pulse count
+                pulses_done = 0
+                goal = None
+                thickness_start = None
+            current = entry['index']
+        elif event == PULSING_STARTED:
+            goal = entry['goal']
+            goal_offset = entry.get('offset', 0)
+            pulses_done = max(pulses_done, goal_offset)
+            if thickness_start is None:
+                thickness_start = entry.get('thickness_start')
+        elif event == GOAL_CHANGED:
+            # A thickness step's goal moved while pulsing, the arduino's count carries on from the same start
+            goal = entry['goal']
+        elif event in (PULSES, RUN_ABORTED) and entry.get('delivered') is not None:
+            pulses_done = max(pulses_done, entry['delivered'])
+        elif event == STEP_FINISHED:
+            finished_steps.add(entry['index'])
+            current = None
+            pulses_done = 0
+            goal = None
+            thickness_start = None
+
+    finished = entries[-1]['event'] == RUN_FINISHED
+    resume_index = None
+    if not finished:
+        remaining = [step.index for step in plan if step.index not in finished_steps]
+        if remaining:
+            resume_index = current if current is not None else remaining[0]
+        else:
+            finished = True
+    if resume_index != current:
+        pulses_done, goal, goal_offset, thickness_start = 0, None, 0, None
+    return JournalState(path, plan, finished, resume_index, pulses_done, goal, goal_offset, entries[-1]['event'],
+                        thickness_start)
+
+
+def latest_journal(directory=Global.DEPOSITION_JOURNAL_DIR):
+    # Path of the most recent journal in directory, or None
+    try:
+        names = [name for name in os.listdir(directory) if name.startswith('deposition_') and name.endswith('.jsonl')]
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    return max((os.path.join(directory, name) for name in names), key=os.path.getmtime)
+
+
+def latest_unfinished_journal(directory=Global.DEPOSITION_JOURNAL_DIR):
+    # JournalState of the most recent run if it didn't finish, otherwise None
+    path = latest_journal(directory)
+    if path is None:
+        return None
+    try:
+        state = read_journal(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return None if state.finished else state
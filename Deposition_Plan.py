@@ -0,0 +1,187 @@
+import xml.etree.ElementTree as ET
+import Global_Values as Global
+import Static_Functions as Static
+from RPi_Hardware import RPiHardware
+
+
+class DepositionPlanError(ValueError):
+    pass
+
+
+class DepositionStep:
+    # One step of a compiled deposition. Everything the deposition worker needs
+    # is parsed, checked and converted to motor units up front so that running
+    # the step is just a matter of sending the numbers.
+    __slots__ = ('index', 'name', 'target', 'carousel_goal', 'raster_steps', 'tts_distance', 'sub_goal',
+                 'num_pulses', 'reprate', 'delay', 'man_action', 'thickness')
+
+    def __init__(self, index: int, name: str, target: int, raster_steps: int, tts_distance: float, num_pulses: int,
+                 reprate: int, delay: float, man_action: str, thickness=0.):
+        self.index = index
+        self.name = name
+        self.target = target
+        self.carousel_goal = RPiHardware.carousel_position_for_target(target)
+        self.raster_steps = raster_steps  # 0 for no rastering
+        self.tts_distance = tts_distance  # mm
+        self.sub_goal = RPiHardware.sub_position_for_tts(tts_distance)
+        self.num_pulses = num_pulses
+        self.reprate = reprate
+        self.delay = delay  # Seconds to wait after the step
+        self.man_action = man_action  # Empty if there is no manual action
+        # kAngstrom to grow as measured by the SQM, 0 for a step that just fires num_pulses. Thickness steps end
+        # when the thickness is reached, num_pulses is then the planned number of pulses and the most that will
+        # be fired.
+        self.thickness = thickness
+
+    def is_thickness_step(self):
+        return self.thickness > 0
+
+    def laser_time(self):
+        # Seconds of pulsing, not counting the laser start delay
+        return self.num_pulses / self.reprate
+
+    def __repr__(self):
+        return ('DepositionStep(index={}, name={!r}, target={}, raster_steps={}, tts_distance={}, num_pulses={}, '
+                'reprate={}, delay={}, man_action={!r}, thickness={})'.format(self.index, self.name, self.target,
+                                                                               self.raster_steps, self.tts_distance,
+                                                                               self.num_pulses, self.reprate,
+                                                                               self.delay, self.man_action,
+                                                                               self.thickness))
+
+
+class DepositionPlan:
+    # Ordered, immutable sequence of compiled steps.
+    __slots__ = ('steps',)
+
+    def __init__(self, steps):
+        self.steps = tuple(sorted(steps, key=lambda step: step.index))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __getitem__(self, item):
+        return self.steps[item]
+
+    def from_index(self, start_index: int):
+        # Plan made of the steps with an index of at least start_index, used to resume an aborted deposition.
+        return DepositionPlan(step for step in self.steps if step.index >= start_index)
+
+    def total_pulses(self):
+        return sum(step.num_pulses for step in self.steps)
+
+
+def compile_deposition(deposition, pld_settings=None, max_reprate=None):
+    # Compiles a deposition into a DepositionPlan. deposition can be a <deposition> xml element or an iterable of
+    # step parameter dicts (DepStepItem.get_params()). pld_settings is the instrument settings xml, needed to size
+    # rastering for each target. Raises DepositionPlanError naming the step for any invalid value.
+    if isinstance(deposition, ET.Element):
+        params = [step_params_from_xml(step) for step in deposition.findall('./step')]
+    else:
+        params = list(deposition)
+
+    if max_reprate is None and pld_settings is not None:
+        max_reprate_element = pld_settings.find('./laser/max_reprate')
+        if max_reprate_element is not None:
+            max_reprate = int(max_reprate_element.text)
+
+    steps = [compile_step(step_params, pld_settings, max_reprate) for step_params in params]
+    indices = [step.index for step in steps]
+    if len(set(indices)) != len(indices):
+        raise DepositionPlanError('Deposition has duplicate step indices: {}'.format(sorted(indices)))
+    return DepositionPlan(steps)
+
+
+def step_params_from_xml(step: ET.Element):
+    # Same keys as DepStepItem.step_params
+    params = {'step_index': step.get('step_index'), 'step_name': step.get('step_name')}
+    for child in step:
+        params[child.tag] = child.text
+    return params
+
+
+def compile_step(params: dict, pld_settings=None, max_reprate=None):
+    name = str(params.get('step_name'))
+    try:
+        index = int(params['step_index'])
+    except (KeyError, TypeError, ValueError):
+        raise DepositionPlanError('Step "{}" has no valid step index'.format(name))
+
+    def fail(field, problem):
+        raise DepositionPlanError('Step {} ("{}"): {} {}'.format(index, name, field, problem))
+
+    def number(field, cast):
+        try:
+            return cast(float(str(params[field]).strip()))
+        except (KeyError, TypeError, ValueError):
+            fail(field, 'is not a number ({!r})'.format(params.get(field)))
+
+    target = parse_target(params.get('target'))
+    if target is None:
+        fail('target', 'is not a valid target ({!r})'.format(params.get('target')))
+
+    tts_distance = number('tts_distance', float)
+    if not Global.SUB_D0 <= tts_distance <= Global.SUB_DMAX:
+        fail('tts_distance', 'must be between {} and {} mm'.format(Global.SUB_D0, Global.SUB_DMAX))
+
+    num_pulses = number('num_pulses', int)
+    if num_pulses <= 0:
+        fail('num_pulses', 'must be positive')
+
+    reprate = number('reprate', int)
+    if reprate <= 0 or (max_reprate is not None and reprate > max_reprate):
+        fail('reprate', 'must be between 1 and {} Hz'.format(max_reprate if max_reprate is not None else 'the max'))
+
+    delay = number('delay', float) if params.get('delay') not in (None, '', 'None') else 0.
+    if delay < 0:
+        fail('delay', 'cannot be negative')
+
+    thickness = number('thickness', float) if params.get('thickness') not in (None, '', 'None') else 0.
+    if thickness < 0:
+        fail('thickness', 'cannot be negative')
+
+    raster_steps = 0
+    if parse_bool(params.get('raster')):
+        if pld_settings is None:
+            fail('raster', 'needs the instrument settings to size the raster')
+        raster_steps = target_raster_steps(pld_settings, target)
+
+    man_action = params.get('man_action')
+    if isinstance(man_action, ET.Element):
+        man_action = man_action.text
+    if man_action in (None, 'None'):
+        man_action = ''
+
+    return DepositionStep(index, name, target, raster_steps, tts_distance, num_pulses, reprate, delay,
+                          str(man_action), thickness)
+
+
+def parse_target(value):
+    # Targets are stored either as a plain number or as the roster text from the target combo box
+    # ("#2 - LLTaO - 20 mm"). Returns None if no target number can be found.
+    text = str(value).strip()
+    if text.startswith('#'):
+        text = text[1:].split(' ', 1)[0]
+    try:
+        target = int(text)
+    except ValueError:
+        return None
+    return target if 0 <= target < 6 else None
+
+
+def parse_bool(value):
+    # Raster is saved as True/False or as a Qt check state (0 unchecked, 2 checked)
+    return str(value).strip().lower() in ('true', '1', '2')
+
+
+def target_raster_steps(pld_settings, target: int):
+    target_string = "./target_carousel/target[@ID='{}']/".format(target)
+    try:
+        target_size = float(pld_settings.find(target_string + 'Size').text)
+        target_utilization = float(pld_settings.find(target_string + 'Utilization').text)
+        target_height = float(pld_settings.find(target_string + 'Height').text)
+    except (AttributeError, ValueError):
+        raise DepositionPlanError('Instrument settings are missing the size of target {}'.format(target))
+    return Static.calc_raster_steps(target_size, target_utilization, target_height)
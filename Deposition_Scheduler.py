@@ -0,0 +1,40 @@
+from Deposition_Plan import DepositionPlan
+
+
+class StepSchedule:
+    # What can be overlapped around one step of a plan, worked out once before the deposition starts.
+    #   arm_during_move: turn the laser on when the step's moves are sent, so the laser start delay runs while
+    #       the motors are moving instead of after them (external triggering only).
+    #   premove_during_manual: send the next step's moves as soon as the manual action prompt for this step is
+    #       shown rather than after it has been answered.
+    #   keep_laser_on: leave the laser in on mode after the step because the next one follows without a move and
+    #       soon enough that the laser won't time out, so it doesn't have to go through its start delay again.
+    __slots__ = ('arm_during_move', 'premove_during_manual', 'keep_laser_on')
+
+    def __init__(self, arm_during_move=False, premove_during_manual=False, keep_laser_on=False):
+        self.arm_during_move = arm_during_move
+        self.premove_during_manual = premove_during_manual
+        self.keep_laser_on = keep_laser_on
+
+    def __repr__(self):
+        return 'StepSchedule(arm_during_move={}, premove_during_manual={}, keep_laser_on={})'.format(
+            self.arm_during_move, self.premove_during_manual, self.keep_laser_on)
+
+
+def schedule_deposition(plan: DepositionPlan, external_trigger=True, premove_during_manual=True, max_idle_on=10.):
+    # Returns a StepSchedule for each step of the plan, in order. max_idle_on is the longest gap (seconds) between
+    # steps that the laser is left on for, keep it well below the laser's trigger timeout.
+    # Overlaps are only planned where they can't change what is deposited: nothing for step N+1 is moved until
+    # step N has finished pulsing, and moves are never overlapped with pulsing.
+    schedule = []
+    for position, step in enumerate(plan):
+        next_step = plan[position + 1] if position + 1 < len(plan) else None
+        premove = (premove_during_manual and bool(step.man_action) and next_step is not None and
+                   (next_step.target != step.target or next_step.tts_distance != step.tts_distance))
+        # If the next step moves, the laser is re-armed during that move anyway so there is nothing to gain
+        keep_on = (external_trigger and next_step is not None and not step.man_action and
+                   step.delay <= max_idle_on and next_step.target == step.target and
+                   next_step.tts_distance == step.tts_distance)
+        schedule.append(StepSchedule(arm_during_move=external_trigger, premove_during_manual=premove,
+                                     keep_laser_on=keep_on))
+    return tuple(schedule)
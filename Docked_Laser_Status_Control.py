@@ -5,7 +5,6 @@ from PyQt5.QtWidgets import (QCheckBox, QComboBox, QLabel, QLineEdit, QPushButto
                              QWidget, QMessageBox, QDockWidget)
 from Laser_Hardware import CompexLaser
 from pyvisa.errors import VisaIOError
-from time import sleep
 import Global_Values as Global
 from RPi_Hardware import RPiHardware
 
@@ -54,7 +53,7 @@ class LaserStatusControl(QDockWidget):
         self.current_hv = self.laser.rd_hv()
         # self.lines['voltage'].setValidator(QDoubleValidator(18, 27, 1))
         self.update_timer = QTimer()
-        self.timer_check_warmup = QTimer()
+        self.waiting_for_warmup = False  # Start/stop is disabled until the telemetry reports the warm-up is over
 
         self.init_connections()
         self.update_pulse_counter() # Reads the current pulse counter value
@@ -92,41 +91,28 @@ class LaserStatusControl(QDockWidget):
         self.update_timer.timeout.connect(self.update_lsc)
         self.update_timer.start(int(1000 / int(self.laser.reprate)))
 
-        self.timer_check_warmup.setInterval(1000)
-        self.timer_check_warmup.timeout.connect(self.check_warmup)
+        self.brain.laser_telemetry.opmode_changed.connect(self.check_warmup)
 
         self.brain.laser_finished.connect(self.change_on_off)
         self.brain.laser_finished.connect(self.update_pulse_counter)
 
     def update_lsc(self):
         # Updater for the laser status readouts. Only updates for fields that are
-        # not currently selected.
-        try:
-            if not self.lines['energy'].hasFocus():
-                self.lines['energy'].setText(self.laser.rd_energy())
-            sleep(Global.OP_DELAY)
-        except VisaIOError as err:
-            print("Error reading laser energy for LSC update.")
+        # not currently selected. Values come from the telemetry snapshot so this
+        # never touches the serial line on the GUI thread.
+        status = self.brain.laser_telemetry.snapshot()
 
-        try:
-            if not self.lines['voltage'].hasFocus():
-                self.lines['voltage'].setText(self.laser.rd_hv())
-            sleep(Global.OP_DELAY)
-        except VisaIOError as err:
-            print("Error reading laser HV for LSC update.")
+        if not self.lines['energy'].hasFocus() and 'energy' in status:
+            self.lines['energy'].setText(status['energy'])
 
-        try:
-            if not self.lines['reprate'].hasFocus():
-                self.lines['reprate'].setText(str(self.laser.reprate))
-            sleep(Global.OP_DELAY)
-        except VisaIOError as err:
-            print("Error reading laser reprate for LSC update.")
+        if not self.lines['voltage'].hasFocus() and 'hv' in status:
+            self.lines['voltage'].setText(status['hv'])
 
-        try:
-            self.lines['tube_press'].setText(self.laser.rd_tube_press())
-            sleep(Global.OP_DELAY)
-        except VisaIOError as err:
-            print("Error reading laser tube pressure for LSC update.")
+        if not self.lines['reprate'].hasFocus():
+            self.lines['reprate'].setText(str(self.laser.reprate))
+
+        if 'tube_press' in status:
+            self.lines['tube_press'].setText(status['tube_press'])
 
     def update_pulse_counter(self):
         self.lines['pulse_counter'].setText(str(self.laser.rd_user_counter()))
@@ -134,7 +120,7 @@ class LaserStatusControl(QDockWidget):
     def terminal_send(self):
         # Sends the command that was typed into the terminal.
         try:
-            self.terminal.setText(self.laser.query(self.terminal.text()))
+            self.terminal.setText(self.laser.query(self.terminal.text(), use_cache=False))
             print("Terminal Command Sent")
         except:
             print("An error occurred on sending terminal command")
@@ -157,31 +143,35 @@ class LaserStatusControl(QDockWidget):
             self.laser.set_trigger('INT')
 
     def change_on_off(self):
-        on_opmodes = ['ON', 'OFF,WAIT']
         # On button press stops the timer that updates the display so that
         # we don't see timeouts on pressing the button to stop/start
         self.update_timer.stop()
-        sleep(Global.OP_DELAY)
 
         try:
             num_pulses = int(self.lines['num_pulses'].text())
         except ValueError as err:
             num_pulses = None
 
-        if self.laser.rd_opmode() in on_opmodes:
+        opmode = self.laser.interpret_opmode()
+        if opmode.is_running:
             self.brain.stop_laser()
             if num_pulses is not None:
                 self.lines['num_pulses'].setText('')
             self.laser_manual_stop.emit()
             self.btns['start_stop'].setChecked(False)
             self.btns['start_stop'].setText('Start Laser')
-        elif self.laser.rd_opmode() == 'OFF:31':
+        elif opmode.is_timed_out:
             self.laser_timeout_handler()
-        elif self.laser.rd_opmode() == 'OFF:21':
+        elif opmode.is_warming_up:
             # FIXME: Add a countdown timer?
             self.btns['start_stop'].setDisabled(True)
-            self.timer_check_warmup.start()  # Starts a timer that will check if the warmup is over every second
-            self.warmup_warn()
+            self.waiting_for_warmup = True  # check_warmup re-enables the button when the opmode changes
+            # The poller may already have published the end of the warm-up, which check_warmup ignored
+            current_opmode = self.brain.laser_telemetry.opmode()
+            if current_opmode is not None:
+                self.check_warmup(None, current_opmode)
+            if self.waiting_for_warmup:
+                self.warmup_warn()
         # If the laser is currently in an off state
         else:
             self.brain.start_laser(num_pulses=num_pulses)
@@ -189,22 +179,25 @@ class LaserStatusControl(QDockWidget):
             self.btns['start_stop'].setText('Stop Laser')
 
         # Re-enables the updater for the LSC after handling start/stop
-        sleep(Global.OP_DELAY)
         try:
             self.update_timer.start(int(1000 / int(self.laser.rd_reprate())))
         except VisaIOError:
             # If the reprate fails to read, set timer to update at 5Hz
             self.update_timer.start(200)
 
-    def check_warmup(self):
-        curr_opmode = self.laser.rd_opmode()
-        if curr_opmode == 'OFF:0':
-            self.timer_check_warmup.stop()
+    def check_warmup(self, previous_opmode, curr_opmode):
+        # Called by the telemetry on every opmode change
+        if not self.waiting_for_warmup:
+            return
+        if curr_opmode.is_ready:
+            self.waiting_for_warmup = False
             self.btns['start_stop'].setDisabled(False)
             self.btns['start_stop'].setChecked(False)
-        elif curr_opmode == 'OFF:21':
+        elif curr_opmode.is_warming_up:
             pass  # Nothing to do if the laser is still in warmup mode
-        elif curr_opmode == 'OFF:31':
+        elif curr_opmode.is_timed_out:
+            self.waiting_for_warmup = False
+            self.btns['start_stop'].setDisabled(False)
             self.laser_timeout_handler()
 
     def laser_timeout_handler(self):
@@ -216,7 +209,6 @@ class LaserStatusControl(QDockWidget):
                                              QMessageBox.Cancel)
         if timeout_clear == QMessageBox.Ok:
             self.laser.set_timeout(False)
-            sleep(Global.OP_DELAY)
             self.laser.off()
             self.btns['start_stop'].setChecked(False)
         elif timeout_clear == QMessageBox.Cancel:
@@ -7,6 +7,7 @@ from PyQt5 import uic
 import Global_Values as Global
 import Static_Functions as Static
 import numpy as np
+from time import monotonic
 
 
 class MotorControlPanel(QDockWidget):
@@ -38,6 +39,16 @@ class MotorControlPanel(QDockWidget):
         # self.hotkey_disable = False
 
         self.motor_update_timer = QTimer()
+        # Fields are refreshed from one non-blocking batched arduino query per
+        # tick, the reply is applied on the next tick after it arrives.
+        # field -> (motor, query parameter)
+        self.field_queries = {'current_target': ('carousel', 'position'),
+                              'sub_position': ('substrate', 'position'),
+                              'sub_speed': ('substrate', 'max speed'),
+                              'carousel_speed': ('carousel', 'max speed'),
+                              'carousel_accel': ('carousel', 'acceleration')}
+        self.pending_fields = None  # (Future, time requested, fields) for the outstanding batched query
+        self.streamed_fields = ['current_target', 'sub_position']  # Available from the arduino status stream
 
         self.init_connections()
         self.update_fields()
@@ -79,27 +90,55 @@ class MotorControlPanel(QDockWidget):
         self.combos['current_target'].blockSignals(False)
 
     def update_fields(self):
-        if not self.combos['current_target'].hasFocus():
-            self.combos['current_target'].setCurrentIndex(self.brain.current_target())
-
-        if not self.lines['sub_position'].hasFocus():
-            sub_step_position = int(self.brain.arduino.query_motor_parameters('substrate', 'position'))
-            sub_position = np.round((sub_step_position / Global.SUB_STEPS_PER_MM + Global.SUB_D0), 3)
+        # Apply the reply that has come in since the last tick, then ask for
+        # fresh values. Nothing here waits on the serial port.
+        if self.pending_fields is not None:
+            future, requested, queries = self.pending_fields
+            if future.done():
+                self.pending_fields = None
+                if not future.cancelled() and future.exception() is None and future.result() is not None:
+                    reply = future.result()
+                    for field, motor_query in queries.items():
+                        self.apply_field(field, reply[motor_query])
+            elif monotonic() - requested > self.brain.arduino.reply_timeout:
+                # Give up on a reply that never came so the fields keep updating
+                self.brain.arduino.resync()
+                self.pending_fields = None
+
+        # Positions come from the pushed status stream while it is live, so only the
+        # settings need to be queried.
+        queries = self.field_queries
+        if self.brain.arduino.status_is_fresh():
+            status = self.brain.arduino.status
+            self.apply_field('current_target', status.target_position)
+            self.apply_field('sub_position', status.sub_position)
+            queries = {field: motor_query for field, motor_query in self.field_queries.items()
+                       if field not in self.streamed_fields}
+
+        if self.pending_fields is None:
+            self.pending_fields = (self.brain.arduino.query_many_async(queries.values()), monotonic(), queries)
+
+    def apply_field(self, field: str, value):
+        if value is None:
+            return
+        if field == 'current_target':
+            if not self.combos['current_target'].hasFocus():
+                self.combos['current_target'].setCurrentIndex(self.brain.target_from_position(int(value)))
+
+        elif field == 'sub_position' and not self.lines['sub_position'].hasFocus():
+            sub_position = np.round((int(value) / Global.SUB_STEPS_PER_MM + Global.SUB_D0), 3)
             self.lines['sub_position'].setText(str(sub_position))
 
-        if not self.lines['sub_speed'].hasFocus():
-            sub_step_speed = float(self.brain.arduino.query_motor_parameters('substrate', 'max speed'))
-            sub_speed = np.round((sub_step_speed / Global.SUB_STEPS_PER_MM), 3)
+        elif field == 'sub_speed' and not self.lines['sub_speed'].hasFocus():
+            sub_speed = np.round((float(value) / Global.SUB_STEPS_PER_MM), 3)
             self.lines['sub_speed'].setText(str(sub_speed))
-            
-        if not self.lines['carousel_speed'].hasFocus():
-            carousel_step_speed = float(self.brain.arduino.query_motor_parameters('carousel', 'max speed'))
-            carousel_speed = np.round((carousel_step_speed / Global.CAROUSEL_STEPS_PER_REV), 3)
+
+        elif field == 'carousel_speed' and not self.lines['carousel_speed'].hasFocus():
+            carousel_speed = np.round((float(value) / Global.CAROUSEL_STEPS_PER_REV), 3)
             self.lines['carousel_speed'].setText(str(carousel_speed))
-            
-        if not self.lines['carousel_accel'].hasFocus():
-            carousel_step_accel = float(self.brain.arduino.query_motor_parameters('carousel', 'acceleration'))
-            carousel_accel = np.round((carousel_step_accel / Global.CAROUSEL_STEPS_PER_REV), 3)
+
+        elif field == 'carousel_accel' and not self.lines['carousel_accel'].hasFocus():
+            carousel_accel = np.round((float(value) / Global.CAROUSEL_STEPS_PER_REV), 3)
             self.lines['carousel_accel'].setText(str(carousel_accel))
 
     # def toggle_hotkeys(self):
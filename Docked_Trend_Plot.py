@@ -0,0 +1,174 @@
+from PyQt5.QtCore import Qt, QTimer, QPointF, QLineF, QRectF
+from PyQt5.QtGui import QPainter, QPen, QColor, QPolygonF
+from PyQt5.QtWidgets import QComboBox, QDockWidget, QHBoxLayout, QLabel, QVBoxLayout, QWidget
+from RPi_Hardware import RPiHardware
+from Run_History import decimate_min_max
+import Global_Values as Global
+import numpy as np
+from time import monotonic, perf_counter
+
+
+class TrendBuffer:
+    # Rolling history of the plotted channels, sampled at a fixed rate. Every
+    # sample is written twice, capacity rows apart, so the most recent n rows
+    # are always one contiguous slice of the buffer and reading a window never
+    # copies or wraps.
+    def __init__(self, channels, capacity: int):
+        self.channels = tuple(channels)
+        self.capacity = capacity
+        self.times = np.zeros(2 * capacity)
+        self.values = np.full((len(self.channels), 2 * capacity), np.nan, dtype=np.float32)
+        self.count = 0  # Samples ever written
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp: float, values):
+        idx = self.count % self.capacity
+        self.times[idx] = self.times[idx + self.capacity] = timestamp
+        self.values[:, idx] = self.values[:, idx + self.capacity] = values
+        self.count += 1
+
+    def window(self, seconds=None):
+        # (times, values[channel, sample]) of the last seconds of history, views into the buffer
+        end = self.count % self.capacity + self.capacity if self.count >= self.capacity else self.count
+        start = end - len(self)
+        times = self.times[start:end]
+        if seconds is not None and times.size:
+            start += np.searchsorted(times, times[-1] - seconds, side='left')
+        return self.times[start:end], self.values[:, start:end]
+
+
+class TrendPlot(QWidget):
+    # Stacked strip charts, one lane per channel. Each redraw reduces the
+    # visible window to at most one min/max pair per pixel column, and if a
+    # redraw goes over the frame budget the next one uses fewer columns.
+    lane_colours = ('#1f77b4', '#d62728', '#2ca02c', '#9467bd', '#ff7f0e')
+
+    def __init__(self, buffer: TrendBuffer, labels, parent=None):
+        super().__init__(parent)
+        self.buffer = buffer
+        self.labels = labels
+        self.span = 600.  # Seconds shown, None for all of the history
+        self.max_points = 2000  # Adjusted to keep redraws within the frame budget
+        self.frame_budget = Global.TREND_FRAME_BUDGET_MS / 1000
+        self.last_frame_time = 0.
+        self.setMinimumHeight(60 * len(labels))
+
+    def paintEvent(self, event):
+        started = perf_counter()
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        times, values = self.buffer.window(self.span)
+        lane_height = self.height() / len(self.labels)
+        margin = 4
+        text_height = self.fontMetrics().height()
+        plot_width = max(self.width() - 2 * margin, 1)
+        points = min(plot_width, self.max_points)
+
+        for lane, label in enumerate(self.labels):
+            top = lane * lane_height
+            painter.setPen(QColor('#cccccc'))
+            painter.drawLine(QLineF(0, top, self.width(), top))
+            centres, mins, maxes = decimate_min_max(times, values[lane], points)
+            finite = np.isfinite(mins) & np.isfinite(maxes)
+            caption = label
+            if finite.any():
+                low, high = float(np.min(mins[finite])), float(np.max(maxes[finite]))
+                if high == low:
+                    high, low = high + 0.5, low - 0.5
+                t_end = times[-1]
+                t_start = t_end - self.span if self.span is not None else times[0]
+                x = margin + (centres[finite] - t_start) / max(t_end - t_start, 1e-9) * plot_width
+                scale = (lane_height - 2 * margin - text_height) / (high - low)
+                y_min = top + lane_height - margin - (mins[finite] - low) * scale
+                y_max = top + lane_height - margin - (maxes[finite] - low) * scale
+
+                painter.setPen(QPen(QColor(self.lane_colours[lane % len(self.lane_colours)]), 1))
+                # Envelope of each column plus a line through the column centres
+                painter.drawLines([QLineF(x0, y0, x0, y1) for x0, y0, y1 in zip(x, y_min, y_max)])
+                painter.drawPolyline(QPolygonF([QPointF(x0, (y0 + y1) / 2) for x0, y0, y1 in zip(x, y_min, y_max)]))
+                caption = '{}: {:.4g}  [{:.4g} - {:.4g}]'.format(label, float(values[lane][-1]), low, high)
+            painter.setPen(Qt.black)
+            painter.drawText(QRectF(margin, top + 1, self.width() - 2 * margin, text_height), Qt.AlignLeft, caption)
+        painter.end()
+
+        self.last_frame_time = perf_counter() - started
+        if self.last_frame_time > self.frame_budget:
+            self.max_points = max(100, int(self.max_points * 0.7))
+        elif self.last_frame_time < self.frame_budget / 2:
+            self.max_points = min(4000, int(self.max_points * 1.1) + 1)
+
+
+class TrendPlotDock(QDockWidget):
+    # Rolling plots of laser energy, HV, tube pressure and motor positions. The
+    # values come from the laser telemetry snapshot and the arduino status
+    # stream, both already held in memory, so nothing here talks to hardware.
+    channels = (('energy', 'Energy (mJ)'),
+                ('hv', 'HV (kV)'),
+                ('tube_press', 'Tube Pressure (mbar)'),
+                ('sub_position', 'Substrate TTS (mm)'),
+                ('target_position', 'Carousel (target)'))
+    spans = (('1 min', 60.), ('10 min', 600.), ('1 hour', 3600.), ('All', None))
+
+    def __init__(self, brain: RPiHardware):
+        super().__init__('Trends')
+        self.setObjectName('trend_plot_dock')
+        self.brain = brain
+        capacity = int(Global.TREND_HISTORY_SECONDS * 1000 / Global.TREND_SAMPLE_MS)
+        self.buffer = TrendBuffer([name for name, label in self.channels], capacity)
+        self.plot = TrendPlot(self.buffer, [label for name, label in self.channels])
+
+        self.combo_span = QComboBox()
+        self.combo_span.addItems([name for name, seconds in self.spans])
+        self.combo_span.setCurrentIndex(1)
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel('Show last:'))
+        controls.addWidget(self.combo_span)
+        controls.addStretch()
+        layout = QVBoxLayout()
+        layout.addLayout(controls)
+        layout.addWidget(self.plot)
+        container = QWidget()
+        container.setLayout(layout)
+        self.setWidget(container)
+
+        self.sample_timer = QTimer()
+        self.redraw_timer = QTimer()
+        self.init_connections()
+
+    def init_connections(self):
+        self.combo_span.currentIndexChanged.connect(self.change_span)
+        self.sample_timer.timeout.connect(self.take_sample)
+        self.sample_timer.start(Global.TREND_SAMPLE_MS)
+        self.redraw_timer.timeout.connect(self.redraw)
+        self.redraw_timer.start(Global.TREND_REDRAW_MS)
+
+    def change_span(self, idx: int):
+        self.plot.span = self.spans[idx][1]
+        self.plot.update()
+
+    def take_sample(self):
+        snapshot = self.brain.laser_telemetry.snapshot()
+        values = [to_float(snapshot.get('energy')), to_float(snapshot.get('hv')),
+                  to_float(snapshot.get('tube_press'))]
+        status = self.brain.arduino.status
+        if status is not None:
+            values.append(Global.SUB_D0 + status.sub_position / Global.SUB_STEPS_PER_MM)
+            values.append((status.target_position % Global.CAROUSEL_STEPS_PER_REV) /
+                          (Global.CAROUSEL_STEPS_PER_REV / 6))
+        else:
+            values.extend((np.nan, np.nan))
+        self.buffer.append(monotonic(), values)
+
+    def redraw(self):
+        # Skip painting while the dock is hidden or tabbed away, the samples are still kept
+        if self.isVisible() and not self.visibleRegion().isEmpty():
+            self.plot.update()
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
@@ -21,5 +21,25 @@ CAROUSEL_DIA_MM = CAROUSEL_DIA_INCH * 25.4  # mm, calculated
 
 AUTO_REPEAT_DELAY = 150
 OP_DELAY = 0.01
+TELEMETRY_INTERVAL = 0.1  # seconds between laser telemetry poll cycles
+LASER_SETTINGS_CHECK_INTERVAL = 60.  # seconds between checks of the mirrored laser settings against the laser
+ARDUINO_STATUS_PERIOD_MS = 50  # milliseconds between status frames pushed by the arduino
+ARDUINO_RESYNC_QUIET = 0.2  # seconds without a stray reply before requests are matched to replies again
 
-TARGET_UTILIZATION_FRACTION = 0.9
\ No newline at end of file
+TARGET_UTILIZATION_FRACTION = 0.9
+
+DEPOSITION_JOURNAL_DIR = 'deposition_journals'  # Where run journals for resuming depositions are kept
+DEPOSITION_JOURNAL_INTERVAL = 1.0  # seconds between pulse count records while pulsing
+PULSE_LOG_DIR = 'pulse_logs'  # Per run laser and motor telemetry logs
+PULSE_LOG_CAPACITY = 65536  # rows held in memory between flushes
+PULSE_LOG_FLUSH_INTERVAL = 2.0  # seconds between writing pulse log chunks
+TREND_SAMPLE_MS = 50  # milliseconds between samples for the trend plots
+TREND_REDRAW_MS = 250  # milliseconds between trend plot redraws
+TREND_HISTORY_SECONDS = 4 * 3600  # seconds of history kept for the trend plots
+TREND_FRAME_BUDGET_MS = 15  # target time for one trend plot redraw
+SQM_PORT = '/dev/ttyAMA0'  # Serial port 1, the SQM-160 thickness monitor is connected here
+SQM_POLL_INTERVAL = 0.1  # seconds between SQM-160 rate/thickness readings
+THICKNESS_FIT_POINTS = 30  # SQM readings used to fit growth per pulse for thickness terminated steps
+THICKNESS_FIT_MIN_PULSES = 10  # pulses the fit must span before its prediction is used
+THICKNESS_MAX_READING_AGE = 0.5  # seconds an SQM reading can be old and still trim a thickness step's goal
+THICKNESS_FINISH_WAIT = 1.0  # seconds a finished thickness step waits for a reading taken after the laser stopped
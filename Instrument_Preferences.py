@@ -1,6 +1,6 @@
 import os
 
-from PyQt5.QtCore import QRegExp, pyqtSignal, QTimer
+from PyQt5.QtCore import QRegExp, pyqtSignal
 from PyQt5.QtWidgets import QTabWidget, QLineEdit, QPushButton, QToolButton, QGroupBox, QFileDialog, QDialog, QWidget, \
     QLabel, QMessageBox, QStackedWidget
 from PyQt5 import uic
@@ -51,7 +51,6 @@ class InstrumentPreferencesDialog(QTabWidget):
                                  for widget in self.findChildren(QPushButton, QRegExp("btn_maint_*"))}
 
         # Class variables
-        self.maint_timer = QTimer()
         self.maint_window = None
         self.settings_file_path = 'settings.xml'
         self.pld_settings = ET.Element  # Empty element tree, needs to be read in on the next line
@@ -279,6 +278,12 @@ class SettingsPasswordDialog(QDialog):
 
 
 class NewGasFillDialog(QDialog):
+    # Status text for each stage of a new fill, by the stage in the opmode ('NEW FILL, EVAC' -> 'EVAC')
+    fill_stage_messages = {None: "New fill procedure started",
+                           'EVAC': "Evacuating laser tube for new gas fill",
+                           'WAIT': "Performing new fill leak test",
+                           'FILL': "Filling laser tube with new gas"}
+
     def __init__(self, brain: RPiHardware, settings: InstrumentPreferencesDialog):
         super().__init__()
         self.brain = brain
@@ -299,42 +304,39 @@ class NewGasFillDialog(QDialog):
         self.line_tube_press = self.findChildren(QLineEdit, QRegExp("line_tube_press"))[0]
         self.btn_ice_cancel = self.findChildren(QPushButton, QRegExp("btn_ice_cancel"))[0]
 
+        # Readouts and fill progress come from the laser telemetry poller, the
+        # filter contamination is only added to its queries while this is open.
+        self.telemetry = self.brain.laser_telemetry
+        self.telemetry.set_query('filter_contamination', 'FILTER CONTAMINATION?', 5.0)
+
         self.init_connections()
-        self.update_fields()
+        self.line_halogen_filter_ratio.setText(self.brain.laser.rd_filter_contamination())
+        self.update_fields(self.telemetry.snapshot())
         self.exec_()
 
     def init_connections(self):
         self.btn_cancel_fill.clicked.connect(self.close)
         self.btn_continue_fill.clicked.connect(self.start_new_fill)
         self.btn_ice_cancel.clicked.connect(self.abort)
-
-    def update_fields(self):
-        filter_ratio = self.brain.laser.rd_filter_contamination()
-        self.line_halogen_filter_ratio.setText(filter_ratio)
-        opmode = self.brain.laser.rd_opmode()
-        self.line_laser_status.setText(opmode)
-        tube_press = self.brain.laser.rd_tube_press()
-        self.line_tube_press.setText(tube_press)
-
-        return filter_ratio, opmode, tube_press
-
-    def check_fill_status(self):
-        filter_ratio, opmode, tube_press = self.update_fields()
-        print("Current tube pressure: ", tube_press)
-
-        if opmode == "NEW FILL":
-            self.lbl_fill_status.setText("New fill procedure started")
-            print("New fill procedure started")
-        elif opmode == "NEW FILL, EVAC":
-            self.lbl_fill_status.setText("Evacuating laser tube for new gas fill")
-            print("Evacuating laser tube for new gas fill")
-        elif opmode == "NEW FILL, WAIT":
-            self.lbl_fill_status.setText("Performing new fill leak test")
-            print("Performing new fill leak test")
-        elif opmode == "NEW FILL, FILL":
-            self.lbl_fill_status.setText("Filling laser tube with new gas")
-            print("Filling laser tube with new gas")
-        elif opmode == "NEW FILL:3":
+        self.telemetry.status_updated.connect(self.update_fields)
+
+    def update_fields(self, status):
+        # Fills in the readouts from a telemetry snapshot
+        if 'filter_contamination' in status:
+            self.line_halogen_filter_ratio.setText(status['filter_contamination'])
+        if 'opmode' in status:
+            self.line_laser_status.setText(status['opmode'])
+        if 'tube_press' in status:
+            self.line_tube_press.setText(status['tube_press'])
+
+    def check_fill_status(self, previous_opmode, opmode):
+        # Called by the telemetry each time the opmode changes during the fill
+        print("Current tube pressure: ", self.telemetry.snapshot().get('tube_press'))
+
+        if opmode.procedure == "NEW FILL" and not opmode.code and opmode.stage in self.fill_stage_messages:
+            self.lbl_fill_status.setText(self.fill_stage_messages[opmode.stage])
+            print(self.fill_stage_messages[opmode.stage])
+        elif opmode.procedure == "NEW FILL" and opmode.code == 3:
             self.lbl_fill_status.setText("No gas flow for new fill. You need to restart the procedure")
             print("No gas flow for new fill. You need to restart the procedure")
             no_flow = QMessageBox.warning(self, "No gas flow",
@@ -343,31 +345,33 @@ class NewGasFillDialog(QDialog):
                                           "will continue filling process as soon as gas flow is detected, clicking ok "
                                           "only closes this warning)",
                                           QMessageBox.Ok, QMessageBox.Ok)
-        elif opmode == "OFF" or opmode == "OFF:0":
+        elif opmode.is_ready:
             self.lbl_fill_status.setText("New gas fill complete")
             print("New gas fill complete")
             complete = QMessageBox.information(self, "New Gas Fill Complete",
                                                "The new gas fill procedure is complete click ok to close this dialog",
                                                QMessageBox.Ok, QMessageBox.Ok)
             self.close()
-        elif opmode == "SAFETY FILL":
+        elif opmode.procedure == "SAFETY FILL":
             print("Safety fill triggered, this is most likely due to a laser tube leak according to the manual.")
         else:
             print(opmode)
 
     def start_new_fill(self):
         self.stack.setCurrentIndex(1)
-        self.settings.maint_timer.timeout.connect(self.check_fill_status)
+        self.telemetry.opmode_changed.connect(self.check_fill_status)
         self.brain.laser.fill_new()
-        self.settings.maint_timer.start(250)
 
     def abort(self):
         self.brain.laser.off()
 
-    def close(self):
-        self.settings.maint_timer.stop()
-        try:
-            self.settings.maint_timer.timeout.disconnect(self.check_fill_status)
-        except TypeError:
-            pass
-        super().close()
+    def done(self, result):
+        # Every way of closing the dialog ends up here, including the window's close button
+        self.telemetry.remove_query('filter_contamination')
+        for signal, slot in ((self.telemetry.opmode_changed, self.check_fill_status),
+                             (self.telemetry.status_updated, self.update_fields)):
+            try:
+                signal.disconnect(slot)
+            except TypeError:
+                pass
+        super().done(result)
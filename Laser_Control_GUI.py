@@ -10,8 +10,10 @@ import sys
 from Laser_Hardware import CompexLaser
 from RPi_Hardware import RPiHardware
 from Arduino_Hardware import LaserBrainArduino
+from SQM_Hardware import SQM160
 from Docked_Motor_Control import MotorControlPanel
 from Docked_Laser_Status_Control import LaserStatusControl
+from Docked_Trend_Plot import TrendPlotDock
 from Deposition_Control import DepControlBox
 from Instrument_Preferences import InstrumentPreferencesDialog
 from pathlib import Path
@@ -21,6 +23,10 @@ from datetime import datetime, timedelta
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import serial
+import Global_Values as Global
 
 
 # Adds a settings attribute to the application for use elsewhere.
@@ -89,6 +95,7 @@ class PLDMainWindow(QMainWindow):
         # Create a docked widget to hold the LSC module
         self.lsc_docked = LaserStatusControl(self.laser, self.brain)
         self.motor_control_docked = MotorControlPanel(self.brain)
+        self.trend_docked = TrendPlotDock(self.brain)
         self.dep_control = DepControlBox(self.laser, self.brain, self)
         self.statusbar = QStatusBar()
         self.timeout_counter = -9999 # Starts with the value of a completed timer.
@@ -116,6 +123,8 @@ class PLDMainWindow(QMainWindow):
         self.addDockWidget(Qt.TopDockWidgetArea, self.motor_control_docked)
         self.tabifyDockWidget(self.lsc_docked, self.motor_control_docked)
         self.lsc_docked.raise_()
+        self.trend_docked.setAllowedAreas(Qt.TopDockWidgetArea | Qt.BottomDockWidgetArea)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.trend_docked)
 
         self.init_menubar()
 
@@ -290,12 +299,27 @@ def main():
     PLD_error_handler = PLDErrorLogger(pop_up=True)
     sys.excepthook = PLD_error_handler.pld_excepthook
     
-    # Use the following call for remote testing (without access to the laser), note that the laser.yaml file must be in
-    # the working directory
-    # laser = CompexLaser('ASRL3::INSTR', 'laser.yaml@sim')
-    laser = CompexLaser('ASRL/dev/ttyAMA1::INSTR', '@py')
-    arduino = LaserBrainArduino('/dev/ttyACM0')
-    brain = RPiHardware(laser=laser, arduino=arduino)
+    # The laser handshake runs on a worker thread while the arduino connects here. The arduino is a QObject so it
+    # has to be created on the GUI thread, CompexLaser isn't.
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        laser_future = executor.submit(CompexLaser, 'ASRL/dev/ttyAMA1::INSTR', '@py')
+        # Use the following call for remote testing (without access to the laser), note that the laser.yaml file must
+        # be in the working directory
+        # laser_future = executor.submit(CompexLaser, 'ASRL3::INSTR', 'laser.yaml@sim')
+        arduino = LaserBrainArduino('/dev/ttyACM0')
+        arduino_time = perf_counter() - started
+        laser = laser_future.result()
+    print('Hardware connected in {:.0f} ms (laser handshake {:.0f} ms, arduino {:.0f} ms)'
+          .format((perf_counter() - started) * 1000, laser.connect_time * 1000, arduino_time * 1000))
+    # The SQM-160 is optional, without it thickness terminated steps can't be run
+    try:
+        sqm = SQM160(Global.SQM_PORT)
+    except serial.SerialException as err:
+        print('SQM-160 not connected on {} ({}), thickness terminated steps are unavailable.'
+              .format(Global.SQM_PORT, err))
+        sqm = None
+    brain = RPiHardware(laser=laser, arduino=arduino, sqm=sqm)
     ex = PLDMainWindow(laser, brain)
     ex.show()
     
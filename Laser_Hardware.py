@@ -7,44 +7,201 @@ Created on Tue Mar  5 12:17:18 2019
 # analysis:ignore
 
 import pyvisa as visa
-import csv
-from time import sleep
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from time import sleep, monotonic, perf_counter
 
 from PyQt5.QtWidgets import QInputDialog
+from Laser_Opmode import decode_opmode
 
 
 class LaserOutOfRangeError(BaseException):
     pass
 
 
+# Command priorities for the laser command queue, lower numbers are sent first.
+# Safety commands (e.g. OPMODE=OFF) jump ahead of anything already waiting.
+PRIORITY_SAFETY = 0
+PRIORITY_COMMAND = 1
+PRIORITY_POLL = 2
+_PRIORITY_STOP = 99
+
+
+# Writable laser settings, by setter name (the part of the command before
+# '=') with the query that reads each one back. They are read in bulk at
+# connect and kept in memory after that: every write updates the stored value
+# so reads never go to the laser, apart from check_settings() looking for
+# changes made at the laser's own keypad. COUNTS isn't one, it counts down
+# while the laser runs.
+LASER_SETTINGS = {'REPRATE': 'REPRATE?', 'TRIGGER': 'TRIGGER?', 'MODE': 'MODE?', 'EGY': 'EGY SET?',
+                  'EGY RANGE': 'EGY RANGE?', 'FILTER': 'FILTER?', 'GASMODE': 'GASMODE?', 'MENU': 'MENU?',
+                  'TIMEOUT': 'TIMEOUT?', 'COD': 'COD STATE?', 'ROOMTEMP': 'ROOMTEMP?', 'BUFFER': 'BUFFER?',
+                  'HALOGEN': 'HALOGEN?', 'INERT': 'INERT?', 'RARE': 'RARE?'}
+SETTING_QUERIES = frozenset(LASER_SETTINGS.values())
+
+# Read along with the settings by CompexLaser.handshake() at connect
+HANDSHAKE_QUERIES = ('TOTALCOUNTER?', 'COUNTER?', 'VERSION?', 'TYPE OF LASER?', 'OPMODE?')
+
+# Setting writes that don't read back as the value written (MENU? also
+# reports the gas, EGY=0 goes back to the menu default), these are re-read
+# from the laser the next time they're needed instead.
+SETTINGS_NOT_ECHOED = {'MENU': None, 'EGY': ('0',)}
+
+# How long (seconds) a query's reply can be reused before the laser is asked
+# again. Queries that aren't listed are always sent, settings are held by the
+# settings mirror instead. TTL_PULSE is one pulse period at the current
+# reprate, for readings that can change every pulse.
+TTL_FOREVER = float('inf')
+TTL_PULSE = 'pulse'
+QUERY_TTLS = {'VERSION?': TTL_FOREVER, 'TYPE OF LASER?': TTL_FOREVER,
+              'TOTALCOUNTER?': 300., 'LEAKRATE?': 300., 'CAP.LEFT?': 60.,
+              'FILTER CONTAMINATION?': 10., 'TEMP?': 5., 'ACCU?': 5.,
+              'PRESSURE?': 1., 'POWER STABILIZATION ACHIEVED?': 1., 'INTERLOCK?': 0.5, 'OPMODE?': 0.2,
+              'EGY?': TTL_PULSE, 'HV?': TTL_PULSE, 'COUNTER?': TTL_PULSE, 'PULSE DIFF?': TTL_PULSE}
+
+# Cached replies dropped when a setter is written, by the setter's name (the
+# part before '='). A setter always drops the query of the same name as well.
+SETTER_INVALIDATES = {'OPMODE': ('PRESSURE?', 'CAP.LEFT?', 'EGY?', 'HV?', 'FILTER CONTAMINATION?'),
+                      'MODE': ('EGY?', 'HV?'),
+                      'EGY': ('EGY SET?', 'HV?'),
+                      'HV': ('EGY?',),
+                      'COUNTS': ('TRIGGER?',),
+                      'CAP.SET': ('CAP.LEFT?',),
+                      'MENU': ('GASMODE?', 'EGY SET?', 'HV?', 'REPRATE?'),
+                      'GASMODE': ('MENU?',)}
+
+
+class LaserCommandQueue:
+    # Owns the pyvisa resource and serializes every transaction with the laser
+    # on a single worker thread. Callers submit writes/queries with a priority
+    # and get back a Future (or block on it through write/query). The gap
+    # between back to back serial operations is measured from the end of the
+    # previous transaction, so there is only a sleep if one is actually needed.
+
+    def __init__(self, resource, min_gap=0.01):
+        self.resource = resource
+        self.min_gap = min_gap
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()  # Keeps FIFO order within a priority
+        self._last_transaction = 0.
+        self._thread = threading.Thread(target=self._run, name='LaserCommandQueue', daemon=True)
+        self._thread.start()
+
+    def submit(self, kind: str, command=None, priority=PRIORITY_COMMAND):
+        # kind is one of 'write', 'query' or 'read'
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Called from a future callback on the worker, run it in place
+            # rather than deadlocking on our own queue.
+            self._execute(kind, command, future)
+        else:
+            self._queue.put((priority, next(self._sequence), kind, command, future))
+        return future
+
+    def write(self, command: str, priority=PRIORITY_COMMAND):
+        return self.submit('write', command, priority).result()
+
+    def query(self, command: str, priority=PRIORITY_COMMAND):
+        return self.submit('query', command, priority).result()
+
+    def read(self, priority=PRIORITY_COMMAND):
+        return self.submit('read', None, priority).result()
+
+    def query_batch(self, commands, priority=PRIORITY_COMMAND):
+        # Sends the queries back to back as one job, each as soon as the reply
+        # to the last one is in (no min_gap between them). Returns the replies
+        # in order, None for any that failed. Holds the line for the whole
+        # batch, so keep it to things like the connect handshake.
+        return self.submit('batch', list(commands), priority).result()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=2.0):
+        # Stop after everything already queued has been sent
+        self._queue.put((_PRIORITY_STOP, next(self._sequence), 'stop', None, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            priority, sequence, kind, command, future = self._queue.get()
+            if kind == 'stop':
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._execute(kind, command, future)
+
+    def _execute(self, kind, command, future):
+        wait = self.min_gap - (monotonic() - self._last_transaction)
+        if wait > 0:
+            sleep(wait)
+        try:
+            if kind == 'write':
+                result = self.resource.write(command)
+            elif kind == 'query':
+                result = self.resource.query(command)
+            elif kind == 'batch':
+                result = []
+                for query in command:
+                    try:
+                        result.append(self.resource.query(query))
+                    except visa.VisaIOError:
+                        print('Laser did not answer {} during a batch read'.format(query))
+                        result.append(None)
+            else:
+                result = self.resource.read()
+        except BaseException as err:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+        finally:
+            self._last_transaction = monotonic()
+
+
 class CompexLaser:
 
-    def __init__(self, laser_id, visa_backend='@ni'):
+    def __init__(self, laser_id, visa_backend='@ni', resource=None, cache=True):
         # Create a visa resource manager (Will default to using NI Visa, but
         # you can pass other options like '@py' for the fully python VISA or
-        # '@sim' for a simulated backend that connects to dummy instruments)
-        self.resManager = visa.ResourceManager(visa_backend)
-        self.laserCodes = {}
-        with open('Laser_Codes.txt', 'rt') as csv_file:
-            for row in csv.reader(csv_file, delimiter='\t'):
-                self.laserCodes[row[0]] = row[1:]
-
-        try:
-            self.laser = self.resManager.open_resource(laser_id,
-                                                       write_termination='\r',
-                                                       read_termination='\r')
-        except NameError:
-            print(self.resManager.list_resources())
-            print("Could not connect to laser, check for instrument name \
-                  changes and make sure that the laser is plugged in. Note: \
-                  the available resource names are printed above.")
+        # '@sim' for a simulated backend that connects to dummy instruments).
+        # An already open pyvisa-like resource can be passed as resource
+        # instead (e.g. the CompexLaserSimulator from Laser_Simulator), in
+        # which case laser_id and visa_backend are ignored. cache=False turns
+        # off reuse of recent query replies (see QUERY_TTLS), the settings
+        # mirror (see LASER_SETTINGS) is always kept.
+        if resource is not None:
+            self.resManager = None
+            self.laser = resource
+        else:
+            self.resManager = visa.ResourceManager(visa_backend)
+            try:
+                self.laser = self.resManager.open_resource(laser_id,
+                                                           write_termination='\r',
+                                                           read_termination='\r')
+            except NameError:
+                print(self.resManager.list_resources())
+                print("Could not connect to laser, check for instrument name \
+                      changes and make sure that the laser is plugged in. Note: \
+                      the available resource names are printed above.")
             
         # Setup Class variables
-        self.op_delay = 0.01  # Delay for back to back serial ops
-        self.trigger_src = self.rd_trigger()
-        self.reprate = self.rd_reprate()
-        self.total_pulse_counter = self.rd_total_counter()
-        self.user_pulse_counter = self.rd_user_counter()
+        self.op_delay = 0.01  # Minimum gap for back to back serial ops
+        # All traffic to the laser goes through the command queue so that
+        # callers on different threads can't interleave on the serial line.
+        self.commands = LaserCommandQueue(self.laser, self.op_delay)
+        # Read-through cache of query replies: query string -> (monotonic() time sent, reply).
+        # Mirrored settings live here too and never expire.
+        self.cache_ttls = dict(QUERY_TTLS) if cache else {}
+        self.cache_ttls.update(dict.fromkeys(SETTING_QUERIES, TTL_FOREVER))
+        self._cache = {}
+        self._invalidated_at = {}  # query string -> monotonic() time it was last invalidated
+        self._cache_lock = threading.Lock()
+        self.connect_time = None  # Seconds the connect handshake took
+        self.total_pulse_counter = None
+        self.user_pulse_counter = None
+        self.handshake()
 
         # # Set the laser to energy constant mode to pull internal energy setting
         # curr_mode = self.rd_mode()
@@ -58,41 +215,166 @@ class CompexLaser:
 
     # Disconnect from the laser gracefully
     def disconnect(self):
+        self.commands.close()
         self.laser.close()
 
-    # Pass through methods for laser read, write, query through PyVisa
-
-    def write(self, command):
-        self.laser.write(command)
-
-    def read(self):
-        return self.laser.read()
-
-    def query(self, command):
-        return self.laser.query(command)
+    # Pass through methods for laser read, write, query through the command
+    # queue. Priority should be one of the PRIORITY_* values above. Queries
+    # listed in cache_ttls are answered from the cache while their last reply
+    # is younger than the TTL, writes drop the cached replies they affect.
+
+    def write(self, command, priority=PRIORITY_COMMAND):
+        self.invalidate_for_setter(command)
+        self.commands.write(command, priority)
+        # Again once the write has gone out, in case a query sent just before it refilled the cache
+        self.invalidate_for_setter(command)
+        self.mirror_setting(command)
+
+    def read(self, priority=PRIORITY_COMMAND):
+        return self.commands.read(priority)
+
+    def query(self, command, priority=PRIORITY_COMMAND, use_cache=True):
+        if '=' in command:
+            # A setter sent through query (e.g. from the terminal)
+            self.invalidate_for_setter(command)
+            return self.commands.query(command, priority)
+        ttl = self.cache_ttl(command)
+        if ttl is None:
+            return self.commands.query(command, priority)
+        if use_cache:
+            with self._cache_lock:
+                cached = self._cache.get(command)
+            if cached is not None and monotonic() - cached[0] < ttl:
+                return cached[1]
+        sent_at = monotonic()
+        reply = self.commands.query(command, priority)
+        with self._cache_lock:
+            # Not stored if a setter invalidated it while the query was in flight
+            if self._invalidated_at.get(command, -1.) < sent_at:
+                self._cache[command] = (sent_at, reply)
+        return reply
+
+    def cache_ttl(self, command):
+        # Seconds a reply to command can be reused, None if it isn't cached
+        ttl = self.cache_ttls.get(command)
+        if ttl == TTL_PULSE:
+            # Straight from the mirror, this mustn't go to the laser itself
+            with self._cache_lock:
+                reprate = self._cache.get('REPRATE?')
+            try:
+                return 1. / float(reprate[1])
+            except (TypeError, ValueError, ZeroDivisionError):
+                return None
+        return ttl
+
+    def mirror_setting(self, command: str):
+        # Records the value of a setting that has just been written
+        name, _, value = command.partition('=')
+        name, value = name.strip().upper(), value.strip().upper()
+        query = LASER_SETTINGS.get(name)
+        if query is None or name in SETTINGS_NOT_ECHOED and (SETTINGS_NOT_ECHOED[name] is None or
+                                                            value in SETTINGS_NOT_ECHOED[name]):
+            return
+        with self._cache_lock:
+            self._cache[query] = (monotonic(), value)
+
+    def handshake(self):
+        # Reads everything needed at connect (the mirrored settings, counters,
+        # identity and opmode) as one pipelined batch and fills the settings
+        # mirror and query cache with the replies. Returns the elapsed seconds.
+        queries = sorted(SETTING_QUERIES) + list(HANDSHAKE_QUERIES)
+        started = perf_counter()
+        sent_at = monotonic()
+        replies = self.commands.query_batch(queries)
+        self.connect_time = perf_counter() - started
+        replies = {query: reply for query, reply in zip(queries, replies) if reply is not None}
+        self.store_replies(replies, sent_at)
+        try:
+            self.total_pulse_counter = int(replies['TOTALCOUNTER?'])
+            self.user_pulse_counter = int(replies['COUNTER?'])
+        except (KeyError, ValueError):
+            print('Could not read the laser pulse counters at connect')
+        print('Laser handshake: {} of {} queries answered in {:.1f} ms ({:.1f} ms/query)'
+              .format(len(replies), len(queries), self.connect_time * 1000, self.connect_time * 1000 / len(queries)))
+        return self.connect_time
+
+    def read_settings(self, priority=PRIORITY_COMMAND):
+        # Reads every mirrored setting from the laser and returns {query: reply}.
+        # The queries are queued together but sent one by one, so a higher
+        # priority command can still get in between them.
+        sent_at = monotonic()
+        futures = {query: self.commands.submit('query', query, priority) for query in SETTING_QUERIES}
+        replies = {}
+        for query, future in futures.items():
+            try:
+                replies[query] = future.result()
+            except visa.VisaIOError:
+                print('Could not read laser setting {}'.format(query))
+        self.store_replies(replies, sent_at)
+        return replies
+
+    def store_replies(self, replies: dict, sent_at: float):
+        # Stores {query: reply} read at sent_at in the cache (and so the
+        # settings mirror), skipping uncached queries and any invalidated since
+        with self._cache_lock:
+            for query, reply in replies.items():
+                if query in self.cache_ttls and self._invalidated_at.get(query, -1.) < sent_at:
+                    self._cache[query] = (sent_at, reply)
+
+    def settings(self):
+        # Copy of the mirrored settings, {query: value}
+        with self._cache_lock:
+            return {query: self._cache[query][1] for query in SETTING_QUERIES if query in self._cache}
+
+    def check_settings(self, priority=PRIORITY_POLL):
+        # Re-reads the settings and returns {query: (mirrored value, laser value)}
+        # for any that had changed without going through write(), e.g. from
+        # the laser's keypad. The mirror is updated to the laser's values.
+        mirrored = self.settings()
+        actual = self.read_settings(priority)
+        drifted = {query: (mirrored[query], value) for query, value in actual.items()
+                   if query in mirrored and not same_setting(mirrored[query], value)}
+        for query, (was, now) in drifted.items():
+            print('Laser setting {} changed outside the program: {} -> {}'.format(query, was, now))
+        return drifted
+
+    def invalidate(self, *commands):
+        # Drops the cached replies to the given queries, or the whole cache if none are given
+        now = monotonic()
+        with self._cache_lock:
+            if not commands:
+                commands = list(self._cache)
+            for command in commands:
+                self._cache.pop(command, None)
+                self._invalidated_at[command] = now
+
+    def invalidate_for_setter(self, command: str):
+        name = command.split('=', 1)[0].strip().upper()
+        self.invalidate(name + '?', *SETTER_INVALIDATES.get(name, ()))
 
 # =============================================================================
 #     Operations Methods
 # =============================================================================
 
     def off(self):
-        # Stops laser operation
-        self.laser.write('OPMODE=OFF')
+        # Stops laser operation. Sent as a safety command so that it goes out
+        # ahead of any routine status polls already waiting in the queue.
+        self.write('OPMODE=OFF', priority=PRIORITY_SAFETY)
 
     def on(self):
         # Starts laser operation using set parameters, and a start delay of
         # 4.1s, this start delay allows the user to interrupt startup with the
         # off command.
-        self.laser.write('OPMODE=ON')
+        self.write('OPMODE=ON')
 
     def energy_cal(self):
         # Runs the laser's built in energy calibration method, will prompt for
         # a value measured with an external energy meter, and have a cancel
         # FIXME: Needs GUI Element work to allow for ext. energy reading input
-        self.laser.write("OPMODE=ENERGY CAL")
-        rdmode = self.laser.rd_opmode()
+        self.write("OPMODE=ENERGY CAL")
+        rdmode = self.rd_opmode()
         while rdmode != "OFF:7" and rdmode != "ENERGY CAL CONT":
-            rdmode = self.laser.rd_opmode()
+            rdmode = self.rd_opmode()
             sleep(0.2)
         if rdmode == "OFF:7":
             QInputDialog.getInt(self)
@@ -102,7 +384,7 @@ class CompexLaser:
         # RARE, HALOGEN, BUFFER, or INERT
         valid_line_names = ['RARE', 'HALOGEN', 'INERT']
         if line_name.upper() in valid_line_names:
-            self.laser.write('OPMODE=FLUSH %s LINE' % line_name.upper())
+            self.write('OPMODE=FLUSH %s LINE' % line_name.upper())
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -113,53 +395,53 @@ class CompexLaser:
         # Flushes(evacuates) the laser tube to allow for optics maintenance
         # FIXME: Needs a GUI element to complete the flush as there will be 2x
         # OPMODE=CONT inputs required
-        self.laser.write('OPMODE=FLUSHING')
+        self.write('OPMODE=FLUSHING')
 
     def halogen_inject(self):
         # Laser performs a halogen injection after a 3 minute waiting period
         # ONLY USED IF WE HAVE CHANGED GAS SOURCES AWAY FROM A PREMIX
-        self.laser.write('OPMODE=HI')
+        self.write('OPMODE=HI')
 
     def disable_low_light(self):
         # Disables the low light warning function. Low light function stops
         # laser operation if more than 30% of pulses within 10s are misses.
-        self.laser.write('OPMODE=LL OFF')
+        self.write('OPMODE=LL OFF')
 
     def fill_manual_inert(self):
         # Opens the inert valve for 10s to fill the laser tube with inert gas
         # note that this command will only be accepted if the laser is not
         # operating and the tube pressure is less than 3800 mbar.
-        self.laser.write('OPMODE=MANUAL FILL INERT')
+        self.write('OPMODE=MANUAL FILL INERT')
 
     def fill_new(self):
         # Begins the new fill procedure for the laser tube. No leak test unless
         # using a halogen source
-        self.laser.write('OPMODE=NEW FILL')
+        self.write('OPMODE=NEW FILL')
 
     def fill_passivation(self):
         # Starts the passivation fill procedure.
-        self.laser.write('OPMODE=PASSIVATION FILL')
+        self.write('OPMODE=PASSIVATION FILL')
 
     def fill_transport(self):
         # Starts a transport fill, which sets the tube up for safe transport.
-        self.laser.write('OPMODE=TRANSPORT FILL')
+        self.write('OPMODE=TRANSPORT FILL')
 
     def partial_gas_replacement(self):
         # Performs a partial gas replacement, only available when using a
         # halogen source.
-        self.laser.write('OPMODE=PGR')
+        self.write('OPMODE=PGR')
 
     def purge_line(self, line_name):
         # Purges the selected line (flushes/evacuates and fills with inert).
-        self.laser.write('OPMODE=PURGE %s LINE' % line_name.upper())
+        self.write('OPMODE=PURGE %s LINE' % line_name.upper())
 
     def purge_tube(self):
         # Purges the laser tube (flushes/evacuates and fills with inert).
-        self.laser.write('OPMODE=PURGE RESERVOIR')
+        self.write('OPMODE=PURGE RESERVOIR')
 
     def skip_warmup(self):
         # Sends command to override warmup and allow laser operation.
-        self.laser.write('OPMODE=SKIP')
+        self.write('OPMODE=SKIP')
 
 # =============================================================================
 #     Parameter Methods: Used to Set Operations Values
@@ -167,21 +449,21 @@ class CompexLaser:
 
     def set_buffer_press(self, mbar):  # Takes an int
         # Sets the partial pressure of gas connected to buffer line
-        self.laser.write('BUFFER=%s' % mbar)
+        self.write('BUFFER=%s' % mbar)
 
     def set_halogen_filter_cap(self, cap):
         # Provides a value for the halogen source capacity as a percentage,
         # 0 <= cap <= 120, this function also runs the set command.
-        self.laser.write('CAP.SET=%s' % cap)
-        self.laser.write('OPMODE=CAPACITY RESET')
+        self.write('CAP.SET=%s' % cap)
+        self.write('OPMODE=CAPACITY RESET')
 
     def set_charge_on_demand(self, is_charge_on_demand):
         # Sets the charge on demand mode for the laser. Note that if COD is
         # set as on, the laser will not accept reprates over 50Hz.
         if is_charge_on_demand is True:
-            self.laser.write('COD=ON')
+            self.write('COD=ON')
         elif is_charge_on_demand is False:
-            self.laser.write('COD=OFF')
+            self.write('COD=OFF')
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -191,9 +473,9 @@ class CompexLaser:
     def reset_counter(self):
         # Resets the user counter on the laser; Only available when the
         # laser is in off mode.
-        self.laser.write("COUNTER=RESET")
+        self.write("COUNTER=RESET")
         sleep(0.1)
-        counter = self.laser.query("COUNTER?")
+        counter = self.query("COUNTER?")
         if counter != '0':
             print("Counter reset failed. Counter value:", counter)
 
@@ -201,19 +483,19 @@ class CompexLaser:
         # Sets a countdown value, this switches the laser to external
         # triggering mode, and allows the laser to run until the remaining
         # counts reduces to 0. Can set 0 <= counts <= 65535.
-        self.laser.write('COUNTS=%s' % counts)
+        self.write('COUNTS=%s' % counts)
 
     def set_energy(self, mj):
         # In energy constant mode, this sets the target energy value.
         # Setting this value to 0 will reset the laser to the default
         # energy value as defined in the gas menu. Finally, this command
         # is used to set the energy value during energy calibration
-        self.laser.write('EGY=%s' % mj)
+        self.write('EGY=%s' % mj)
 
     def set_energy_range(self, pct):
         # Allows setting the limits for energy setting by percentage of
         # the factory limits. Range of 1 to 100.
-        self.laser.write('EGY RANGE=%s' % pct)
+        self.write('EGY RANGE=%s' % pct)
 
     def set_pulse_averaging(self, sample_pop):
         # Sets the number of pulses the laser will used to calculate an
@@ -221,7 +503,7 @@ class CompexLaser:
         # ignored. Valid values: 0, 1, 2, 4, 8, 16.
         valid_sample_pop = [0, 1, 2, 4, 8, 16]
         if sample_pop in valid_sample_pop:
-            self.laser.write('FILTER=%s' % sample_pop)
+            self.write('FILTER=%s' % sample_pop)
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -230,13 +512,13 @@ class CompexLaser:
 
     def reset_filter_contamination(self):
         # Resets the halogen filter capacity value in percent.
-        self.laser.write('FILTER CONTAMINATION=RESET')
+        self.write('FILTER CONTAMINATION=RESET')
 
     def set_gas_mode(self, mode):
         # Changes the laser between single gas and premix operating modes
         valid_gas_modes = ['SINGLE GASES', 'PREMIX']
         if mode.upper() in valid_gas_modes:
-            self.laser.write('GASMODE=%s' % mode)
+            self.write('GASMODE=%s' % mode)
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -245,12 +527,12 @@ class CompexLaser:
 
     def set_halogen_press(self, mbar):
         # Sets the partial pressure of gas connected to halogen line
-        self.laser.write('HALOGEN=%s' % mbar)
+        self.write('HALOGEN=%s' % mbar)
 
     def set_hv(self, hv):
         # Sets the voltage in HV constant mode
-        if self.laser.query('MODE?') == 'HV':
-            self.laser.write('HV=%s' % hv)
+        if self.query('MODE?') == 'HV':
+            self.write('HV=%s' % hv)
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -268,13 +550,13 @@ class CompexLaser:
 
     def set_inert_press(self, mbar):
         # Sets the partial pressure of gas connected to inert line
-        self.laser.write('INERT=%s' % mbar)
+        self.write('INERT=%s' % mbar)
 
     def set_menu(self, menu_num):
         # Sets the gas menu by number, probably shouldn't allow direct access
         # to this through the GUI, unless you are going to add a dropdown.
         if 1 <= menu_num <= 6:
-            self.laser.write('MENU=%s' % menu_num)
+            self.write('MENU=%s' % menu_num)
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -283,13 +565,13 @@ class CompexLaser:
 
     def reset_menu(self):
         # Resets the menu to the factory defaults
-        self.laser.write('MENU=RESET')
+        self.write('MENU=RESET')
 
     def set_mode(self, mode):
         # Sets the laser operating mode
         valid_modes = ['HV', 'EGY PGR', 'EGY NGR']
         if mode.upper() in valid_modes:
-            self.laser.write('MODE=%s' % mode.upper())
+            self.write('MODE=%s' % mode.upper())
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -298,20 +580,18 @@ class CompexLaser:
 
     def set_rare_press(self, mbar):
         # Sets the partial pressure of gas connected to rare line
-        self.laser.write('INERT=%s' % mbar)
+        self.write('INERT=%s' % mbar)
 
     def set_reprate(self, hz):
         # Sets the reprate for the laser
-        self.laser.write('REPRATE={}'.format(hz))
-        sleep(self.op_delay)
-        self.rd_reprate()
+        self.write('REPRATE={}'.format(hz))
 
     def set_roomtemp_hilow(self, rt):
         # Only for use with an HCl source as the source reaction is very temp
         # sensitive. Can be set to high (above 22C) or low (below 22C).
         valid_rt = ['HIGH', 'LOW']
         if rt.upper() in valid_rt:
-            self.laser.write('ROOMTEMP=%s' % rt.upper())
+            self.write('ROOMTEMP=%s' % rt.upper())
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -321,9 +601,9 @@ class CompexLaser:
 
     def set_timeout(self, timeout):
         if timeout is True:
-            self.laser.write('TIMEOUT=ON')
+            self.write('TIMEOUT=ON')
         elif timeout is False:
-            self.laser.write('TIMEOUT=OFF')
+            self.write('TIMEOUT=OFF')
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -334,9 +614,7 @@ class CompexLaser:
     def set_trigger(self, trigger):
         valid_trigger = ['INT', 'EXT']
         if trigger.upper() in valid_trigger:
-            self.laser.write('TRIGGER=%s' % trigger.upper())
-            sleep(self.op_delay)
-            self.rd_trigger()
+            self.write('TRIGGER=%s' % trigger.upper())
         else:
             try:
                 raise LaserOutOfRangeError()
@@ -351,110 +629,108 @@ class CompexLaser:
         # Provides the current pressure in the accumulator if there is a
         # halogen source installed. Will return 0 if there is no halogen
         # source installed.
-        return self.laser.query('ACCU?')
+        return self.query('ACCU?')
 
     def rd_buffer_press(self):
         # Reads the partial pressure of the buffer gas in mbar
-        return self.laser.query('BUFFER?')
+        return self.query('BUFFER?')
 
     def rd_halogen_source_capacity(self):
         # Reads the remaining halogen source capacity.
-        return self.laser.query('CAP.LEFT?')
+        return self.query('CAP.LEFT?')
 
     def rd_charge_on_demand(self):
         # Reads the charge on demand delay in microseconds.
         # Note: This value is soley determined by laser model.
-        return self.laser.query('COD?')
+        return self.query('COD?')
 
     def rd_user_counter(self):
         # Reads the current number of pulses accumulated since the last
         # user counter reset
-        self.user_pulse_counter = int(self.laser.query('COUNTER?'))
+        self.user_pulse_counter = int(self.query('COUNTER?'))
         return self.user_pulse_counter
 
     def rd_counts(self):
         # Reads the initial value of the countdown counter. Does
         # not return the number of pulses remaining.
-        return self.laser.query('COUNTS?')
+        return self.query('COUNTS?')
 
     def rd_energy(self):
         # Depending on operating mode: 1) Laser OFF: returns the preset/target
         # energy setting 2) Laser ON: displays the measured beam energy, if
         # polled again between trigger pulses, will return 0 3) During ENERGY
         # CAL: reads the momentary monitor reading (unitless)
-        return self.laser.query('EGY?')
+        return self.query('EGY?')
 
     def rd_energy_setting(self):
         # Reads the preset/target energy value for energy constant mode.
-        return self.laser.query('EGY SET?')
+        return self.query('EGY SET?')
 
     def rd_energy_range(self):
         # Reads the energy tolerance range in percent.
-        return self.laser.query('EGY RANGE?')
+        return self.query('EGY RANGE?')
 
     def rd_pulse_averaging(self):
         # Reads the number of pulses being used to calculate a mean value
         # for the beam energy. A reading of 0 means the value has been set
         # automatically, based on the reprate.
-        return self.laser.query('FILTER?')
+        return self.query('FILTER?')
 
     def rd_filter_contamination(self):
         # Reads the capacity of the halogen filter in percent
-        return self.laser.query('FILTER CONTAMINATION?')
+        return self.query('FILTER CONTAMINATION?')
 
     def rd_gas_mode(self):
         # Reads the current gas mode setting.
-        return self.laser.query('GASMODE?')
+        return self.query('GASMODE?')
 
     def rd_halogen_press(self):
         # Reads the current partial pressure of the halogen gas in mbar.
-        return self.laser.query('HALOGEN?')
+        return self.query('HALOGEN?')
 
     def rd_hv(self):
         # Reads the charging voltage in HV mode.
-        return self.laser.query('HV?')
+        return self.query('HV?')
 
     def rd_inert_press(self):
         # Reads the current partial pressure of the inert gas.
-        return self.laser.query('INERT?')
+        return self.query('INERT?')
 
     def rd_interlock(self):
         # Reads a comma separated list of activated interlocks. Returns NONE
         # if no interlocks are active.
         # FIXME: Figure out of the Estop is working and why it doesnt seem
         # to throw an interlock
-        return self.laser.query('INTERLOCK?')
+        return self.query('INTERLOCK?')
 
     def rd_leak_rate(self):
         # For a fluorine source, reads the leak rate of the tube as measured
         # during the new fill procedure. Units of [mbar/2min]
-        return self.laser.query('LEAKRATE?')
+        return self.query('LEAKRATE?')
 
     def rd_menu(self):
         # Reads the current gas menu number, wavelength, and gas mixture as a
         # a tuple.
-        return str.split(self.laser.query('MENU?'), ' ')
+        return str.split(self.query('MENU?'), ' ')
 
     def rd_mode(self):
         # Reads the current laser running mode: HV, EGY PGR, or EGY NGR.
-        return self.laser.query('MODE?')
+        return self.query('MODE?')
 
     def rd_opmode(self):
-        # Reads the laser opmode state. This value can be parsed to give
-        # insight into error states, operation health, etc.
-        # FIXME: Should probably set up a parser so that any error
-        # states are more readable
-        return self.laser.query('OPMODE?')
+        # Reads the laser opmode state as the raw reply string. Use
+        # interpret_opmode to get it decoded into state, severity etc.
+        return self.query('OPMODE?')
 
     def rd_is_power_stabilized(self):
         # Provides a boolean value for power stabilization state.
-        if self.laser.query('POWER STABILIZATION ACHIEVED?') == 'YES':
+        if self.query('POWER STABILIZATION ACHIEVED?') == 'YES':
             return True
         return False
 
     def rd_tube_press(self):
         # Reads the current tube pressure in mbar.
-        return self.laser.query('PRESSURE?')
+        return self.query('PRESSURE?')
 
     def rd_pulse_diff(self):
         # Returns the delta of trigger pulses to pulses received by the
@@ -462,52 +738,66 @@ class CompexLaser:
         # dp = (# of ext trigger pulses) - (# of pulses measured)
         # FIXME: USE THIS AS A CHECK AFTER DEP PROGRAM RUNS TO MAKE SURE THAT
         # WE ARE GETTING THE CORRECT NUMBER OF PULSES.
-        return self.laser.query('PULSE DIFF?')
+        return self.query('PULSE DIFF?')
 
     def rd_rare_press(self):
         # Reads the partial pressure of the Rare in mbar.
-        return self.laser.query('RARE?')
+        return self.query('RARE?')
 
     def rd_reprate(self):
         # Reads the current reprate status.
-        self.reprate = int(self.laser.query('REPRATE?'))
-        return self.reprate
+        return int(float(self.query('REPRATE?')))
+
+    @property
+    def reprate(self):
+        return self.rd_reprate()
 
     def rd_roomtemp_hilow(self):
         # Only with a halogen source: Room temp value (can be High or Low), if
         # no halogen source, returns high.
-        return self.laser.query('ROOMTEMP?')
+        return self.query('ROOMTEMP?')
 
     def rd_f_source_temp(self):
         # Reads the temperature in fluorine source, returns 0 if there is no
         # fluorine source is attached.
-        return self.laser.query('TEMP?')
+        return self.query('TEMP?')
 
     def rd_is_timeout(self):
         # Returns a boolean for if timeout is enabled.
-        if self.laser.query('TIMEOUT?') == 'ON':
+        if self.query('TIMEOUT?') == 'ON':
             return True
         return False
 
     def rd_total_counter(self):
         # Reads the total counter number of pulses for the laser. Note this
         # value cannot be reset and is for the lifetime of the laser cabinet.
-        self.total_pulse_counter = int(self.laser.query('TOTALCOUNTER?'))
+        self.total_pulse_counter = int(self.query('TOTALCOUNTER?'))
         return self.total_pulse_counter
 
     def rd_trigger(self):
         # Reads the current laser triggering mode. Returns: INT or EXT.
-        self.trigger_src = self.laser.query('TRIGGER?')
-        return self.trigger_src
+        return self.query('TRIGGER?')
+
+    @property
+    def trigger_src(self):
+        return self.rd_trigger()
 
     def rd_laser_model(self):
         # Reads the laser model.
-        return self.laser.query('TYPE OF LASER?')
+        return self.query('TYPE OF LASER?')
 
     def rd_version(self):
         # Reads the current laser software version
-        return self.laser.query('VERSION?')
+        return self.query('VERSION?')
 
     def interpret_opmode(self):
-        current_opmode = self.rd_opmode()
-        return current_opmode, self.laserCodes[current_opmode]
+        # Reads the opmode and returns it decoded as a LaserOpmode (see Laser_Opmode)
+        return decode_opmode(self.rd_opmode())
+
+
+def same_setting(a: str, b: str):
+    # Setting values compare as numbers where they are numbers ('10' == '10.0')
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return str(a).strip().upper() == str(b).strip().upper()
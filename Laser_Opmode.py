@@ -0,0 +1,150 @@
+import csv
+from enum import Enum, IntEnum
+from functools import lru_cache
+
+
+# Decodes the laser's OPMODE? replies. They look like 'OFF:21' (state and a
+# numbered message), 'ON', 'OFF,WAIT' (start delay), or the name of a gas
+# procedure with an optional stage and message: 'NEW FILL', 'NEW FILL, EVAC',
+# 'NEW FILL:3'. Every distinct reply is decoded once into a read only
+# LaserOpmode and shared after that, so classifying the current opmode is a
+# dictionary lookup wherever it's done.
+
+LASER_CODES_FILE = 'Laser_Codes.txt'
+
+
+class OpmodeState(Enum):
+    OFF = 'off'
+    STARTING = 'starting'      # OFF,WAIT: the start delay after OPMODE=ON
+    ON = 'on'
+    PROCEDURE = 'procedure'    # Gas handling, energy calibration etc.
+    UNKNOWN = 'unknown'        # A reply that couldn't be decoded
+
+
+class Severity(IntEnum):
+    OK = 0
+    INFO = 1       # Expected on the way to lasing (warm-up, timeout)
+    WARNING = 2    # The laser can carry on but needs attention soon
+    FAULT = 3      # The laser stopped or can't run until something is fixed
+
+
+# Severity of the numbered messages, by state. Anything not listed for a
+# state is a fault, except message 0 which is always OK.
+OFF_SEVERITIES = {6: Severity.INFO, 21: Severity.INFO, 31: Severity.INFO, 8: Severity.WARNING}
+ON_SEVERITIES = {2: Severity.WARNING, 3: Severity.WARNING, 8: Severity.WARNING, 34: Severity.INFO,
+                 36: Severity.INFO, 37: Severity.WARNING, 40: Severity.WARNING}
+
+OFF_WARMUP = 21
+OFF_TIMEOUT = 31
+
+# Procedures the laser reports by name, on top of the ones listed in
+# Laser_Codes.txt. These are the OPMODE= commands CompexLaser sends for gas
+# handling and calibration, any other name is treated as an unknown reply.
+LINE_NAMES = ('RARE', 'HALOGEN', 'BUFFER', 'INERT')
+PROCEDURES = frozenset(('NEW FILL', 'PASSIVATION FILL', 'SAFETY FILL', 'TRANSPORT FILL', 'MANUAL FILL INERT',
+                        'PURGE RESERVOIR', 'FLUSHING', 'FLUSHING LEAKTEST', 'FLUSHING LEAKTEST CONT',
+                        'ENERGY CAL', 'ENERGY CAL CONT', 'HI', 'PGR', 'CAPACITY RESET') +
+                       tuple('FLUSH {} LINE'.format(line) for line in LINE_NAMES) +
+                       tuple('PURGE {} LINE'.format(line) for line in LINE_NAMES))
+
+
+class LaserOpmode:
+    # One decoded OPMODE? reply. Instances come from decode_opmode() and are
+    # shared between callers, so they are read only.
+    __slots__ = ('raw', 'state', 'procedure', 'stage', 'code', 'message', 'severity')
+
+    def __init__(self, raw, state, procedure, stage, code, message, severity):
+        object.__setattr__(self, 'raw', raw)                # The reply as the laser sent it, None if it didn't reply
+        object.__setattr__(self, 'state', state)            # OpmodeState
+        object.__setattr__(self, 'procedure', procedure)    # e.g. 'NEW FILL', None unless state is PROCEDURE
+        object.__setattr__(self, 'stage', stage)            # e.g. 'EVAC' from 'NEW FILL, EVAC', None if there isn't one
+        object.__setattr__(self, 'code', code)              # Message number after ':', None if there isn't one
+        object.__setattr__(self, 'message', message)        # Text from Laser_Codes.txt, '' if it isn't listed
+        object.__setattr__(self, 'severity', severity)      # Severity
+
+    def __setattr__(self, key, value):
+        raise AttributeError('LaserOpmode is read only')
+
+    @property
+    def is_fault(self):
+        return self.severity == Severity.FAULT
+
+    @property
+    def is_running(self):
+        # Lasing, or about to once the start delay is over (OPMODE=OFF stops either)
+        return self.state in (OpmodeState.ON, OpmodeState.STARTING)
+
+    @property
+    def is_ready(self):
+        # Off with nothing pending, the laser can be started
+        return self.state == OpmodeState.OFF and not self.code
+
+    @property
+    def is_warming_up(self):
+        return self.state == OpmodeState.OFF and self.code == OFF_WARMUP
+
+    @property
+    def is_timed_out(self):
+        return self.state == OpmodeState.OFF and self.code == OFF_TIMEOUT
+
+    def __str__(self):
+        return self.raw if self.raw is not None else ''
+
+    def __repr__(self):
+        return 'LaserOpmode(raw={!r}, state={}, procedure={!r}, stage={!r}, code={}, severity={})'.format(
+            self.raw, self.state.name, self.procedure, self.stage, self.code, self.severity.name)
+
+
+def split_opmode(raw: str):
+    # 'NEW FILL, EVAC:3' -> ('NEW FILL', 'EVAC', 3), codes that aren't numbers are left in the name
+    name, code = raw.strip().upper(), None
+    head, sep, tail = name.rpartition(':')
+    if sep and tail.strip().isdigit():
+        name, code = head.strip(), int(tail)
+    base, sep, stage = name.partition(',')
+    return base.strip(), stage.strip() if sep else None, code
+
+
+@lru_cache(maxsize=None)
+def opmode_messages(path=LASER_CODES_FILE):
+    # {(name, stage, code): message} from the tab separated Laser_Codes.txt, read once
+    messages = {}
+    with open(path, 'rt') as csv_file:
+        for row in csv.reader(csv_file, delimiter='\t'):
+            if row:
+                messages[split_opmode(row[0])] = row[1].strip() if len(row) > 1 else ''
+    return messages
+
+
+@lru_cache(maxsize=None)
+def known_procedures(path=LASER_CODES_FILE):
+    # Procedure names from Laser_Codes.txt along with PROCEDURES
+    return PROCEDURES.union(name for name, stage, code in opmode_messages(path) if name not in ('OFF', 'ON'))
+
+
+@lru_cache(maxsize=256)
+def decode_opmode(raw: str):
+    # Returns the LaserOpmode for an OPMODE? reply, unknown replies decode to a fault rather than raising
+    if raw is None:
+        # The query failed (e.g. within a batch)
+        return LaserOpmode(raw, OpmodeState.UNKNOWN, None, None, None, 'No opmode reply', Severity.FAULT)
+    base, stage, code = split_opmode(raw)
+    message = opmode_messages().get((base, stage, code), '')
+    procedure = None
+    if base == 'OFF' and stage == 'WAIT':
+        state, stage = OpmodeState.STARTING, None
+        severity = Severity.OK
+    elif base == 'OFF' and stage is None:
+        state = OpmodeState.OFF
+        severity = OFF_SEVERITIES.get(code, Severity.FAULT) if code else Severity.OK
+    elif base == 'ON' and stage is None:
+        state = OpmodeState.ON
+        severity = ON_SEVERITIES.get(code, Severity.FAULT) if code else Severity.OK
+    elif base in known_procedures():
+        state, procedure = OpmodeState.PROCEDURE, base
+        # Numbered messages during a procedure are errors (no gas flow, leak)
+        severity = Severity.FAULT if code else Severity.OK
+    else:
+        state, stage, code, severity = OpmodeState.UNKNOWN, None, None, Severity.FAULT
+        message = 'Unrecognised opmode {!r}'.format(raw)
+    return LaserOpmode(raw, state, procedure, stage, code, message, severity)
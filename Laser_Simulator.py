@@ -0,0 +1,270 @@
+import random
+import threading
+from collections import deque
+from time import monotonic, sleep
+from pyvisa import constants
+from pyvisa.errors import VisaIOError
+
+
+# Stateful stand-in for the Compex laser. Where laser.yaml (pyvisa-sim) only
+# answers with static values, this simulator walks through the opmode sequences
+# the GUI watches for (warm-up OFF:21, the NEW FILL stages, timeout OFF:31),
+# counts pulses while the laser is on and lets the gas pressures drift, with a
+# configurable delay on every query. It behaves like an open pyvisa resource so
+# it can be handed straight to CompexLaser, e.g.
+#     laser = CompexLaser('simulated', resource=CompexLaserSimulator(time_scale=10))
+# Simulated time is wall time multiplied by time_scale, so long procedures (the
+# 8 minute warm-up, a new fill) can be run through quickly.
+
+
+class CompexLaserSimulator:
+    # Seconds (simulated) spent in each stage of a new fill, in order
+    new_fill_stages = (('NEW FILL', 2.),
+                       ('NEW FILL, EVAC', 60.),
+                       ('NEW FILL, WAIT', 120.),
+                       ('NEW FILL, FILL', 60.))
+
+    # Procedures without modelled stages just report their name for a while
+    procedure_time = 30.
+
+    def __init__(self, time_scale=1., latency=0.02, query_latency=None, warmup_time=480., start_delay=4.1,
+                 timeout_time=60., fill_pressure=3300., seed=None):
+        self.time_scale = time_scale
+        # Real seconds per query, with per command overrides e.g. {'EGY?': 0.05}
+        self.latency = latency
+        self.query_latency = dict(query_latency) if query_latency is not None else {}
+        self.warmup_time = warmup_time
+        self.start_delay = start_delay    # OFF,WAIT period after OPMODE=ON
+        self.timeout_time = timeout_time  # Seconds without a trigger before OFF:31
+        self.fill_pressure = fill_pressure
+        self.gas_flow = True              # Set False to get a NEW FILL:3 during filling
+        self.timeout = 2000               # pyvisa style, ms
+        self.write_termination = '\r'
+        self.read_termination = '\r'
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._responses = deque()
+        self._wall_start = monotonic()
+        self._last_update = 0.
+
+        # Laser state, all times are simulated seconds since power on
+        self.opmode = 'OFF:21'
+        self._opmode_since = 0.
+        self._procedure = None            # (name, stage index) while a gas procedure runs
+        self._last_trigger = 0.
+        self._pulse_fraction = 0.
+        self.settings = {'EGY': 200, 'HV': 18.0, 'REPRATE': 5, 'TRIGGER': 'INT', 'MODE': 'HV', 'TIMEOUT': 'ON',
+                         'COUNTS': 0, 'EGY RANGE': 100, 'FILTER': 0, 'GASMODE': 'PREMIX', 'ROOMTEMP': 'HIGH',
+                         'COD': 'OFF', 'MENU': 1, 'CAP.SET': 100, 'BUFFER': 3120, 'HALOGEN': 80,
+                         'INERT': 0, 'RARE': 100}
+        self.user_counter = 0
+        self.total_counter = 12000000
+        self.tube_pressure = fill_pressure
+        self.filter_contamination = 12.
+
+        self.queries_answered = 0
+
+    # ---- pyvisa resource interface ----
+
+    def write(self, command: str):
+        with self._lock:
+            self._update()
+            command = command.strip()
+            if command.endswith('?'):
+                self._responses.append(self._answer(command))
+            else:
+                self._set(command)
+        return len(command)
+
+    def read(self):
+        with self._lock:
+            response = self._responses.popleft() if self._responses else None
+        if response is None:
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        return response
+
+    def query(self, command: str):
+        command = command.strip()
+        sleep(self.query_latency.get(command, self.latency))
+        with self._lock:
+            self._update()
+            response = self._answer(command)
+            self.queries_answered += 1
+        if response is None:
+            # The laser doesn't answer unknown queries, pyvisa would time out
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        return response
+
+    def close(self):
+        pass
+
+    # ---- Test hooks ----
+
+    def now(self):
+        # Simulated seconds since power on
+        return (monotonic() - self._wall_start) * self.time_scale
+
+    def external_pulses(self, count: int):
+        # Pulses arriving on the external trigger input (e.g. from the Arduino)
+        with self._lock:
+            self._update()
+            if self.opmode == 'ON' and self.settings['TRIGGER'] == 'EXT':
+                self._fire(count)
+                self._last_trigger = self.now()
+
+    # ---- State ----
+
+    def _set_opmode(self, opmode, now):
+        self.opmode = opmode
+        self._opmode_since = now
+
+    def _update(self):
+        # Brings the state forward to the current simulated time
+        now = self.now()
+        dt = now - self._last_update
+        self._last_update = now
+        if dt <= 0:
+            return
+        since = now - self._opmode_since
+
+        if self.opmode == 'OFF:21' and now >= self.warmup_time:
+            self._set_opmode('OFF:0', self.warmup_time)
+        elif self.opmode == 'OFF,WAIT' and since >= self.start_delay:
+            self._set_opmode('ON', self._opmode_since + self.start_delay)
+            self._last_trigger = self._opmode_since
+        elif self.opmode == 'ON':
+            if self.settings['TRIGGER'] == 'INT':
+                self._pulse_fraction += dt * int(self.settings['REPRATE'])
+                pulses = int(self._pulse_fraction)
+                self._pulse_fraction -= pulses
+                self._fire(pulses)
+                self._last_trigger = now
+            elif self.settings['TIMEOUT'] == 'ON' and now - self._last_trigger >= self.timeout_time:
+                self._set_opmode('OFF:31', self._last_trigger + self.timeout_time)
+        elif self._procedure is not None:
+            self._update_procedure(now, dt)
+
+        # Slow leak towards atmosphere when nothing is happening
+        if self._procedure is None:
+            self.tube_pressure -= 0.0005 * dt
+
+    def _fire(self, pulses):
+        self.user_counter += pulses
+        self.total_counter += pulses
+        # Halogen is consumed a little with every shot
+        self.tube_pressure -= 0.0002 * pulses
+        self.filter_contamination = min(100., self.filter_contamination + 1e-6 * pulses)
+
+    def _update_procedure(self, now, dt):
+        name, stage = self._procedure
+        since = now - self._opmode_since
+        if name != 'NEW FILL':
+            if since >= self.procedure_time:
+                self._procedure = None
+                self._set_opmode('OFF:0', now)
+            return
+
+        if self.opmode == 'NEW FILL:3':
+            if self.gas_flow:
+                self._set_opmode('NEW FILL, FILL', now)
+            return
+
+        stage_name, duration = self.new_fill_stages[stage]
+        if stage_name == 'NEW FILL, EVAC':
+            self.tube_pressure = max(5., self.tube_pressure - dt * self.fill_pressure / duration)
+        elif stage_name == 'NEW FILL, FILL':
+            if not self.gas_flow:
+                self._set_opmode('NEW FILL:3', now)
+                return
+            self.tube_pressure = min(self.fill_pressure, self.tube_pressure + dt * self.fill_pressure / duration)
+            if self.tube_pressure >= self.fill_pressure:
+                self._procedure = None
+                self.filter_contamination = 0.
+                self._set_opmode('OFF:0', now)
+                return
+
+        if since >= duration and stage_name != 'NEW FILL, FILL':
+            self._procedure = (name, stage + 1)
+            self._set_opmode(self.new_fill_stages[stage + 1][0], now)
+
+    def _set(self, command):
+        if '=' not in command:
+            return
+        key, value = command.split('=', 1)
+        now = self.now()
+        if key == 'OPMODE':
+            self._set_operating_mode(value, now)
+        elif key == 'COUNTER' and value == 'RESET':
+            if not self.opmode.startswith('ON'):
+                self.user_counter = 0
+        elif key == 'FILTER CONTAMINATION' and value == 'RESET':
+            self.filter_contamination = 0.
+        elif key in self.settings:
+            current = self.settings[key]
+            try:
+                self.settings[key] = type(current)(value) if not isinstance(current, str) else value
+            except ValueError:
+                pass
+
+    def _set_operating_mode(self, value, now):
+        if value == 'OFF':
+            self._procedure = None
+            if self.opmode != 'OFF:21':
+                self._set_opmode('OFF:0', now)
+        elif value == 'ON':
+            if self.opmode in ('OFF:0', 'OFF:31', 'OFF'):
+                self._set_opmode('OFF,WAIT', now)
+        elif value == 'SKIP':
+            if self.opmode == 'OFF:21':
+                self._set_opmode('OFF:0', now)
+        elif value == 'CONT':
+            pass
+        elif self.opmode in ('OFF:0', 'OFF:31', 'OFF'):
+            # Gas handling procedures only start from off
+            self._procedure = (value, 0)
+            self._set_opmode(value, now)
+
+    def _answer(self, command):
+        # Returns the response string, or None for queries the laser doesn't know
+        key = command[:-1]
+        on = self.opmode == 'ON'
+        if key == 'OPMODE':
+            return self.opmode
+        if key == 'EGY':
+            if on:
+                # Measured value scatters around the setpoint
+                return '{:d}'.format(int(self._random.gauss(self.settings['EGY'], 0.02 * self.settings['EGY'])))
+            return '{:d}'.format(self.settings['EGY'])
+        if key == 'HV':
+            return '{:.1f}'.format(self.settings['HV'])
+        if key == 'PRESSURE':
+            return '{:d}'.format(int(self.tube_pressure))
+        if key == 'COUNTER':
+            return '{:d}'.format(self.user_counter)
+        if key == 'TOTALCOUNTER':
+            return '{:d}'.format(self.total_counter)
+        if key == 'FILTER CONTAMINATION':
+            return '{:d}'.format(int(self.filter_contamination))
+        if key == 'EGY SET':
+            return '{:d}'.format(self.settings['EGY'])
+        if key == 'MENU':
+            return '{} 248 KrF'.format(self.settings['MENU'])
+        if key == 'VERSION':
+            return 'v4.82'
+        if key == 'TYPE OF LASER':
+            return 'COMPEX 205'
+        if key == 'INTERLOCK':
+            return 'NONE'
+        if key == 'POWER STABILIZATION ACHIEVED':
+            return 'YES' if on else 'NO'
+        if key == 'COD STATE':
+            return self.settings['COD']
+        if key in ('ACCU', 'CAP.LEFT', 'COD', 'PULSE DIFF', 'TEMP'):
+            return '0'
+        if key == 'LEAKRATE':
+            return '0.5'
+        if key in self.settings:
+            value = self.settings[key]
+            return '{:.1f}'.format(value) if isinstance(value, float) else str(value)
+        return None
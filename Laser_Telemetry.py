@@ -0,0 +1,150 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+from pyvisa.errors import VisaIOError
+from types import MappingProxyType
+from time import monotonic, time
+import threading
+import Global_Values as Global
+from Laser_Hardware import PRIORITY_POLL
+from Laser_Opmode import decode_opmode
+
+
+class LaserStatusSnapshot:
+    # Immutable, timestamped copy of the most recent laser readings. Widgets
+    # read from one of these instead of going to the serial line themselves.
+    __slots__ = ('timestamp', 'values')
+
+    def __init__(self, timestamp: float, values: dict):
+        object.__setattr__(self, 'timestamp', timestamp)
+        object.__setattr__(self, 'values', MappingProxyType(dict(values)))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('LaserStatusSnapshot is read only')
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def age(self):
+        # Seconds since the snapshot was published
+        return time() - self.timestamp
+
+    def __repr__(self):
+        return 'LaserStatusSnapshot(timestamp={}, values={})'.format(self.timestamp, dict(self.values))
+
+
+class LaserTelemetry(QObject):
+    # Emitted from the poller thread every time a new snapshot is published,
+    # connections made from the GUI thread will be queued automatically.
+    status_updated = pyqtSignal(object)
+    # Emitted from the poller thread with (previous, current) LaserOpmode when
+    # the opmode reply changes, e.g. OFF:21 -> OFF:0 or NEW FILL, EVAC ->
+    # NEW FILL, WAIT. previous is None for the first reading. Consumers that
+    # wait on the laser's state should connect here instead of polling OPMODE?.
+    opmode_changed = pyqtSignal(object, object)
+
+    # Default queries: name -> (laser query, minimum seconds between polls).
+    # A period of 0 means the query is read on every poll cycle.
+    default_queries = {'energy': ('EGY?', 0),
+                       'hv': ('HV?', 0),
+                       'tube_press': ('PRESSURE?', 1.0),
+                       'opmode': ('OPMODE?', 1.0)}
+
+    def __init__(self, laser, queries=None, interval=Global.TELEMETRY_INTERVAL,
+                 settings_check_interval=Global.LASER_SETTINGS_CHECK_INTERVAL):
+        super().__init__()
+        # The poller is the only thing that reads routine status values from
+        # the laser, everything else should read from the published snapshot.
+        self.laser = laser
+        if queries is None:
+            queries = self.default_queries
+        self.queries = dict(queries)
+        self.interval = interval
+        # The laser's settings are mirrored in memory, they are only read back
+        # this often to catch changes made at the laser itself. None to never check.
+        self.settings_check_interval = settings_check_interval
+        self._last_settings_check = monotonic()
+
+        self._last_polled = {name: None for name in self.queries}
+        self._snapshot = LaserStatusSnapshot(time(), {})
+        self._opmode = None  # Decoded opmode from the last poll that read it
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        # Reference swaps are atomic so there is no need to lock for readers
+        return self._snapshot
+
+    def opmode(self):
+        # Most recent decoded opmode (a LaserOpmode), None until it has been read
+        return self._opmode
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._poll_loop, name='LaserTelemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def set_query(self, name: str, command: str, period=0.):
+        # Queries can be added or replaced while the poller is running, the
+        # change takes effect on the next poll cycle.
+        queries = dict(self.queries)
+        queries[name] = (command, period)
+        self._last_polled[name] = None
+        self.queries = queries
+
+    def remove_query(self, name: str):
+        queries = dict(self.queries)
+        queries.pop(name, None)
+        self.queries = queries
+
+    def poll_once(self):
+        # Read every query that is due and publish a new snapshot. Values that
+        # are not due (or fail to read) carry over from the previous snapshot.
+        now = monotonic()
+        values = dict(self._snapshot.values)
+        for name, (command, period) in self.queries.items():
+            last = self._last_polled.get(name)
+            if last is not None and now - last < period:
+                continue
+            try:
+                # Always goes to the laser, the reply refreshes the query cache for everyone else
+                values[name] = self.laser.query(command, priority=PRIORITY_POLL, use_cache=False)
+                self._last_polled[name] = now
+            except VisaIOError:
+                print('Error reading {} ({}) for laser telemetry.'.format(name, command))
+
+        if self.settings_check_interval is not None and now - self._last_settings_check >= self.settings_check_interval:
+            self._last_settings_check = now
+            self.laser.check_settings(priority=PRIORITY_POLL)
+
+        self._snapshot = LaserStatusSnapshot(time(), values)
+        self.status_updated.emit(self._snapshot)
+
+        if 'opmode' in values:
+            opmode = decode_opmode(values['opmode'])
+            if self._opmode is None or opmode.raw != self._opmode.raw:
+                previous, self._opmode = self._opmode, opmode
+                self.opmode_changed.emit(previous, opmode)
+        return self._snapshot
+
+    def _poll_loop(self):
+        while not self._stop_event.is_set():
+            started = monotonic()
+            self.poll_once()
+            # Wait out the remainder of the interval, returns early on stop
+            self._stop_event.wait(max(0., self.interval - (monotonic() - started)))
@@ -0,0 +1,200 @@
+from PyQt5.QtCore import Qt
+from time import time
+import threading
+import os
+import numpy as np
+import Global_Values as Global
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# Columns of a pulse log, one row is written every time the laser telemetry or
+# the arduino status stream publishes. Values from the other source are carried
+# over from its last update so every row is a complete picture at that time.
+LOG_DTYPE = np.dtype([('time', 'f8'),           # time.time() of the update
+                      ('step', 'i4'),           # Deposition step index, -1 outside of a step
+                      ('pulses', 'i4'),         # Arduino pulse counter for the current goal
+                      ('energy', 'f4'),         # mJ
+                      ('hv', 'f4'),             # kV
+                      ('tube_press', 'f4'),     # mbar
+                      ('sub_position', 'i4'),   # steps
+                      ('target_position', 'i4')])  # steps
+
+# Laser telemetry names that are logged, see LaserTelemetry.default_queries
+LASER_FIELDS = ('energy', 'hv', 'tube_press')
+
+
+class PulseLogger:
+    # Records laser and motor telemetry through a deposition. Updates are copied
+    # into a preallocated numpy ring buffer on whatever thread the telemetry
+    # source publishes from (nothing is allocated or written to disk there), and
+    # a background thread flushes the new rows as chunk files: numbered .npy
+    # files in the run's directory, or datasets in a single run.h5 if h5py is
+    # installed. If the flusher falls a whole buffer behind the oldest rows are
+    # overwritten and counted in dropped.
+
+    def __init__(self, laser_telemetry=None, arduino=None, capacity=Global.PULSE_LOG_CAPACITY,
+                 flush_interval=Global.PULSE_LOG_FLUSH_INTERVAL, use_hdf5=True):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.use_hdf5 = use_hdf5 and h5py is not None
+        self.path = None  # Directory of the run being logged, None when not logging
+        self.dropped = 0
+
+        self._buffer = np.zeros(capacity, dtype=LOG_DTYPE)
+        self._row = np.zeros((), dtype=LOG_DTYPE)  # Latest values from every source
+        self._row['step'] = -1
+        for name in LASER_FIELDS:
+            self._row[name] = np.nan
+        self._written = 0  # Rows ever written to the buffer
+        self._flushed = 0  # Rows ever flushed (or dropped)
+        self._chunk = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        # Direct connections so the rows are recorded on the publishing threads, not queued onto the GUI thread
+        if laser_telemetry is not None:
+            laser_telemetry.status_updated.connect(self.on_laser_status, Qt.DirectConnection)
+        if arduino is not None:
+            arduino.status_updated.connect(self.on_arduino_status, Qt.DirectConnection)
+
+    def is_logging(self):
+        return self.path is not None
+
+    def start(self, name: str, directory=Global.PULSE_LOG_DIR):
+        # Starts logging to directory/name. Starting again with the same name (resuming a run) carries on after the
+        # chunks already there.
+        self.stop()
+        path = os.path.join(directory, name)
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._flushed = self._written
+            self.dropped = 0
+        self._chunk = len(chunk_names(path))
+        if self.use_hdf5:
+            with h5py.File(os.path.join(path, 'run.h5'), 'a') as h5_file:
+                self._chunk = max(self._chunk, len(h5_file.keys()))
+        self.path = path
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name='PulseLogger', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        # Stops logging, the rows still in the buffer are flushed first
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join(timeout)
+            self._thread = None
+        self.path = None
+
+    def set_step(self, step_index):
+        with self._lock:
+            self._row['step'] = -1 if step_index is None else step_index
+
+    def on_laser_status(self, snapshot):
+        if self.path is None:
+            return
+        with self._lock:
+            for name in LASER_FIELDS:
+                self._row[name] = parse_float(snapshot.get(name))
+            # Stamped here rather than with snapshot.timestamp (taken before the lock) so rows stay in time order
+            self._row['time'] = time()
+            self._append()
+
+    def on_arduino_status(self, status):
+        if self.path is None:
+            return
+        with self._lock:
+            self._row['pulses'] = status.laser_pulses
+            self._row['sub_position'] = status.sub_position
+            self._row['target_position'] = status.target_position
+            self._row['time'] = time()
+            self._append()
+
+    def _append(self):
+        # Called with the lock held
+        self._buffer[self._written % self.capacity] = self._row
+        self._written += 1
+        if self._written - self._flushed > self.capacity:
+            self._flushed += 1
+            self.dropped += 1
+
+    def _take_new_rows(self):
+        with self._lock:
+            start, stop = self._flushed, self._written
+            self._flushed = stop
+            if start == stop:
+                return None
+            first, last = start % self.capacity, stop % self.capacity
+            if first < last:
+                return self._buffer[first:last].copy()
+            return np.concatenate((self._buffer[first:], self._buffer[:last]))
+
+    def flush(self):
+        # Writes the rows logged since the last flush as a new chunk
+        rows = self._take_new_rows()
+        if rows is None or self.path is None:
+            return
+        if self.use_hdf5:
+            with h5py.File(os.path.join(self.path, 'run.h5'), 'a') as h5_file:
+                h5_file.create_dataset('chunk_{:06d}'.format(self._chunk), data=rows)
+        else:
+            # Written to a temporary file and renamed so a crash or a reader of a live run never sees half a chunk
+            chunk_path = os.path.join(self.path, 'chunk_{:06d}.npy'.format(self._chunk))
+            with open(chunk_path + '.tmp', 'wb') as chunk_file:
+                np.save(chunk_file, rows)
+            os.replace(chunk_path + '.tmp', chunk_path)
+        self._chunk += 1
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as err:
+                print('Error writing pulse log chunk: {}'.format(err))
+        self.flush()
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def chunk_names(path: str):
+    return sorted(name for name in os.listdir(path) if name.startswith('chunk_') and name.endswith('.npy'))
+
+
+def open_pulse_log(path: str):
+    # Returns the chunks of the run logged in directory path, in order, without reading them into memory: .npy
+    # chunks are memory mapped and HDF5 chunks are h5py datasets (read on slicing, keep the file open while in use).
+    chunks = []
+    for name in chunk_names(path):
+        try:
+            chunks.append(np.load(os.path.join(path, name), mmap_mode='r'))
+        except (OSError, ValueError) as err:
+            print('Skipping unreadable pulse log chunk {}: {}'.format(os.path.join(path, name), err))
+    h5_path = os.path.join(path, 'run.h5')
+    if os.path.exists(h5_path):
+        if h5py is None:
+            print('h5py is needed to read {}'.format(h5_path))
+        else:
+            h5_file = h5py.File(h5_path, 'r')
+            chunks.extend(h5_file[name] for name in sorted(h5_file.keys()))
+    return chunks
+
+
+def load_pulse_log(path: str, fields=None):
+    # Whole run as one structured array, or just the named fields
+    chunks = open_pulse_log(path)
+    if not chunks:
+        return np.zeros(0, dtype=LOG_DTYPE if fields is None else LOG_DTYPE[list(fields)])
+    if fields is not None:
+        chunks = [chunk[list(fields)] if isinstance(chunk, np.ndarray) else chunk.fields(list(fields))[:]
+                  for chunk in chunks]
+    return np.concatenate([np.asarray(chunk[:]) for chunk in chunks])
@@ -6,8 +6,10 @@ from PyQt5.QtWidgets import (QHBoxLayout, QVBoxLayout, QLabel, QDialog, QPushBut
                              QSpacerItem, QWidget)
 from pathlib import Path
 from Laser_Hardware import CompexLaser
+from Laser_Telemetry import LaserTelemetry
+from Pulse_Logger import PulseLogger
 from Arduino_Hardware import LaserBrainArduino
-from time import sleep
+from time import sleep, monotonic
 import numpy as np
 import threading
 from warnings import warn
@@ -20,13 +22,38 @@ class RPiHardware(QWidget):
     sub_top = pyqtSignal()
     target_changed = pyqtSignal()
     laser_finished = pyqtSignal()
+    motion_finished = pyqtSignal()
+    run_line_released = pyqtSignal(str)
     laser_time_to_completion = pyqtSignal(int)
 
-    def __init__(self, laser: CompexLaser, arduino: LaserBrainArduino):
+    def __init__(self, laser: CompexLaser, arduino: LaserBrainArduino, sqm=None):
         super().__init__()
         # Set up access to the passed laser control object and get current params
         self.laser = laser
         self.arduino = arduino
+        # Optional SQM160 thickness monitor, needed for thickness terminated deposition steps
+        self.sqm = sqm
+        if self.sqm is not None:
+            self.sqm.start()
+        # Background poller for routine laser status, GUI elements should read
+        # from laser_telemetry.snapshot() rather than querying the laser.
+        self.laser_telemetry = LaserTelemetry(self.laser)
+        self.laser_telemetry.start()
+
+        # Have the arduino push axis state instead of polling it. While the stream is
+        # live, laser completion is detected from it rather than the laser_run GPIO.
+        self.laser_goal = None          # Pulse goal most recently sent to the arduino
+        self.laser_goal_sent_at = None  # monotonic() time that goal was sent
+        self.laser_goal_armed = False   # Set once the stream has shown the goal being worked on
+        self.motion_sent_at = None      # monotonic() time of the last move command, None when no move is pending
+        self.laser_ready_at = None      # monotonic() time the laser's start delay ends, None when not armed
+        self.pending_laser_goal = None  # Pulse goal waiting on the start delay
+        self.motion_armed = False       # Set once the stream has shown the move being worked on
+        self.laser_telemetry.opmode_changed.connect(self.on_laser_opmode)
+        self.arduino.status_updated.connect(self.on_arduino_status)
+        self.arduino.start_status_stream()
+        # Records both telemetry sources to disk while a deposition is running
+        self.pulse_logger = PulseLogger(self.laser_telemetry, self.arduino)
 
         # Set up class variables
         self.homing_sub = False  # Status flag that indicates if the substrate is being homed.
@@ -34,6 +61,13 @@ class RPiHardware(QWidget):
         # Setup timer to check when external trigger pulses finish.
         self.timer_check_laser_finished = QTimer()
         self.timer_check_laser_finished.timeout.connect(self.check_laser_finished)
+        self.timer_laser_goal = QTimer()
+        self.timer_laser_goal.setSingleShot(True)
+        self.timer_laser_goal.timeout.connect(self.send_pending_laser_goal)
+        # Fallback for catching the end of a move when the status stream isn't running.
+        self.timer_check_motion_finished = QTimer()
+        self.timer_check_motion_finished.setInterval(200)
+        self.timer_check_motion_finished.timeout.connect(self.check_motion_finished)
 
         # Define Pin Dictionaries
         hold_time = 0.01
@@ -52,12 +86,19 @@ class RPiHardware(QWidget):
 
         self.gpio_handler.sig_gpio_input.connect(self.gpio_act)
 
+        # Falling edges on the run lines. gpiozero calls these from its own thread so they are passed
+        # on through a signal to be handled on the GUI thread.
+        for name in ('sub_run', 'target_run', 'laser_run'):
+            self.buttons[name].when_released = lambda device: self.run_line_released.emit(device.dev_name)
+        self.run_line_released.connect(self.on_run_line_released)
+
     def start_laser(self, num_pulses=None):
-        self.laser.on()  # All cases need the laser in on mode.
+        self.arm_laser()  # All cases need the laser in on mode.
+        start_delay_msec = self.laser_start_remaining_msec()
         if num_pulses is None:
             self.laser_time_to_completion.emit(-9999)
         else:
-            self.laser_time_to_completion.emit(ceil(self.laser_start_delay_msec/1000 + num_pulses / self.laser.reprate))
+            self.laser_time_to_completion.emit(ceil(start_delay_msec/1000 + num_pulses / self.laser.reprate))
         if self.laser.trigger_src == 'INT':
             if num_pulses is None:
                 pass
@@ -65,7 +106,7 @@ class RPiHardware(QWidget):
                 time = float(num_pulses / self.laser.reprate)
                 warn("The number of pulses parameter can only be used accurately with an external trigger, internal "
                      "triggering of the laser will continue for {time} seconds then cease.".format(time=time))
-                QTimer.singleShot(self.laser_start_delay_msec - 500 + time * 1000, self.laser_finished.emit)
+                QTimer.singleShot(max(0, int(start_delay_msec - 500 + time * 1000)), self.laser_finished.emit)
             else:
                 raise TypeError("Num pulses was not an integer, partial pulses are not possible.")
         elif self.laser.trigger_src == 'EXT':
@@ -75,29 +116,162 @@ class RPiHardware(QWidget):
             if num_pulses is None:
                 self.arduino.update_laser_param('start')
             elif isinstance(num_pulses, int):
-                # Start the laser after 3 seconds of warmup
-                QTimer.singleShot(self.laser_start_delay_msec,
-                                  lambda: self.arduino.update_laser_param('goal', num_pulses))
-                QTimer.singleShot(self.laser_start_delay_msec,
-                                  lambda: print("laser pulsing started"))
-                # Start a timer that will kick off looking for the laser to go dormant
-                self.timer_check_laser_finished.start(self.laser_start_delay_msec + 500)
+                # Send the goal once the laser's start delay is over, if the laser was armed ahead of time
+                # (see arm_laser) some or all of the delay has already passed.
+                self.pending_laser_goal = num_pulses
+                self.timer_laser_goal.start(start_delay_msec)
+                # Start a timer that will kick off looking for the laser to go dormant, only used
+                # as a fallback when the arduino status stream isn't running.
+                self.timer_check_laser_finished.start(start_delay_msec + 500)
             else:
                 raise TypeError("Num pulses was not an integer, partial pulses are not possible.")
 
+    def arm_laser(self):
+        # Puts the laser in on mode and starts its start delay without firing, so the delay can run while
+        # something else (e.g. a move) is going on. start_laser then only waits out what is left of it.
+        self.laser.on()
+        if self.laser_ready_at is None:
+            self.laser_ready_at = monotonic() + self.laser_start_delay_msec / 1000
+
+    def on_laser_opmode(self, previous_opmode, opmode):
+        # If the laser drops out of on mode by itself (timeout, interlock) the next laser.on() starts the whole
+        # start delay over, so it is no longer armed
+        if not opmode.is_running:
+            self.laser_ready_at = None
+
+    def laser_start_remaining_msec(self):
+        if self.laser_ready_at is None:
+            return self.laser_start_delay_msec
+        return max(0, int((self.laser_ready_at - monotonic()) * 1000))
+
+    def send_pending_laser_goal(self):
+        if self.pending_laser_goal is not None:
+            print("laser pulsing started")
+            self.send_laser_goal(self.pending_laser_goal)
+            self.pending_laser_goal = None
+
+    def update_laser_goal(self, num_pulses: int):
+        # Changes the pulse goal in progress without restarting its count, e.g. to stop a thickness terminated
+        # step on the pulse it is predicted to reach its thickness. If the arduino has already passed num_pulses
+        # it stops where it is.
+        if self.pending_laser_goal is not None:
+            self.pending_laser_goal = num_pulses
+        elif self.laser_goal is not None:
+            self.laser_goal = num_pulses
+            self.arduino.update_laser_param('total goal', num_pulses)
+
+    def extend_laser_goal(self, num_pulses: int):
+        # Restarts a goal that has finished, carrying on from the arduino's count rather than resetting it, e.g.
+        # when a thickness terminated step stopped short of its thickness. laser_finished is emitted again once
+        # the count reaches num_pulses.
+        self.laser_goal = num_pulses
+        self.laser_goal_sent_at = monotonic()
+        self.laser_goal_armed = False
+        self.arduino.update_laser_param('total goal', num_pulses)
+        self.timer_check_laser_finished.start(500)
+
+    def send_laser_goal(self, num_pulses: int):
+        self.laser_goal = num_pulses
+        self.laser_goal_sent_at = monotonic()
+        self.laser_goal_armed = False
+        self.arduino.update_laser_param('goal', num_pulses)
+
+    def on_arduino_status(self, status):
+        # Called for every status frame pushed by the arduino. Watches for the
+        # current pulse goal and the last move to complete.
+        self.check_motion_status(status)
+        if self.laser_goal is None:
+            return
+        if status.laser_running or status.laser_pulses_remaining > 0:
+            self.laser_goal_armed = True
+        elif status.laser_pulses >= self.laser_goal and \
+                status.timestamp - self.laser_goal_sent_at > 2 * self.arduino.status_period_ms / 1000:
+            # Short goals can finish between frames, accept a frame showing the full count
+            # as long as it can't have been sent before the goal was received.
+            self.laser_goal_armed = True
+
+        if self.laser_goal_armed and not status.laser_running and status.laser_pulses_remaining == 0:
+            self.finish_laser_goal()
+
+    def check_motion_status(self, status):
+        # Same idea as the laser goal, watches for the last move command to complete.
+        if self.motion_sent_at is None:
+            return
+        moving = status.sub_running or status.sub_distance_to_go != 0 or status.target_distance_to_go != 0
+        if moving:
+            self.motion_armed = True
+        elif status.timestamp - self.motion_sent_at > 2 * self.arduino.status_period_ms / 1000:
+            # Moves to the current position, or short enough to finish between frames
+            self.motion_armed = True
+
+        if self.motion_armed and not moving:
+            self.finish_motion()
+
+    def finish_laser_goal(self):
+        print("Laser activity finished, emitting signal")
+        self.laser_goal = None
+        self.laser_goal_armed = False
+        self.timer_check_laser_finished.stop()
+        self.laser_finished.emit()
+
+    def begin_motion(self):
+        # Called whenever a move is commanded, motion_finished is emitted once
+        # both the substrate and carousel have stopped.
+        self.motion_sent_at = monotonic()
+        self.motion_armed = False
+        self.timer_check_motion_finished.start()
+
+    def finish_motion(self):
+        self.motion_sent_at = None
+        self.motion_armed = False
+        self.timer_check_motion_finished.stop()
+        self.motion_finished.emit()
+
+    def check_motion_finished(self):
+        if self.motion_sent_at is None:
+            self.timer_check_motion_finished.stop()
+        elif self.arduino.status_is_fresh():
+            # The status stream is live and will catch the end of the move
+            pass
+        elif not self.is_sub_running():
+            # The target run line isn't reliable (the firmware never pulls it low), so ask the arduino
+            # how far the carousel has to go.
+            remaining = self.arduino.query_motor_parameters('carousel', 'distance to go')
+            if remaining is not None and int(remaining) == 0:
+                self.finish_motion()
+
+    def on_run_line_released(self, name: str):
+        # Falling edge on one of the run lines, only used when the status stream isn't running.
+        if self.arduino.status_is_fresh():
+            return
+        if name == 'laser_run' and self.laser_goal is not None:
+            self.check_laser_finished()
+        elif name in ('sub_run', 'target_run'):
+            self.check_motion_finished()
+
     def check_laser_finished(self):
-        if self.buttons['laser_run'].is_active and self.timer_check_laser_finished.interval() > 1000:
+        if self.laser_goal is None:
+            # Already handled from the status stream
+            self.timer_check_laser_finished.stop()
+        elif self.arduino.status_is_fresh():
+            # The status stream is live and will catch the end of pulsing
+            pass
+        elif self.buttons['laser_run'].is_active and self.timer_check_laser_finished.interval() > 1000:
             self.timer_check_laser_finished.setInterval(200)
         elif self.buttons['laser_run'].is_active:
             pass
         elif not self.buttons['laser_run'].is_active:
-            print("Laser activity finished, emitting signal")
-            self.laser_finished.emit()
-            self.timer_check_laser_finished.stop()
+            self.finish_laser_goal()
 
     def stop_laser(self):
-        # Stop the laser from generating or accepting trigger pulses.
+        # Stop the laser from generating or accepting trigger pulses. A manual stop
+        # cancels any pulse goal so it isn't reported as finishing later.
         self.laser.off()
+        self.laser_ready_at = None
+        self.laser_goal = None
+        self.pending_laser_goal = None
+        self.timer_laser_goal.stop()
+        self.timer_check_laser_finished.stop()
         if self.laser.trigger_src == 'EXT':
             self.arduino.halt_laser()
 
@@ -131,8 +305,17 @@ class RPiHardware(QWidget):
             warn("Substrate has reached its lower limit and will not move further.")
 
     def move_sub_to(self, mm_tts: float):
-        goal_position = (mm_tts - Global.SUB_D0) * Global.SUB_STEPS_PER_MM
+        self.move_sub_to_position(self.sub_position_for_tts(mm_tts))
+
+    def move_sub_to_position(self, goal_position: int):
+        # Goal in motor steps, see sub_position_for_tts
         self.arduino.update_motor_param('substrate', 'goal', int(goal_position))
+        self.begin_motion()
+
+    @staticmethod
+    def sub_position_for_tts(mm_tts: float):
+        # Substrate motor position for a target to substrate distance in mm
+        return int((mm_tts - Global.SUB_D0) * Global.SUB_STEPS_PER_MM)
 
     def set_sub_speed(self, mm_spd: float):
         sub_spd = mm_spd * Global.SUB_STEPS_PER_MM
@@ -164,21 +347,37 @@ class RPiHardware(QWidget):
         Moves to the target indicated by target_num. Target numbers are zero indexed and can be kept track of
         of in the upper level GUI
         """
-        goal = (target_num % 6) * (Global.CAROUSEL_STEPS_PER_REV/6)
-        self.arduino.update_motor_param('carousel', 'goal', goal)
+        self.move_carousel_to_position(self.carousel_position_for_target(target_num))
+
+    def move_carousel_to_position(self, goal_position: int):
+        # Goal in motor steps, see carousel_position_for_target
+        self.arduino.update_motor_param('carousel', 'goal', goal_position)
+        self.begin_motion()
+
+    @staticmethod
+    def carousel_position_for_target(target_num: int):
+        return int((target_num % 6) * (Global.CAROUSEL_STEPS_PER_REV / 6))
 
     def current_target(self):
+        # Use the pushed status when it is current rather than asking the arduino
+        if self.arduino.status_is_fresh():
+            current_pos = self.arduino.status.target_position
+        else:
+            current_pos = int(self.arduino.query_motor_parameters('carousel', 'position'))
+
+        return self.target_from_position(current_pos)
+
+    @staticmethod
+    def target_from_position(current_pos: int):
         # This calculates the current position as a fraction of the total rotation, then multiplies by the number of
         #  of steps and rounds to get to an integer target positon, finally takes the modulus by the number of positions
         #  to account for the circle (position 6 = position 0)
-        # print(self.arduino.query_motor_parameters('carousel', 'position'))
-        current_pos = int(self.arduino.query_motor_parameters('carousel', 'position'))
-            
         return int(np.around(((current_pos % Global.CAROUSEL_STEPS_PER_REV) / Global.CAROUSEL_STEPS_PER_REV) * 6) % 6)
 
-    def raster_target(self):
-        # ToDo: implement this and test the arduino code attached to it.
-        pass
+    def raster_target(self, raster_steps: int):
+        # Rasters the current target by raster_steps either side of center (see Static.calc_raster_steps), 0 stops
+        # rastering and recenters the target.
+        self.arduino.update_motor_param('carousel', 'raster', int(raster_steps))
 
     def set_target_carousel_speed(self, dps: float):
         # ToDo: move these hardcoded values somewhere else so they are easier to change
@@ -0,0 +1,196 @@
+import json
+import os
+import numpy as np
+import Global_Values as Global
+from Pulse_Logger import open_pulse_log
+
+
+# Browsing of past runs logged by PulseLogger. The chunks of a run are memory
+# mapped (never read into memory as a whole), and a small index.json next to
+# them holds the step boundaries, per step statistics and the time span of each
+# chunk so that summaries and plot windows only touch the chunks they need.
+# The index is rebuilt whenever the run has gained chunks since it was written.
+
+INDEX_NAME = 'index.json'
+
+
+class StepSummary:
+    # Statistics for one step of a logged run. Energy statistics are over the
+    # logged rows, which hold the last energy reading at each update.
+    __slots__ = ('step', 'start_time', 'end_time', 'rows', 'pulses', 'energy_mean', 'energy_std')
+
+    def __init__(self, step, start_time, end_time, rows, pulses, energy_mean, energy_std):
+        self.step = step
+        self.start_time = start_time
+        self.end_time = end_time
+        self.rows = rows
+        self.pulses = pulses
+        self.energy_mean = energy_mean
+        self.energy_std = energy_std
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return 'StepSummary(step={}, duration={:.1f}, rows={}, pulses={}, energy_mean={}, energy_std={})'.format(
+            self.step, self.duration(), self.rows, self.pulses, self.energy_mean, self.energy_std)
+
+
+class RunHistory:
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks = open_pulse_log(path)
+        self.index = load_index(path)
+        if self.index is None or len(self.index['chunks']) != len(self.chunks):
+            self.index = build_index(self.chunks)
+            save_index(path, self.index)
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.index['chunks'])
+
+    def time_span(self):
+        # (first, last) time.time() of the run, None for an empty run
+        if not self.index['chunks']:
+            return None
+        return self.index['chunks'][0]['start_time'], self.index['chunks'][-1]['end_time']
+
+    def steps(self):
+        return [StepSummary(**summary) for summary in self.index['steps']]
+
+    def step_boundaries(self):
+        # [(step, first row, last row + 1), ...] in the order they were logged
+        return [tuple(boundary) for boundary in self.index['boundaries']]
+
+    def rows(self, start=0, stop=None, fields=None):
+        # Rows start to stop (run wide row numbers) as an in memory array, reading only the chunks they fall in
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        offset = 0
+        for chunk, info in zip(self.chunks, self.index['chunks']):
+            first, last = max(start - offset, 0), min(stop - offset, info['rows'])
+            if first < last:
+                part = chunk[first:last]
+                parts.append(part if fields is None else part[list(fields)])
+            offset += info['rows']
+        if not parts:
+            return np.zeros(0, dtype=self.chunks[0].dtype if self.chunks else None)
+        return np.concatenate([np.asarray(part) for part in parts])
+
+    def window(self, field: str, start_time=None, end_time=None):
+        # (times, values) of field between two time.time() values, only chunks overlapping the window are read
+        times, values = [], []
+        for chunk, info in zip(self.chunks, self.index['chunks']):
+            if info['rows'] == 0 or (end_time is not None and info['start_time'] > end_time) or \
+                    (start_time is not None and info['end_time'] < start_time):
+                continue
+            chunk_times = np.asarray(chunk['time'])
+            first = 0 if start_time is None else np.searchsorted(chunk_times, start_time, side='left')
+            last = chunk_times.size if end_time is None else np.searchsorted(chunk_times, end_time, side='right')
+            times.append(chunk_times[first:last])
+            values.append(np.asarray(chunk[field][first:last]))
+        if not times:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    def decimate(self, field: str, max_points=2000, start_time=None, end_time=None):
+        # Min/max downsampling for plotting: the window is split into max_points equal time bins and each bin is
+        # reduced to its min and max, so spikes survive however far the plot is zoomed out. Returns
+        # (bin centre times, mins, maxes) with empty bins left out.
+        times, values = self.window(field, start_time, end_time)
+        return decimate_min_max(times, values, max_points)
+
+
+def decimate_min_max(times, values, max_points=2000):
+    if times.size <= max_points:
+        return times, values, values
+    edges = np.linspace(times[0], times[-1], max_points + 1)
+    starts = np.searchsorted(times, edges[:-1], side='left')
+    filled = np.append(starts[1:], times.size) > starts  # Bins with at least one row
+    starts = starts[filled]
+    values = values.astype(float)
+    # reduceat takes the min/max from each start up to the next start
+    mins = np.fmin.reduceat(values, starts)
+    maxes = np.fmax.reduceat(values, starts)
+    centres = ((edges[:-1] + edges[1:]) / 2)[filled]
+    return centres, mins, maxes
+
+
+def build_index(chunks):
+    # Scans the run one chunk at a time to find where each step starts and ends and accumulate its statistics
+    chunk_info = []
+    boundaries = []  # [step, first row, last row + 1]
+    totals = {}  # step -> [start_time, end_time, rows, pulses, energy count, energy sum, energy sum of squares]
+    offset = 0
+    last_pulses = None
+    for chunk in chunks:
+        rows = len(chunk)
+        if rows == 0:
+            chunk_info.append({'rows': 0, 'start_time': None, 'end_time': None})
+            continue
+        times = np.asarray(chunk['time'])
+        steps = np.asarray(chunk['step'])
+        pulses = np.asarray(chunk['pulses'], dtype=np.int64)
+        energy = np.asarray(chunk['energy'], dtype=float)
+        chunk_info.append({'rows': rows, 'start_time': float(times[0]), 'end_time': float(times[-1])})
+
+        # Pulses delivered at each row, the counter restarts from 0 with every new pulse goal
+        previous = np.concatenate(([pulses[0] if last_pulses is None else last_pulses], pulses[:-1]))
+        delivered = np.where(pulses >= previous, pulses - previous, pulses)
+        last_pulses = pulses[-1]
+
+        segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(steps)) + 1))
+        segment_stops = np.append(segment_starts[1:], rows)
+        for first, last in zip(segment_starts, segment_stops):
+            step = int(steps[first])
+            if boundaries and boundaries[-1][0] == step and boundaries[-1][2] == offset + first:
+                boundaries[-1][2] = offset + int(last)
+            else:
+                boundaries.append([step, offset + int(first), offset + int(last)])
+            if step < 0:
+                continue
+            seg_energy = energy[first:last]
+            seg_energy = seg_energy[~np.isnan(seg_energy)]
+            total = totals.setdefault(step, [float(times[first]), 0., 0, 0, 0, 0., 0.])
+            total[1] = float(times[last - 1])
+            total[2] += int(last - first)
+            total[3] += int(delivered[first:last].sum())
+            total[4] += seg_energy.size
+            total[5] += float(seg_energy.sum())
+            total[6] += float(np.square(seg_energy).sum())
+        offset += rows
+
+    steps = []
+    for step, (start_time, end_time, rows, pulses, count, energy_sum, energy_sq) in sorted(totals.items()):
+        mean = energy_sum / count if count else None
+        std = float(np.sqrt(max(energy_sq / count - mean * mean, 0.))) if count else None
+        steps.append({'step': step, 'start_time': start_time, 'end_time': end_time, 'rows': rows,
+                      'pulses': pulses, 'energy_mean': mean, 'energy_std': std})
+    return {'chunks': chunk_info, 'boundaries': boundaries, 'steps': steps}
+
+
+def load_index(path: str):
+    try:
+        with open(os.path.join(path, INDEX_NAME), 'rt') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_index(path: str, index: dict):
+    # Written to a temporary file and renamed over the old index so a reader never sees half of it
+    temp_path = os.path.join(path, INDEX_NAME + '.tmp')
+    try:
+        with open(temp_path, 'wt') as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, os.path.join(path, INDEX_NAME))
+    except OSError as err:
+        print('Could not save run history index for {}: {}'.format(path, err))
+
+
+def list_runs(directory=Global.PULSE_LOG_DIR):
+    # Run directories in directory, newest first
+    try:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    except FileNotFoundError:
+        return []
+    return sorted((path for path in paths if os.path.isdir(path)), key=os.path.getmtime, reverse=True)
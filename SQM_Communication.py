@@ -1,27 +1,78 @@
+import numpy as np
+
+
+# The SQM-160 uses a 14 bit CRC (reflected polynomial 0x2001, initial value
+# 0x3fff) over the length character and the message. CRC_TABLE holds the
+# result of shifting each possible byte through the polynomial so a message is
+# processed a byte at a time instead of a bit at a time.
+def _makeCRCTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x2001 if crc & 0x1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _makeCRCTable()
+CRC_TABLE_NP = np.array(CRC_TABLE, dtype=np.uint16)
+
+
+def crc14(data: bytes):
+    # CRC of the bytes in data (the length character onwards)
+    crc = 0x3fff
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc & 0x3fff
+
+
+def splitCRC(crc: int):
+    # The two CRC characters appended to a message, 7 bits each offset by 34 to keep them printable
+    return {'CRC1': int((crc & 0x7F) + 34), 'CRC2': int(((crc >> 7) & 0x7F) + 34)}
+
+
 def calcCRC(message: str, split=True, debug=False):
-          byteMsg = message.encode('ascii')
-          length = 1 + byteMsg[1] - 34
-          if debug:
-            print(byteMsg, type(byteMsg))
-            print("Message length: ", length)
-          if length > 0:
-              crc = 0x3fff
-              for i in range(1, length + 1):
-                  if debug:
-                    print(i, byteMsg[i])
-                  crc = crc ^ byteMsg[i]
-                  for j in range(0, 8):
-                      tmpCRC = crc
-                      crc = crc >> 1
-                      if tmpCRC & 0x1 == 1:
-                          crc = crc ^ 0x2001
-          crc = crc & 0x3fff
-          if not split:
-            return crc
-          else:
-            crc1 = int((crc & 0x7F) + 34)
-            crc2 = int(((crc >> 7) & 0x7F) + 34)
-            return {'CRC1': crc1, 'CRC2': crc2}
+    # CRC of a message string starting with the sync character and length character
+    byteMsg = message.encode('ascii') if isinstance(message, str) else bytes(message)
+    length = 1 + byteMsg[1] - 34
+    if debug:
+        print(byteMsg, type(byteMsg))
+        print("Message length: ", length)
+    crc = crc14(byteMsg[1:length + 1]) if length > 0 else 0x3fff
+    if not split:
+        return crc
+    return splitCRC(crc)
+
+
+def calcCRCs(frames):
+    # CRCs of many frames at once (each starting with the sync and length characters), as a numpy array. The
+    # frames are processed together a byte position at a time.
+    frames = [bytes(frame) for frame in frames]
+    lengths = np.array([max(frame[1] - 33, 0) if len(frame) > 1 else 0 for frame in frames], dtype=np.intp)
+    crcs = np.full(len(frames), 0x3fff, dtype=np.uint16)
+    if not frames or lengths.max() == 0:
+        return crcs
+    data = np.zeros((len(frames), lengths.max()), dtype=np.uint16)
+    for row, (frame, length) in enumerate(zip(frames, lengths)):
+        data[row, :length] = np.frombuffer(frame[1:length + 1].ljust(length, b'\0'), dtype=np.uint8)
+    for column in range(data.shape[1]):
+        active = column < lengths
+        updated = (crcs >> 8) ^ CRC_TABLE_NP[(crcs ^ data[:, column]) & 0xFF]
+        crcs = np.where(active, updated, crcs)
+    return crcs & 0x3fff
+
+
+def verifyCRC(frame: bytes):
+    # True if frame (sync, length, message, CRC1, CRC2) is complete and its CRC characters match
+    frame = bytes(frame)
+    if len(frame) < 4 or frame[0] != ord('!'):
+        return False
+    length = 1 + frame[1] - 34
+    if length < 1 or len(frame) < length + 3:
+        return False
+    crc = splitCRC(crc14(frame[1:length + 1]))
+    return frame[length + 1] == crc['CRC1'] and frame[length + 2] == crc['CRC2']
 
 def genMsgString(command: str):
          sync = '!'
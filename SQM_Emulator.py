@@ -0,0 +1,109 @@
+import random
+from SQM_Communication import genMsgString, verifyCRC
+
+
+# Stand-in for an SQM-160 thickness monitor so SQM160 and the thickness driven
+# deposition code can be run without one. It answers the commands SQM160 uses
+# with the same framing and has the same feed/read_output/advance interface as
+# the arduino emulator, so it can be opened through Arduino_Emulator's
+# EmulatedSerial (and run in real or accelerated time by its EmulatorClock).
+#
+# Film grows at rate Angstrom/s while depositing is set, plus
+# angstrom_per_pulse for every pulse passed to add_pulses().
+
+RESPONSE_OK = 'A'
+RESPONSE_BAD_COMMAND = 'C'
+RESPONSE_BAD_CRC = 'E'
+
+
+class SQM160Emulator:
+    def __init__(self, channels=2, rate=0., angstrom_per_pulse=0.05, noise=0., seed=None):
+        self.channels = channels
+        self.rate = rate  # Angstrom/s while depositing
+        self.depositing = False
+        self.angstrom_per_pulse = angstrom_per_pulse
+        self.noise = noise  # Standard deviation of the reading noise, fraction of the value
+        self.thickness = 0.  # Angstrom since the last zero
+        self.measured_rate = 0.  # Angstrom/s including pulses, filtered over rate_filter_time
+        self.rate_filter_time = 1.  # s
+        self.frequency = 6.0e6  # Hz, falls as film builds up on the crystal
+        self.version = 'SQM-160 Emulator 1.0'
+        self.commands_processed = 0
+        self._random = random.Random(seed)
+        self._input = bytearray()
+        self._output = bytearray()
+        self._pending_pulse_thickness = 0.
+
+    # ---- Serial side ----
+
+    def feed(self, data: bytes):
+        self._input.extend(data)
+
+    def read_output(self):
+        data = bytes(self._output)
+        self._output.clear()
+        return data
+
+    def output_waiting(self):
+        return len(self._output)
+
+    # ---- Film model ----
+
+    def add_pulses(self, count: int):
+        self._pending_pulse_thickness += count * self.angstrom_per_pulse
+
+    def advance(self, dt: float):
+        grown = self._pending_pulse_thickness + (self.rate * dt if self.depositing else 0.)
+        self._pending_pulse_thickness = 0.
+        if dt > 0:
+            # Smoothed over about a second like the monitor's own rate filter
+            self.measured_rate += min(dt / self.rate_filter_time, 1.) * (grown / dt - self.measured_rate)
+        self.thickness += grown
+        self.frequency -= grown * 1e-3
+        self._handle_input()
+
+    def _noisy(self, value):
+        return value * (1 + self._random.gauss(0, self.noise)) if self.noise else value
+
+    def _handle_input(self):
+        while True:
+            start = self._input.find(b'!')
+            if start < 0:
+                self._input.clear()
+                return
+            del self._input[:start]
+            if len(self._input) < 2 or len(self._input) < self._input[1] - 34 + 4:
+                return  # Wait for the rest of the frame
+            size = self._input[1] - 34 + 4
+            frame = bytes(self._input[:size])
+            del self._input[:size]
+            if not verifyCRC(frame):
+                self._reply(RESPONSE_BAD_CRC)
+                continue
+            self.commands_processed += 1
+            self._reply(*self._handle_command(frame[2:-2].decode('ascii', errors='replace')))
+
+    def _handle_command(self, command: str):
+        code, argument = command[:1], command[1:]
+        if code == '@':
+            return RESPONSE_OK, self.version
+        if code in ('M', 'N'):
+            value = self.measured_rate if code == 'M' else self.thickness / 1000
+            return RESPONSE_OK, '{:.3f}'.format(self._noisy(value))
+        if code in ('L', 'O', 'P'):
+            try:
+                channel = int(argument)
+            except ValueError:
+                return RESPONSE_BAD_COMMAND, ''
+            if not 1 <= channel <= self.channels:
+                return RESPONSE_BAD_COMMAND, ''
+            value = {'L': self.measured_rate, 'O': self.thickness / 1000, 'P': self.frequency}[code]
+            return RESPONSE_OK, '{:.3f}'.format(self._noisy(value))
+        if code == 'S':
+            self.thickness = 0.
+            self.measured_rate = 0.
+            return RESPONSE_OK, ''
+        return RESPONSE_BAD_COMMAND, ''
+
+    def _reply(self, status: str, data=''):
+        self._output.extend(genMsgString(status + data))
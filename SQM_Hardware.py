@@ -0,0 +1,150 @@
+import serial
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+from time import monotonic
+import Global_Values as Global
+from SQM_Communication import genMsgString, verifyCRC
+
+
+# Replies from the SQM-160 are framed like commands: '!', length character,
+# a response status character ('A' for success) followed by the data, then the
+# two CRC characters.
+RESPONSE_OK = 'A'
+
+
+class SQMReading:
+    # One timestamped rate/thickness reading, a new object is made for every poll
+    __slots__ = ('timestamp', 'rate', 'thickness')
+
+    def __init__(self, timestamp, rate, thickness):
+        self.timestamp = timestamp  # time.monotonic() when the reading was taken
+        self.rate = rate  # Average rate over the enabled channels, Angstrom/s
+        self.thickness = thickness  # Average thickness over the enabled channels, kAngstrom
+
+    def age(self):
+        return monotonic() - self.timestamp
+
+    def __repr__(self):
+        return 'SQMReading(timestamp={}, rate={}, thickness={})'.format(self.timestamp, self.rate, self.thickness)
+
+
+class SQM160(QObject):
+    # Emitted from the poller thread with an SQMReading for every poll
+    reading_updated = pyqtSignal(object)
+
+    def __init__(self, port=Global.SQM_PORT, serial_port=None, poll_interval=Global.SQM_POLL_INTERVAL):
+        super().__init__()
+        # The SQM-160 defaults to 19200 8N1. An already open pyserial-like object can be passed as serial_port
+        # instead (e.g. EmulatedSerial with an SQM160Emulator), in which case port is ignored.
+        if serial_port is None:
+            serial_port = serial.Serial(port, baudrate=19200, timeout=0.1)
+        self.sqm = serial_port
+        self.poll_interval = poll_interval
+        self.reply_timeout = 0.5
+        self.reading = None  # Most recent SQMReading, None until the poller has read one
+        self.crc_errors = 0  # Replies dropped for a bad CRC or a malformed frame
+
+        self._io_lock = threading.Lock()  # One command and its reply on the wire at a time
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def query(self, command: str):
+        # Sends command and returns the data of the reply (after the status character), None if no valid reply came
+        with self._io_lock:
+            self.sqm.reset_input_buffer()
+            self.sqm.write(genMsgString(command))
+            frame = self._read_frame()
+        if frame is None:
+            return None
+        payload = frame[2:-2].decode('ascii', errors='replace')
+        if not payload.startswith(RESPONSE_OK):
+            print('SQM-160 rejected command {!r} with response {!r}'.format(command, payload[:1]))
+            return None
+        return payload[1:]
+
+    def _read_frame(self):
+        # Reads one reply frame, called with the io lock held
+        deadline = monotonic() + self.reply_timeout
+        sync = b''
+        while sync != b'!':
+            if monotonic() > deadline:
+                print('Timed out waiting for a reply from the SQM-160.')
+                return None
+            sync = self.sqm.read(1)
+        length = self.sqm.read(1)
+        if not length or length[0] < 34:
+            self.crc_errors += 1
+            return None
+        frame = b'!' + length + self.sqm.read(length[0] - 34 + 2)
+        if not verifyCRC(frame):
+            self.crc_errors += 1
+            print('Dropped SQM-160 reply with a bad CRC.')
+            return None
+        return frame
+
+    def query_float(self, command: str):
+        reply = self.query(command)
+        try:
+            return float(reply)
+        except (TypeError, ValueError):
+            return None
+
+    def version(self):
+        return self.query('@')
+
+    def rd_rate(self, channel=None):
+        # Average rate, or a single channel's rate, in Angstrom/s
+        return self.query_float('M' if channel is None else 'L{}'.format(channel))
+
+    def rd_thickness(self, channel=None):
+        # Average thickness, or a single channel's thickness, in kAngstrom
+        return self.query_float('N' if channel is None else 'O{}'.format(channel))
+
+    def rd_frequency(self, channel: int):
+        # Crystal frequency in Hz
+        return self.query_float('P{}'.format(channel))
+
+    def zero_thickness(self):
+        # Zeroes the average thickness and rate readings
+        return self.query('S') is not None
+
+    # ---- Streaming ----
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._poll_loop, name='SQM160', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def poll_once(self):
+        rate = self.rd_rate()
+        thickness = self.rd_thickness()
+        if rate is None or thickness is None:
+            return None
+        self.reading = SQMReading(monotonic(), rate, thickness)
+        self.reading_updated.emit(self.reading)
+        return self.reading
+
+    def _poll_loop(self):
+        while not self._stop_event.is_set():
+            started = monotonic()
+            try:
+                self.poll_once()
+            except serial.SerialException as err:
+                print('SQM-160 serial read failed:', err)
+                break
+            self._stop_event.wait(max(0., self.poll_interval - (monotonic() - started)))
+
+    def close(self):
+        self.stop()
+        self.sqm.close()
@@ -0,0 +1,39 @@
+from collections import deque
+import numpy as np
+import Global_Values as Global
+
+
+class ThicknessPredictor:
+    # Predicts the pulse count at which a step reaches its thickness from
+    # (pulses delivered, thickness grown) pairs taken as the SQM readings come
+    # in. Growth per pulse is a least squares fit over the most recent points so
+    # it follows slow drifts in deposition rate (target wear, energy) while
+    # averaging out the monitor's reading noise and 1 Angstrom resolution.
+
+    def __init__(self, window=Global.THICKNESS_FIT_POINTS, min_pulse_span=Global.THICKNESS_FIT_MIN_PULSES):
+        self.points = deque(maxlen=window)
+        self.min_pulse_span = min_pulse_span  # Pulses the fit has to cover before it is trusted
+
+    def add(self, pulses: int, thickness: float):
+        if self.points and pulses < self.points[-1][0]:
+            # The count went backwards (new goal), the old points no longer line up
+            self.points.clear()
+        self.points.append((pulses, thickness))
+
+    def thickness_per_pulse(self):
+        # kAngstrom per pulse, None until there is enough data for a positive fit
+        if len(self.points) < 3:
+            return None
+        pulses, thickness = np.array(self.points, dtype=float).T
+        if pulses[-1] - pulses[0] < self.min_pulse_span:
+            return None
+        slope = np.polyfit(pulses, thickness, 1)[0]
+        return slope if slope > 0 else None
+
+    def pulses_for(self, thickness: float):
+        # Predicted pulse count at which thickness is reached, None if there isn't a usable fit yet
+        per_pulse = self.thickness_per_pulse()
+        if per_pulse is None:
+            return None
+        last_pulses, last_thickness = self.points[-1]
+        return int(round(last_pulses + (thickness - last_thickness) / per_pulse))
@@ -0,0 +1,35 @@
+// Batched query for reading several parameters in one serial round trip.
+// Command: <b,sp,sm,tp,lp> where each pair is an axis (s, t or l) followed by
+// the same parameter character used for single queries.
+// Reply: {value,value,...} on one line, values in the order they were requested.
+// An unknown pair leaves its slot empty so the positions still line up. In binary
+// mode the reply is one FRAME_BATCH frame with the values packed back to back.
+
+void batchQuery() {
+    char * strtokIdx;
+    bool first = true;
+
+    replyBegin(FRAME_BATCH);
+    strtokIdx = strtok(inCommandBatch, ",");
+    while (strtokIdx != NULL) {
+        if (!first) replySeparator();
+        first = false;
+
+        switch (strtokIdx[0]) {
+            case 's':
+                replyMotorQuery(substrate, 's', strtokIdx[1]);
+                break;
+            case 't':
+                replyMotorQuery(target, 't', strtokIdx[1]);
+                break;
+            case 'l':
+                replyLaserQuery(laser, strtokIdx[1]);
+                break;
+        }
+        strtokIdx = strtok(NULL, ",");
+    }
+    replyEnd();
+
+    commandReady = false;
+    clearAxisModVars();
+}
@@ -0,0 +1,90 @@
+// Optional binary framing for everything the arduino sends back to the host.
+// The host asks for it with <n,b>; the arduino answers "BIN1" as a text line and
+// every reply after that is a frame. <n,t> goes back to text replies. Commands
+// from the host are always text.
+//
+// Frame: FRAME_SYNC, type, payload length, payload, CRC-16 (low byte first)
+// The CRC is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over type, length and
+// payload. Values in the payload are packed little-endian, longs and floats are
+// both 4 bytes.
+//
+// The reply* functions below are used to build every reply so that the query code
+// doesn't need to know which mode is active. In text mode they print the values the
+// same way the original protocol did.
+
+void updateProtocol() {
+    if (inCommandType == 'b') {
+        Serial.println("BIN1");
+        binaryMode = true;
+    }
+    else if (inCommandType == 't') {
+        binaryMode = false;
+        Serial.println("TXT1");
+    }
+    commandReady = false;
+    clearAxisModVars();
+}
+
+void replyBegin(byte type) {
+    frameType = type;
+    frameLength = 0;
+    if (!binaryMode && type == FRAME_BATCH) Serial.print('{');
+}
+
+void replyAppend(const void * value, byte length) {
+    if (frameLength + length > sizeof(frameBuffer)) return;  // Drop values that won't fit
+    memcpy(frameBuffer + frameLength, value, length);
+    frameLength += length;
+}
+
+void replyLong(long value) {
+    if (binaryMode) replyAppend(&value, sizeof(value));
+    else Serial.print(value);
+}
+
+void replyFloat(float value) {
+    if (binaryMode) replyAppend(&value, sizeof(value));
+    else Serial.print(value);
+}
+
+void replyByte(byte value) {
+    if (binaryMode) replyAppend(&value, sizeof(value));
+    else Serial.print(value);
+}
+
+void replySeparator() {
+    if (!binaryMode) Serial.print(',');
+}
+
+void replyEnd() {
+    if (binaryMode) {
+        sendFrame(frameType, frameBuffer, frameLength);
+    }
+    else {
+        if (frameType == FRAME_BATCH) Serial.print('}');
+        Serial.println();
+    }
+}
+
+void sendFrame(byte type, const byte * payload, byte length) {
+    byte header[3] = {FRAME_SYNC, type, length};
+    unsigned int crc = 0xFFFF;
+    crc = crc16Update(crc, header + 1, 2);
+    crc = crc16Update(crc, payload, length);
+
+    Serial.write(header, 3);
+    Serial.write(payload, length);
+    Serial.write((byte)(crc & 0xFF));
+    Serial.write((byte)(crc >> 8));
+}
+
+unsigned int crc16Update(unsigned int crc, const byte * data, byte length) {
+    for (byte i = 0; i < length; i++) {
+        crc ^= (unsigned int)data[i] << 8;
+        for (byte j = 0; j < 8; j++) {
+            if (crc & 0x8000) crc = (crc << 1) ^ 0x1021;
+            else crc <<= 1;
+        }
+    }
+    return crc;
+}
@@ -36,6 +36,7 @@ char inCommandType = 'z';
 char inCommandPinNum = 0;
 
 char inCommandSerForward[numChars];
+char inCommandBatch[numChars];   // Axis/parameter pairs for a batched query, e.g. "sp,sm,tp"
 char inCommandParam = 'z';
 long inCommandValLong;
 float inCommandValFloat;
@@ -56,6 +57,21 @@ int rasterSteps = 0;          // Stores the number of steps across the target, s
 bool rasterOn = false;        // Sets the raster on off state
 bool centering = false;       // Set based on whether the target is returning to center
 int rasterSide = 1;           // Which side of the target should be moved to
+unsigned long statusPeriod = 0;     // Milliseconds between pushed status frames, 0 turns the stream off
+unsigned long lastStatusFrame = 0;  // millis() when the last status frame was sent
+
+// Reply framing, see binaryFraming.ino. Replies and status frames are sent as text
+// until the host negotiates binary mode with <n,b>.
+enum FRAME_TYPES {
+  FRAME_SYNC = 0xA5,
+  FRAME_REPLY = 0x01,
+  FRAME_BATCH = 0x02,
+  FRAME_STATUS = 0x03
+};
+bool binaryMode = false;
+byte frameType = 0;
+byte frameBuffer[64];
+byte frameLength = 0;
 
 /********************************************** Main run loops **********************************************/
 void setup() {
@@ -98,7 +114,9 @@ void loop() {
         digitalPinWrite();
         break;
       case 'i':
-        Serial.println(digitalPinRead());
+        replyBegin(FRAME_REPLY);
+        replyLong(digitalPinRead());
+        replyEnd();
         break;
       case 'f':
         forwardSerial1();
@@ -115,6 +133,15 @@ void loop() {
       case 'l':
         updateLaserParams(laser);
         break;
+      case 'b':
+        batchQuery();
+        break;
+      case 'm':
+        updateStatusStream();
+        break;
+      case 'n':
+        updateProtocol();
+        break;
       default:
         commandReady = false; // Protects against erroneous commands sending the arduino into a loop
         break;
@@ -178,4 +205,10 @@ void loop() {
 
   // Set the current target position
   currentTarget = round((fmod(target.currentPosition(), CAROUSEL_STEPS_PER_REV) / CAROUSEL_STEPS_PER_REV) * 6);
+
+  // Push a status frame to the host if the stream is on and one is due
+  if (statusPeriod > 0 && millis() - lastStatusFrame >= statusPeriod) {
+    lastStatusFrame = millis();
+    sendStatusFrame();
+  }
 }
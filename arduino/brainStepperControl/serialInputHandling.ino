@@ -47,6 +47,11 @@ void parseData() {      // split the data into its parts
     
     strtokIdx = strtok(tempChars,",");      // get axis for the command to modify
     inCommandAxis = *strtokIdx;              // s=substrate, t=targets, p=pin, c=serial forward; NOTE: Need to copy the pointer to the variable. direct assignment breaks things
+
+    if (inCommandAxis == 'b') {             // Batched query, keep the list of axis/parameter pairs for batchQuery()
+        strcpy(inCommandBatch, inCommandChars + 2);
+        return;
+    }
     
     strtokIdx = strtok(NULL, ",");          // get the modification type
     if (inCommandAxis == 'o' || inCommandAxis == 'i') {               // branch to set the data type based on command axis
@@ -58,7 +63,7 @@ void parseData() {      // split the data into its parts
         //}
         strcpy(inCommandSerForward, strtokIdx);
     }
-    else if (inCommandAxis == 's' || inCommandAxis == 't' || inCommandAxis == 'l')
+    else if (inCommandAxis == 's' || inCommandAxis == 't' || inCommandAxis == 'l' || inCommandAxis == 'm' || inCommandAxis == 'n')
     {                                        // otherwise the second value should be a char signifying optype
         inCommandType = *strtokIdx;          // u=update, h=halt; NOTE: Need to copy the pointer to the variable. direct assignment breaks things
     }
@@ -83,6 +88,7 @@ void clearAxisModVars () {
     inCommandType = 'z';
     inCommandPinNum = -1;
     inCommandSerForward[numChars] = {0};
+    inCommandBatch[0] = '\0';
     inCommandParam = 'z';
     inCommandValLong = 0;  // This probably needs to not be 0... but will have to look for a vlaue that makes life easy
     inCommandValFloat = 0.0;
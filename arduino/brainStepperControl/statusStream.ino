@@ -0,0 +1,46 @@
+// Pushed status stream so the host doesn't have to poll for axis state.
+// Command: <m,u,r,period> sets the number of milliseconds between frames,
+// <m,u,r,0> or <m,h> turns the stream off.
+// Frame: #subPos,subToGo,targetPos,targetToGo,laserPulses,laserToGo,flags
+// The leading '#' marks the line as unsolicited so the host doesn't take it
+// as a reply to a query. Flags: 1=substrate running, 2=target running,
+// 4=laser running, 8=raster on. In binary mode the same values are sent as a
+// FRAME_STATUS frame: six little-endian longs followed by the flags byte.
+
+void updateStatusStream() {
+    if (inCommandType == 'u' && inCommandParam == 'r') {
+        if (inCommandValLong < 0) inCommandValLong = 0;
+        statusPeriod = inCommandValLong;
+        lastStatusFrame = 0;
+    }
+    else if (inCommandType == 'h') {
+        statusPeriod = 0;
+    }
+    commandReady = false;
+    clearAxisModVars();
+}
+
+void sendStatusFrame() {
+    byte flags = 0;
+    if (substrate.isRunning()) flags |= 1;
+    if (target.isRunning()) flags |= 2;
+    if (laser.isRunning()) flags |= 4;
+    if (rasterOn) flags |= 8;
+
+    if (!binaryMode) Serial.print('#');
+    replyBegin(FRAME_STATUS);
+    replyLong(substrate.currentPosition());
+    replySeparator();
+    replyLong(substrate.distanceToGo());
+    replySeparator();
+    replyLong(target.currentPosition());
+    replySeparator();
+    replyLong(target.distanceToGo());
+    replySeparator();
+    replyLong(laser.currentPosition());
+    replySeparator();
+    replyLong(laser.distanceToGo());
+    replySeparator();
+    replyByte(flags);
+    replyEnd();
+}
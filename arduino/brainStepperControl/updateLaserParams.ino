@@ -21,6 +21,14 @@ void updateLaserParams(AccelStepper & laser) {           // Passes laser by refe
                 laser.move(inCommandValLong);
                 commandReady = false;
                 break;
+            case 't':                       // Change the goal to a total number of pulses since the last 'g'
+                laserRunIndef = false;      // without resetting the count, so a running goal can be trimmed
+                if (inCommandValLong < laser.currentPosition()) {
+                    inCommandValLong = laser.currentPosition();  // Already past it, stop here (never step back)
+                }
+                laser.moveTo(inCommandValLong);
+                commandReady = false;
+                break;
             case 'd':                       // Used to run without a set number of pulses
                 laserRunIndef = true;
                 //laser.setSpeed(startSpeed);
@@ -29,26 +37,9 @@ void updateLaserParams(AccelStepper & laser) {           // Passes laser by refe
         }
     }
     else if (inCommandType == 'q') {
-      switch(inCommandParam) {
-        case 'p':
-          Serial.println(laser.currentPosition());
-          break;
-        case 'm':
-          Serial.println(laser.maxSpeed());
-          break;
-        case 'v':
-          Serial.println(laser.speed());
-          break;
-        case 'g':
-          Serial.println(laser.targetPosition());
-          break;
-        case 'd':
-          Serial.println(laser.distanceToGo());
-          break;
-        case 'r':
-          Serial.println(laser.isRunning());
-          break;
-        }
+        replyBegin(FRAME_REPLY);
+        replyLaserQuery(laser, inCommandParam);
+        replyEnd();
         commandReady = false;
     }
     else if (inCommandType == 'h') {
@@ -61,3 +52,28 @@ void updateLaserParams(AccelStepper & laser) {           // Passes laser by refe
         clearAxisModVars();
     }
 }
+
+void replyLaserQuery(AccelStepper & laser, char param) {
+    // Adds the value of a laser parameter to the current reply so that it can be used for
+    // single queries and for batched queries
+    switch(param) {
+        case 'p':
+            replyLong(laser.currentPosition());
+            break;
+        case 'm':
+            replyFloat(laser.maxSpeed());
+            break;
+        case 'v':
+            replyFloat(laser.speed());
+            break;
+        case 'g':
+            replyLong(laser.targetPosition());
+            break;
+        case 'd':
+            replyLong(laser.distanceToGo());
+            break;
+        case 'r':
+            replyLong(laser.isRunning());
+            break;
+    }
+}
@@ -84,30 +84,9 @@ void updateMotorParams(AccelStepper50pctDuty & motor, char axis) {           //
     commandReady = false;
   }
   else if (inCommandType == 'q') {
-    switch (inCommandParam) {
-      case 'p':
-        Serial.println(motor.currentPosition());
-        break;
-      case 'a':
-        if (axis == 't') Serial.println(targetAccel);
-        else if (axis == 's') Serial.println(subAccel);
-        break;
-      case 'm':
-        Serial.println(motor.maxSpeed());
-        break;
-      case 'v':
-        Serial.println(motor.speed());
-        break;
-      case 'g':
-        Serial.println(motor.targetPosition());
-        break;
-      case 'd':
-        Serial.println(motor.distanceToGo());
-        break;
-      case 'r':
-        Serial.println(motor.isRunning());
-        break;
-    }
+    replyBegin(FRAME_REPLY);
+    replyMotorQuery(motor, axis, inCommandParam);
+    replyEnd();
     commandReady = false;
   }
   else if (inCommandType == 'h') {
@@ -128,6 +107,35 @@ void updateMotorParams(AccelStepper50pctDuty & motor, char axis) {           //
   }
 }
 
+void replyMotorQuery(AccelStepper50pctDuty & motor, char axis, char param) {
+  // Adds the value of a motor parameter to the current reply so that it can be used for
+  // single queries and for batched queries
+  switch (param) {
+    case 'p':
+      replyLong(motor.currentPosition());
+      break;
+    case 'a':
+      if (axis == 't') replyFloat(targetAccel);
+      else if (axis == 's') replyFloat(subAccel);
+      break;
+    case 'm':
+      replyFloat(motor.maxSpeed());
+      break;
+    case 'v':
+      replyFloat(motor.speed());
+      break;
+    case 'g':
+      replyLong(motor.targetPosition());
+      break;
+    case 'd':
+      replyLong(motor.distanceToGo());
+      break;
+    case 'r':
+      replyLong(motor.isRunning());
+      break;
+  }
+}
+
 int shortestMoveToTarget(int finalPos) {
   // Function adapted from https://stackoverflow.com/questions/9505862/shortest-distance-between-two-degree-marks-on-a-circle
   // Origin position is from the target motor's current position
@@ -0,0 +1,313 @@
+"""
+Benchmarks for the hardware control stack, run against the simulated laser
+(Laser_Simulator) and the Arduino firmware emulator (Arduino_Emulator) so they
+can be run on any machine. Reports per command round trip latency
+percentiles, commands/second, time the GUI thread spends blocked in each
+refresh tick and the end to end time for a multi step deposition.
+
+Run from anywhere with:
+    python testing/Control_Stack_Benchmark.py [--quick]
+
+The GUI and deposition benchmarks need gpiozero (using its MockFactory) for
+RPiHardware and are skipped if it isn't installed.
+"""
+import argparse
+import os
+import sys
+import threading
+from time import perf_counter, monotonic
+
+import numpy as np
+
+# The control modules open their ui/code files relative to the repo root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtCore import QTimer, QEventLoop
+from PyQt5.QtWidgets import QApplication
+from Laser_Hardware import CompexLaser, PRIORITY_POLL, SETTING_QUERIES, HANDSHAKE_QUERIES
+from Laser_Simulator import CompexLaserSimulator
+from Arduino_Hardware import LaserBrainArduino
+from Arduino_Emulator import BrainStepperEmulator, EmulatedSerial
+
+
+def time_calls(func, count: int):
+    # Wall time of count sequential calls to func, in seconds
+    samples = np.empty(count)
+    for i in range(count):
+        start = perf_counter()
+        func()
+        samples[i] = perf_counter() - start
+    return samples
+
+
+def report(name: str, samples):
+    samples = np.asarray(samples)
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1000
+    print('  {:<34s} n={:<5d} p50={:8.3f}ms  p90={:8.3f}ms  p99={:8.3f}ms  max={:8.3f}ms  {:9.1f}/s'
+          .format(name, samples.size, p50, p90, p99, samples.max() * 1000, samples.size / samples.sum()))
+
+
+def throughput(func, threads: int, duration: float):
+    # Calls func from several threads at once for duration seconds, returns calls/s
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def worker(idx):
+        while not stop.is_set():
+            func()
+            counts[idx] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    start = perf_counter()
+    for thread in workers:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / (perf_counter() - start)
+
+
+def make_laser(latency: float, time_scale=1., cache=True):
+    simulator = CompexLaserSimulator(time_scale=time_scale, latency=latency, warmup_time=0.)
+    return CompexLaser('simulated', resource=simulator, cache=cache), simulator
+
+
+def make_arduino(binary: bool, time_scale=1.):
+    emulator = BrainStepperEmulator()
+    serial_port = EmulatedSerial(emulator, time_scale=time_scale)
+    return LaserBrainArduino('emulated', binary=binary, serial_port=serial_port), emulator
+
+
+# =============================================================================
+#     Command latency and throughput
+# =============================================================================
+
+def bench_laser(count: int, latency: float, duration: float):
+    print('\nCompexLaser (simulated, {:.1f}ms device latency)'.format(latency * 1000))
+    # Uncached so every call is a real round trip, the query cache is measured separately below
+    laser, simulator = make_laser(latency, cache=False)
+    try:
+        queries = sorted(SETTING_QUERIES) + list(HANDSHAKE_QUERIES)
+        sequential = sum(time_calls(lambda: laser.query(query, use_cache=False), 1)[0] for query in queries)
+        print('  {:<34s} {:9.1f} ms pipelined, {:.1f} ms one query at a time ({} queries)'
+              .format('connect handshake', laser.connect_time * 1000, sequential * 1000, len(queries)))
+        report('rd_opmode', time_calls(laser.rd_opmode, count))
+        report('rd_energy', time_calls(laser.rd_energy, count))
+        report('rd_tube_press', time_calls(laser.rd_tube_press, count))
+        report('rd_reprate (settings mirror)', time_calls(laser.rd_reprate, count))
+        report('check_settings (bulk read)', time_calls(laser.check_settings, max(count // 10, 5)))
+        report('set_energy (write)', time_calls(lambda: laser.set_energy(200), count))
+        report('set_reprate (write)', time_calls(lambda: laser.set_reprate(10), count))
+
+        # Command latency while the telemetry poller competes for the line
+        stop = threading.Event()
+
+        def poll():
+            while not stop.is_set():
+                laser.query('EGY?', priority=PRIORITY_POLL)
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+        report('rd_opmode (with poll load)', time_calls(laser.rd_opmode, count))
+        stop.set()
+        poller.join()
+
+        for threads in (1, 4):
+            print('  {:<34s} {:9.1f} cmds/s'.format('throughput, {} thread(s)'.format(threads),
+                                                    throughput(laser.rd_energy, threads, duration)))
+    finally:
+        laser.disconnect()
+
+    laser, simulator = make_laser(latency)
+    try:
+        report('rd_opmode (cached)', time_calls(laser.rd_opmode, count))
+        report('set_energy + rd_energy_setting',
+               time_calls(lambda: (laser.set_energy(200), laser.rd_energy_setting()), count))
+    finally:
+        laser.disconnect()
+
+
+def bench_arduino(count: int, duration: float):
+    for binary in (False, True):
+        arduino, emulator = make_arduino(binary)
+        print('\nLaserBrainArduino (emulated, {} replies)'.format('binary' if arduino.binary_mode else 'text'))
+        try:
+            report('query position', time_calls(lambda: arduino.query_motor_parameters('substrate', 'position'),
+                                                count))
+            report('query max speed (float)', time_calls(lambda: arduino.query_motor_parameters('carousel', 'max speed'),
+                                                         count))
+            fields = [('carousel', 'position'), ('substrate', 'position'), ('substrate', 'max speed'),
+                      ('carousel', 'max speed'), ('carousel', 'acceleration')]
+            report('query_many (5 fields)', time_calls(lambda: arduino.query_many(fields), count))
+            report('5 separate queries', time_calls(
+                lambda: [arduino.query_motor_parameters(motor, param) for motor, param in fields], count // 5 or 1))
+            report('update_motor_param (write)', time_calls(
+                lambda: arduino.update_motor_param('substrate', 'max speed', 1000), count))
+
+            # Pipelined: keep several requests in flight at once
+            def pipelined():
+                futures = [arduino.query_motor_parameters_async('substrate', 'position') for _ in range(8)]
+                for future in futures:
+                    arduino.wait_reply(future)
+            rate = throughput(pipelined, 1, duration) * 8
+            print('  {:<34s} {:9.1f} cmds/s'.format('throughput, 8 in flight', rate))
+            print('  {:<34s} {:9.1f} cmds/s'.format('throughput, 1 in flight', throughput(
+                lambda: arduino.query_motor_parameters('substrate', 'position'), 1, duration)))
+
+            arduino.start_status_stream()
+            started = monotonic()
+            first = arduino.status.timestamp if arduino.status is not None else None
+            frames = 0
+            while monotonic() - started < duration:
+                QApplication.processEvents()
+                if arduino.status is not None and arduino.status.timestamp != first:
+                    first = arduino.status.timestamp
+                    frames += 1
+            print('  {:<34s} {:9.1f} frames/s (requested {:.0f}/s)'.format(
+                'status stream', frames / duration, 1000 / arduino.status_period_ms))
+            arduino.stop_status_stream()
+        finally:
+            arduino.close()
+            arduino.arduino.close()
+
+
+# =============================================================================
+#     GUI thread blocking and end to end deposition (need RPiHardware)
+# =============================================================================
+
+def make_brain(time_scale: float):
+    # Returns (brain, laser, arduino, emulator) or None if gpiozero isn't available
+    try:
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+    except ImportError:
+        return None
+    from RPi_Hardware import RPiHardware
+    Device.pin_factory = MockFactory()
+    laser, simulator = make_laser(latency=0.02, time_scale=time_scale)
+    arduino, emulator = make_arduino(binary=True, time_scale=time_scale)
+    emulator.attach_pi_pins(Device.pin_factory)
+    brain = RPiHardware(laser=laser, arduino=arduino)
+    # QTimer delays aren't scaled, shorten the laser start delay to match the simulator
+    brain.laser_start_delay_msec = int(simulator.start_delay * 1000 / time_scale) + 100
+    return brain, laser, simulator, arduino, emulator
+
+
+def run_event_loop(seconds: float):
+    loop = QEventLoop()
+    QTimer.singleShot(int(seconds * 1000), loop.quit)
+    loop.exec_()
+
+
+def wait_for(predicate, timeout: float):
+    # Runs the event loop until predicate() is true, returns False on timeout
+    deadline = monotonic() + timeout
+    while not predicate():
+        if monotonic() > deadline:
+            return False
+        QApplication.processEvents(QEventLoop.AllEvents, 5)
+    return True
+
+
+def bench_gui_ticks(brain, laser, duration: float):
+    from Docked_Laser_Status_Control import LaserStatusControl
+    from Docked_Motor_Control import MotorControlPanel
+
+    print('\nGUI thread blocking per refresh tick')
+    lsc = LaserStatusControl(laser, brain)
+    motor_panel = MotorControlPanel(brain)
+    # Stop the panels' own timers and drive the same slots on the same schedule
+    # so that each call can be timed.
+    lsc.update_timer.stop()
+    motor_panel.motor_update_timer.stop()
+    ticks = {'LaserStatusControl.update_lsc': (lsc.update_lsc, int(1000 / laser.reprate), []),
+             'MotorControlPanel.update_fields': (motor_panel.update_fields, 100, [])}
+
+    timers = []
+    for name, (slot, interval, samples) in ticks.items():
+        def timed(slot=slot, samples=samples):
+            start = perf_counter()
+            slot()
+            samples.append(perf_counter() - start)
+        timer = QTimer()
+        timer.timeout.connect(timed)
+        timer.start(interval)
+        timers.append(timer)
+    run_event_loop(duration)
+    for timer in timers:
+        timer.stop()
+    for name, (slot, interval, samples) in ticks.items():
+        report(name, samples)
+
+
+def bench_deposition(brain, laser, arduino, steps, timeout=120.):
+    # Runs a deposition through DepositionWorker: for each step move the carousel and substrate, then fire the
+    # step's pulses on the external trigger.
+    from Deposition_Control import DepositionWorker
+    from Deposition_Plan import compile_deposition
+    import xml.etree.ElementTree as ET
+
+    print('\nEnd to end deposition ({} steps, simulated time scale {:g}x)'.format(
+        len(steps), arduino.arduino.clock.time_scale))
+    laser.set_trigger('EXT')
+    # The simulator doesn't see the arduino's trigger pulses, without this it times out on long steps and the
+    # timeout prompt blocks the run
+    laser.set_timeout(False)
+    deposition = ET.Element('deposition')
+    for idx, (target, tts, pulses) in enumerate(steps):
+        step = ET.SubElement(deposition, 'step', step_index=str(idx), step_name='Step {}'.format(idx))
+        for key, value in (('target', target), ('raster', False), ('tts_distance', tts), ('num_pulses', pulses),
+                           ('reprate', laser.reprate), ('delay', 0), ('man_action', '')):
+            ET.SubElement(step, key).text = str(value)
+    plan = compile_deposition(deposition)
+
+    worker = DepositionWorker(laser, brain)
+    step_starts = []
+    worker.step_started.connect(lambda idx: step_starts.append(monotonic()))
+    start = monotonic()
+    worker.start_deposition(plan)
+    if not wait_for(lambda: not worker.is_running(), timeout):
+        print('  Timed out in state {} on step {}'.format(worker.state, worker.curr_step_idx))
+        worker.halt_dep()
+        return
+    total = monotonic() - start
+    report('per step', np.diff(step_starts + [start + total]))
+    print('  {:<34s} {:9.3f} s'.format('total', total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='fewer samples, for a smoke test')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated laser query latency (s)')
+    parser.add_argument('--time-scale', type=float, default=20., help='speed up of simulated motion/pulses')
+    args = parser.parse_args()
+
+    count = 50 if args.quick else 500
+    duration = 0.5 if args.quick else 2.
+    app = QApplication.instance() or QApplication(sys.argv)
+    # The panels look the target roster etc. up on the app, as PLDControlApp in Laser_Control_GUI sets it up
+    if not hasattr(app, 'instrument_settings'):
+        from Instrument_Preferences import InstrumentPreferencesDialog
+        app.instrument_settings = InstrumentPreferencesDialog()
+
+    bench_laser(count, args.latency, duration)
+    bench_arduino(count, duration)
+
+    hardware = make_brain(args.time_scale)
+    if hardware is None:
+        print('\ngpiozero is not installed, skipping the GUI and deposition benchmarks')
+        return
+    brain, laser, simulator, arduino, emulator = hardware
+    bench_gui_ticks(brain, laser, duration * 2)
+    steps = [(0, 60., 200), (2, 55., 500), (2, 55., 100), (4, 62., 300)]
+    bench_deposition(brain, laser, arduino, steps[:2] if args.quick else steps)
+    brain.laser_telemetry.stop()
+    laser.disconnect()
+    arduino.close()
+
+
+if __name__ == '__main__':
+    main()